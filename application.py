@@ -1,25 +1,45 @@
 import json
 import os
-import tempfile
 import uuid
-import boto3
-from flask import abort, Flask, request, send_file
-from globus_sdk import ConfidentialAppAuthClient
-from container_handler import convert_definition_file, pull_container
-from pg_utils import build_schema, create_table_entry, prep_database, select_by_column, table_exists, update_table_entry
-from sqs_queue_utils import put_message
+from flask import abort, Flask, request, Response, stream_with_context
+from auth_utils import authenticate, get_token_cache
+from build_graph import graph_status, submit_graph
+from container_handler import (container_location, convert_definition_file, find_cached_build, find_cached_builds,
+                               get_artifact_cache)
+from gc_utils import get_garbage_collector
+from git_cache_utils import get_git_cache, is_git_url
+from image_cache_utils import get_image_cache
+from log_utils import follow_log, read_log
+from metrics_utils import CONTENT_TYPE as METRICS_CONTENT_TYPE, EXPORT_SECONDS, render_metrics
+from node_utils import NodeHeartbeat, detect_formats, list_nodes
+from pg_utils import (BUILD_KEY, BUILD_PREVIOUS_COLUMNS, BUILD_RESET_COLUMNS, build_schema, create_table_entry,
+                      pool_stats, prep_database, select_by_any, select_by_column, table_exists, update_schema,
+                      update_table_entry, upsert_table_entries)
+from sqs_queue_utils import put_message, put_messages
+from status_utils import FINAL_STATUSES, get_build, json_default, status_events, wait_for_change
 from task_manager import TaskManager
+from upload_utils import UploadTooLarge, max_upload_size, stream_upload
 
 
 application = Flask(__name__)
-manager = TaskManager(max_threads=11, kill_time=10)
-manager.start_prune_thread(10)
+# Leaves room for the multipart form around the file
+application.config["MAX_CONTENT_LENGTH"] = max_upload_size() + 1024 ** 2
+MAX_BATCH_SIZE = 1000
+
+# Builds also run in the web process unless XCS_EMBEDDED_THREADS is 0, in which case they only run on workers
+embedded_threads = int(os.environ.get("XCS_EMBEDDED_THREADS", 11))
+manager = TaskManager(max_threads=embedded_threads, min_threads=min(1, embedded_threads), kill_time=10,
+                      formats=detect_formats() if embedded_threads else [], max_owner_threads=4)
+heartbeat = NodeHeartbeat(manager) if embedded_threads else None
+manager.export_metrics()
+if embedded_threads:
+    manager.start_prune_thread(10)
+    manager.start_scale_thread(5)
 
 
 @application.route("/change_thread", methods=["POST"])
 def change_thread():
-    global manager
-    manager = TaskManager(max_threads=request.json["threads"])
+    manager.resize(max_threads=request.json["threads"], min_threads=request.json.get("min_threads"))
     return "k"
 
 
@@ -27,227 +47,508 @@ def change_thread():
 def config():
     if not(table_exists("definition") and table_exists('build')):
         prep_database()
+    update_schema()
+    if heartbeat is not None:
+        heartbeat.start()
+
+
+@application.route('/metrics')
+def metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
 
 
+# /thread is an alias kept for clients written before /pool
+@application.route('/pool')
 @application.route('/thread')
-def thread():
-    return json.dumps(manager.thread_status)
+def pool():
+    return json.dumps(manager.pool_stats())
+
+
+@application.route('/scheduler')
+def scheduler():
+    return json.dumps(manager.owner_stats())
+
+
+@application.route('/queue_latency')
+def queue_latency():
+    return json.dumps(manager.latency_stats())
+
+
+@application.route('/artifact_cache')
+def artifact_cache():
+    return json.dumps(get_artifact_cache().stats())
+
+
+@application.route('/image_cache')
+def image_cache():
+    return json.dumps(get_image_cache().stats())
+
+
+@application.route('/git_cache')
+def git_cache():
+    return json.dumps(get_git_cache().stats())
+
+
+@application.route('/gc')
+def gc():
+    return json.dumps(get_garbage_collector().stats())
+
+
+@application.route('/nodes')
+def nodes():
+    return json.dumps(list_nodes())
+
+
+@application.route('/db_pool')
+def db_pool():
+    return json.dumps(pool_stats())
+
+
+@application.route('/token_cache')
+def token_cache():
+    return json.dumps(get_token_cache().stats())
 
 
 @application.route('/')
 def index():
-    global manager
     return str(manager.max_threads)
 
 
 @application.route('/upload_def_file', methods=["POST"])
-def upload_file():
-    if 'Authorization' not in request.headers:
-        abort(401, 'You must be logged in to perform this function.')
-
-    token = request.headers.get('Authorization')
-    token = str.replace(str(token), 'Bearer ', '')
-    conf_app = ConfidentialAppAuthClient(os.environ["GL_CLIENT"], os.environ["GL_CLIENT_SECRET"])
-    intro_obj = conf_app.oauth2_token_introspect(token)
-
-    if "client_id" in intro_obj:
-        client_id = str(intro_obj["client_id"])
-
-        if 'file' not in request.files:
-            abort(400, "No file")
-        file = request.files['file']
-        if file.filename == '':
-            abort(400, "No file selected")
-        if file:
-            filename = file.filename
-            definition_id = str(uuid.uuid4())
-            create_table_entry("definition",
-                               definition_id=definition_id,
-                               definition_type="docker" if filename == "Dockerfile" else "singularity",
-                               definition_name=filename,
-                               location="s3",
-                               definition_owner=client_id)
-            s3 = boto3.client('s3')
-
-            s3.upload_fileobj(file, "xtract-container-service",
-                              f'{definition_id}/{filename}')
-            return definition_id
-        else:
-            return abort(400, "Failed to upload file")
+@authenticate
+def upload_file(client_id):
+    if 'file' not in request.files:
+        abort(400, "No file")
+    file = request.files['file']
+    if file.filename == '':
+        abort(400, "No file selected")
+    if file:
+        filename = file.filename
+        definition_id = str(uuid.uuid4())
+        try:
+            definition_hash, _ = stream_upload(file.stream, filename, f'{definition_id}/{filename}')
+        except UploadTooLarge as e:
+            abort(413, str(e))
+        create_table_entry("definition",
+                           definition_id=definition_id,
+                           definition_type="docker" if filename == "Dockerfile" else "singularity",
+                           definition_name=filename,
+                           location="s3",
+                           definition_owner=client_id,
+                           definition_hash=definition_hash)
+        return definition_id
     else:
-        abort(400, "Failed to authenticate user")
+        return abort(400, "Failed to upload file")
+
+
+def new_build_entry(client_id, definition_entry, to_format, container_name, cached_build=None):
+    """Returns a pending entry for a build of a definition for a format, or
+    a successful one served from the image of an identical definition.
+
+    Parameters:
+    client_id (str): ID of the user building the definition.
+    definition_entry (dict): Definition entry to build.
+    to_format (str): "docker" or "singularity".
+    container_name (str): Name to give the container.
+    cached_build (dict): Successful build of an identical definition or
+    None.
+
+    Returns:
+    (dict): Build entry to write with save_builds.
+    """
+    build_entry = dict(build_schema)
+    build_entry["build_id"] = str(uuid.uuid4())
+    build_entry["container_name"] = container_name
+    build_entry["definition_id"] = definition_entry["definition_id"]
+    build_entry["container_type"] = to_format
+    build_entry["container_owner"] = client_id
+    build_entry["build_status"] = "pending"
+
+    # Identical definitions already built to this format are served from the existing image
+    if cached_build is not None:
+        build_entry["build_location"] = container_location(cached_build)
+        build_entry["container_size"] = cached_build["container_size"]
+        build_entry["build_time"] = cached_build["build_time"]
+        build_entry["definition_hash"] = cached_build["definition_hash"]
+        build_entry["build_status"] = "success"
+
+    return build_entry
+
+
+def save_builds(build_entries):
+    """Creates build entries, or resets the existing build of a definition for
+    a format, atomically with one statement. A reset build takes the new
+    container name and loses the location, size and hash of its previous
+    container, and its previous build time is kept in last_built.
+
+    Parameters:
+    build_entries (list (dict)): Entries from new_build_entry, at most one
+    per definition and format.
+
+    Builds waiting on their parents in a build graph aren't reset, since the
+    graph would never queue them.
+
+    Returns:
+    (dict (dict)): Build entries as written, keyed by (definition ID,
+    format). Existing builds keep their ID.
+    """
+    try:
+        build_entries = upsert_table_entries("build", build_entries, conflict_columns=BUILD_KEY,
+                                             update_columns=BUILD_RESET_COLUMNS + ["container_name"],
+                                             previous_columns=BUILD_PREVIOUS_COLUMNS,
+                                             refuse_if={"build_status": ["waiting"]})
+    except ValueError:
+        abort(400, "A build graph is waiting to build the definition")
+    return {(build_entry["definition_id"], build_entry["container_type"]): build_entry
+            for build_entry in build_entries}
+
+
+def prepare_build(client_id, definition_entry, to_format, container_name):
+    """Creates or resets the build entry of a definition for a format.
+    Identical definitions already built to the format are served from the
+    existing image, in which case the entry is marked successful right away.
+
+    Parameters:
+    client_id (str): ID of the user building the definition.
+    definition_entry (dict): Definition entry to build.
+    to_format (str): "docker" or "singularity".
+    container_name (str): Name to give the container.
+
+    Returns:
+    build_entry (dict): Build entry of the build.
+    cached (bool): Whether the build is served from an existing image.
+    """
+    cached_build = find_cached_build(definition_entry["definition_hash"], to_format)
+    build_entry = new_build_entry(client_id, definition_entry, to_format, container_name, cached_build=cached_build)
+    build_entry = save_builds([build_entry])[(definition_entry["definition_id"], to_format)]
+
+    return build_entry, cached_build is not None
 
 
 @application.route('/build', methods=["POST", "GET"])
-def build():
-    if 'Authorization' not in request.headers:
-        abort(401, "You must be logged in to perform this function.")
-
-    token = request.headers.get('Authorization')
-    token = str.replace(str(token), 'Bearer ', '')
-    conf_app = ConfidentialAppAuthClient(os.environ["GL_CLIENT"], os.environ["GL_CLIENT_SECRET"])
-    intro_obj = conf_app.oauth2_token_introspect(token)
-
-    if "client_id" in intro_obj:
-        client_id = str(intro_obj["client_id"])
-        if request.method == "POST":
-            params = request.json
-            required_params = {"definition_id", "to_format", "container_name"}
-            if set(params.keys()) >= required_params and params["to_format"] in ["docker", "singularity"]:
-                definition_entry = select_by_column("definition", definition_id=params["definition_id"])
-                if definition_entry is not None and len(definition_entry) == 1:
-                    definition_entry = definition_entry[0]
-                    if definition_entry["definition_owner"] != client_id:
-                        abort(400, "You don't have permission to use this definition file")
-                    else:
-                        build_entry = select_by_column("build", definition_id=params["definition_id"],
-                                                       container_type=params["to_format"])
-                        if build_entry is not None and len(build_entry) == 1:
-                            build_entry = build_entry[0]
-                            build_id = build_entry["build_id"]
-                            build_entry["build_status"] = "pending"
-                            update_table_entry("build", build_id, **build_entry)
-                        else:
-                            build_id = str(uuid.uuid4())
-                            build_entry = build_schema
-                            build_entry["build_id"] = build_id if build_id is not None else str(uuid.uuid4())
-                            build_entry["container_name"] = params["container_name"]
-                            build_entry["definition_id"] = params["definition_id"]
-                            build_entry["container_type"] = params["to_format"]
-                            build_entry["container_owner"] = client_id
-                            build_entry["build_status"] = "pending"
-                            create_table_entry("build", **build_entry)
-
+@authenticate
+def build(client_id):
+    if request.method == "POST":
+        params = request.json
+        required_params = {"definition_id", "to_format", "container_name"}
+        if set(params.keys()) >= required_params and params["to_format"] in ["docker", "singularity", "both"]:
+            definition_entry = select_by_column("definition", definition_id=params["definition_id"])
+            if definition_entry is not None and len(definition_entry) == 1:
+                definition_entry = definition_entry[0]
+                if definition_entry["definition_owner"] != client_id:
+                    abort(400, "You don't have permission to use this definition file")
+                elif params["to_format"] == "both":
+                    if definition_entry["definition_type"] != "docker":
+                        abort(400, "Can't build Docker container from Singularity file")
+                    singularity_name = params.get("singularity_name", params["container_name"] + ".sif")
+                    if not singularity_name.endswith(".sif"):
+                        abort(400, "Invalid Singularity container name")
+                    docker_entry, docker_cached = prepare_build(client_id, definition_entry, "docker",
+                                                                params["container_name"])
+                    singularity_entry, singularity_cached = prepare_build(client_id, definition_entry,
+                                                                          "singularity", singularity_name)
+                    priority = int(params.get("priority", 0))
+
+                    # Whatever isn't already built is queued, a lone Singularity build converts the Docker image
+                    if not docker_cached and not singularity_cached:
+                        put_message({"function_name": "build_container",
+                                     "build_entry": docker_entry,
+                                     "to_format": "both",
+                                     "container_name": params["container_name"],
+                                     "singularity_entry": singularity_entry,
+                                     "singularity_name": singularity_name,
+                                     "priority": priority})
+                    elif not docker_cached:
+                        put_message({"function_name": "build_container",
+                                     "build_entry": docker_entry,
+                                     "to_format": "docker",
+                                     "container_name": params["container_name"],
+                                     "priority": priority})
+                    elif not singularity_cached:
                         put_message({"function_name": "build_container",
-                                     "build_entry": build_entry,
-                                     "to_format": params["to_format"],
-                                     "container_name": params["container_name"]})
+                                     "build_entry": singularity_entry,
+                                     "to_format": "singularity",
+                                     "container_name": singularity_name,
+                                     "priority": priority})
+                    if not docker_cached or not singularity_cached:
                         manager.start_thread()
-                        return build_id
+                    return {"docker": docker_entry["build_id"], "singularity": singularity_entry["build_id"]}
                 else:
-                    abort(400, f"""No definition DB entry for {params["definition_id"]}""")
+                    build_entry, cached = prepare_build(client_id, definition_entry, params["to_format"],
+                                                        params["container_name"])
+                    if cached:
+                        return build_entry["build_id"]
+
+                    put_message({"function_name": "build_container",
+                                 "build_entry": build_entry,
+                                 "to_format": params["to_format"],
+                                 "container_name": params["container_name"],
+                                 "priority": int(params.get("priority", 0))})
+                    manager.start_thread()
+                    return build_entry["build_id"]
             else:
-                abort(400, f"Missing {set(params.keys())} parameters")
-        elif request.method == "GET":
-            build_entry = select_by_column("build", container_owner=client_id,
-                                           build_id=request.json["build_id"])
-            if build_entry is not None and len(build_entry) == 1:
-                return build_entry[0]
-            else:
-                abort(400, "Build ID not valid")
+                abort(400, f"""No definition DB entry for {params["definition_id"]}""")
+        else:
+            abort(400, f"Missing {set(params.keys())} parameters")
+    elif request.method == "GET":
+        params = request.json
+        # With "wait", long polls until the status differs from "status" instead of returning right away
+        wait = min(float(params.get("wait", 0)), 60)
+        if wait > 0:
+            build_entry = wait_for_change(params["build_id"], client_id, params.get("status"), timeout=wait)
+        else:
+            build_entry = get_build(params["build_id"], client_id)
+        if build_entry is not None:
+            return json.dumps(build_entry, default=json_default)
+        else:
+            abort(400, "Build ID not valid")
+
+
+@application.route('/builds', methods=["POST", "GET"])
+@authenticate
+def builds(client_id):
+    if request.method == "POST":
+        items = request.json.get("builds") if isinstance(request.json, dict) else request.json
+        if not isinstance(items, list) or not items:
+            abort(400, "No builds")
+        if len(items) > MAX_BATCH_SIZE:
+            abort(400, f"At most {MAX_BATCH_SIZE} builds can be submitted at once")
+        required_params = {"definition_id", "to_format", "container_name"}
+        for idx, params in enumerate(items):
+            if not isinstance(params, dict) or not set(params.keys()) >= required_params:
+                abort(400, f"Build {idx} is missing parameters")
+            if params["to_format"] not in ["docker", "singularity"]:
+                abort(400, f"Build {idx} has an invalid to_format")
+
+        # Validated all at once so either every build is submitted or none is
+        definition_ids = {params["definition_id"] for params in items}
+        definition_entries = {definition_entry["definition_id"]: definition_entry
+                              for definition_entry in select_by_any("definition", "definition_id", definition_ids)}
+        for idx, params in enumerate(items):
+            definition_entry = definition_entries.get(params["definition_id"])
+            if definition_entry is None:
+                abort(400, f"""No definition DB entry for {params["definition_id"]}""")
+            if definition_entry["definition_owner"] != client_id:
+                abort(400, f"You don't have permission to use definition file {params['definition_id']}")
+
+        cached_builds = find_cached_builds(definition_entry["definition_hash"]
+                                           for definition_entry in definition_entries.values())
+
+        # A definition is built once per format, so repeated items share a build
+        build_params = {}
+        for params in items:
+            build_params.setdefault((params["definition_id"], params["to_format"]), params)
+        new_entries = []
+        for (definition_id, to_format), params in build_params.items():
+            definition_entry = definition_entries[definition_id]
+            cached_build = cached_builds.get((definition_entry["definition_hash"], to_format))
+            new_entries.append(new_build_entry(client_id, definition_entry, to_format, params["container_name"],
+                                               cached_build=cached_build))
+        build_entries = save_builds(new_entries)
+
+        messages = [{"function_name": "build_container",
+                     "build_entry": build_entries[key],
+                     "to_format": key[1],
+                     "container_name": params["container_name"],
+                     "priority": int(params.get("priority", 0))}
+                    for key, params in build_params.items() if build_entries[key]["build_status"] != "success"]
+        failed = put_messages(messages)
+        for message in failed:
+            update_table_entry("build", message["build_entry"]["build_id"], build_status="error")
+        if len(failed) < len(messages):
+            manager.start_thread()
+
+        return {"build_ids": [build_entries[(params["definition_id"], params["to_format"])]["build_id"]
+                              for params in items]}
+    elif request.method == "GET":
+        build_ids = [build_id for build_id in request.args.get("ids", "").split(",") if build_id]
+        if not build_ids:
+            abort(400, "No build IDs")
+        if len(build_ids) > MAX_BATCH_SIZE:
+            abort(400, f"At most {MAX_BATCH_SIZE} builds can be queried at once")
+        build_entries = {build_entry["build_id"]: build_entry
+                         for build_entry in select_by_any("build", "build_id", set(build_ids))
+                         if build_entry["container_owner"] == client_id}
+        # Builds that don't exist or belong to someone else are null
+        return json.dumps({build_id: build_entries.get(build_id) for build_id in build_ids}, default=json_default)
+
+
+@application.route('/build/<build_id>/log')
+@authenticate
+def build_log(client_id, build_id):
+    if get_build(build_id, client_id) is None:
+        abort(400, "Build ID not valid")
+    try:
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        abort(400, "offset must be an integer")
+
+    if request.args.get("follow", "false").lower() in ["true", "1"]:
+        def finished():
+            build_entry = get_build(build_id, client_id)
+            return build_entry is None or build_entry["build_status"] in FINAL_STATUSES
+
+        return Response(stream_with_context(follow_log(build_id, offset, finished)), mimetype="text/plain",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
     else:
-        abort(400, "Failed to authenticate user")
+        data, next_offset, _ = read_log(build_id, offset)
+        return Response(data, mimetype="text/plain", headers={"X-Log-Offset": str(next_offset)})
 
 
-@application.route('/pull', methods=["GET"])
-def pull():
-    if 'Authorization' not in request.headers:
-        abort(401, 'You must be logged in to perform this function.')
+@application.route('/build/<build_id>/events')
+@authenticate
+def build_events(client_id, build_id):
+    if get_build(build_id, client_id) is None:
+        abort(400, "Build ID not valid")
+    return Response(stream_with_context(status_events(build_id, client_id)), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-    token = request.headers.get('Authorization')
-    token = str.replace(str(token), 'Bearer ', '')
-    conf_app = ConfidentialAppAuthClient(os.environ["GL_CLIENT"], os.environ["GL_CLIENT_SECRET"])
-    intro_obj = conf_app.oauth2_token_introspect(token)
-
-    if "client_id" in intro_obj:
-        client_id = intro_obj["client_id"]
-        params = request.json
-        if "build_id" in params:
-            build_id = params["build_id"]
-            build_entry = select_by_column("build", build_id=build_id)
-            if build_entry is not None and len(build_entry) == 1:
-                build_entry = build_entry[0]
-
-                if build_entry["container_owner"] != client_id:
-                    abort(400, "You do not have access to this definition file")
-            else:
-                abort(400, "Invalid build ID")
 
+@application.route('/build_graph', methods=["POST", "GET"])
+@authenticate
+def build_graph(client_id):
+    params = request.json
+    if request.method == "POST":
+        if "definition_id" in params and params.get("to_format") in ["docker", "singularity"]:
             try:
-                file_name = pull_container(build_entry)
-                response = send_file(os.path.basename(file_name))
-                if os.path.exists(file_name):
-                    os.remove(file_name)
-                return response
-            except Exception as e:
-                file_name = build_id + (".tar" if build_entry["container_type"] == "docker" else ".sif")
-                if os.path.exists(file_name):
-                    os.remove(file_name)
-                print(f"Exception {e}")
-                abort(400, f"Failed to pull {build_id}")
+                build_graph_id = submit_graph(params["definition_id"], params["to_format"], client_id,
+                                              container_names=params.get("container_names"),
+                                              priority=int(params.get("priority", 0)))
+            except (ValueError, PermissionError) as e:
+                abort(400, str(e))
+            manager.start_thread()
+            return build_graph_id
         else:
-            abort(400, "No build ID")
-    else:
-        abort(400, "Failed to authenticate user")
-
-
-@application.route('/repo2docker', methods=["POST"])
-def repo2docker():
-    if 'Authorization' not in request.headers:
-        abort(401, 'You must be logged in to perform this function.')
+            abort(400, f"Missing {set(params.keys())} parameters")
+    elif request.method == "GET":
+        try:
+            return graph_status(params["build_graph_id"], client_id)
+        except (ValueError, PermissionError):
+            abort(400, "Build graph ID not valid")
 
-    token = request.headers.get('Authorization')
-    token = str.replace(str(token), 'Bearer ', '')
-    conf_app = ConfidentialAppAuthClient(os.environ["GL_CLIENT"], os.environ["GL_CLIENT_SECRET"])
-    intro_obj = conf_app.oauth2_token_introspect(token)
 
-    if "client_id" in intro_obj:
-        client_id = str(intro_obj["client_id"])
+@application.route('/pull', methods=["GET"])
+@authenticate
+def pull(client_id):
+    params = request.json
+    if "build_id" in params:
+        build_id = params["build_id"]
+        build_entry = select_by_column("build", build_id=build_id)
+        if build_entry is not None and len(build_entry) == 1:
+            build_entry = build_entry[0]
+
+            if build_entry["container_owner"] != client_id:
+                abort(400, "You do not have access to this definition file")
+        else:
+            abort(400, "Invalid build ID")
+
+        container_type = build_entry["container_type"]
+        byte_range = None
+        try:
+            if container_type == "singularity" and request.range is not None and len(request.range.ranges) == 1:
+                size = get_artifact_cache().size(build_entry)
+                # Resolves suffix and open-ended ranges to (start, end) within the container
+                byte_range = request.range.range_for_length(size)
+                if byte_range is None:
+                    response = Response(status=416, mimetype="application/octet-stream")
+                    response.headers["Content-Range"] = f"bytes */{size}"
+                    return response
+            chunks, info = get_artifact_cache().stream(build_entry, byte_range=byte_range)
+        except Exception as e:
+            print(f"Exception {e}")
+            abort(400, f"Failed to pull {build_id}")
+
+        extension = ".tar" if container_type == "docker" else ".sif"
+        response = Response(stream_with_context(EXPORT_SECONDS.time_iter(chunks, format=container_type)),
+                            mimetype="application/octet-stream")
+        # Frees the cache's fill slot even if the client disconnects before the first chunk
+        response.call_on_close(chunks.close)
+        response.headers["Content-Disposition"] = f"attachment; filename={build_id}{extension}"
+        if info["content_length"] is not None:
+            response.headers["Content-Length"] = str(info["content_length"])
+        if container_type == "singularity":
+            response.headers["Accept-Ranges"] = "bytes"
+        if "content_range" in info:
+            response.status_code = 206
+            response.headers["Content-Range"] = info["content_range"]
+        return response
+    else:
+        abort(400, "No build ID")
+
+
+def queue_repo2docker_upload(client_id, build_id, stream, container_name, priority):
+    """Streams an uploaded .zip or .tar file to S3 and queues its repo2docker
+    build. The file is hashed while it is uploaded and the build runs on
+    whichever node picks up the task.
+
+    Parameters:
+    client_id (str): ID of the user building the file.
+    build_id (str): ID to give to the build.
+    stream: Binary stream of the file.
+    container_name (str): Name to give to the container.
+    priority (int): Priority of the build.
+
+    Returns:
+    (str): build_id.
+    """
+    key = f"uploads/{build_id}/{container_name}"
+    try:
+        definition_hash, _ = stream_upload(stream, "repo2docker", key)
+    except UploadTooLarge as e:
+        abort(413, str(e))
+
+    put_message({"function_name": "repo2docker_container",
+                 "client_id": client_id, "build_id": build_id,
+                 "target": f"s3://xtract-container-service/{key}",
+                 "container_name": container_name, "definition_hash": definition_hash,
+                 "priority": priority})
+    manager.start_thread()
+    return build_id
 
-        build_id = str(uuid.uuid4())
 
-        if request.json is not None and "git_repo" in request.json and "container_name" in request.json:
-            put_message({"function_name": "repo2docker_container",
-                         "client_id": client_id, "build_id": build_id, "target": request.json["git_repo"],
-                         "container_name": request.json["container_name"]})
-            manager.start_thread()
-            return build_id
-        elif 'file' in request.files:
-            file = request.files['file']
-            if file.filename == '':
-                abort(400, "No file selected")
-            if file:
-                file_path = tempfile.mkstemp()[1]
-                with open(file_path, "wb") as f:
-                    f.write(file.read())
-
-                put_message({"function_name": "repo2docker_container",
-                             "client_id": client_id, "build_id": build_id, "target": file_path,
-                             "container_name": file.filename})
-                manager.start_thread()
-                return build_id
-            else:
-                return abort(400, "Failed to upload file")
+@application.route('/repo2docker', methods=["POST"])
+@authenticate
+def repo2docker(client_id):
+    build_id = str(uuid.uuid4())
+
+    if request.json is not None and "git_repo" in request.json and "container_name" in request.json:
+        if not is_git_url(request.json["git_repo"]):
+            abort(400, "Not a git repository URL")
+        put_message({"function_name": "repo2docker_container",
+                     "client_id": client_id, "build_id": build_id, "target": request.json["git_repo"],
+                     "container_name": request.json["container_name"], "ref": request.json.get("ref"),
+                     "priority": int(request.json.get("priority", 0))})
+        manager.start_thread()
+        return build_id
+    elif request.mimetype == "application/octet-stream" and "container_name" in request.args:
+        # Raw bodies are read straight from the socket instead of being spooled by the form parser
+        return queue_repo2docker_upload(client_id, build_id, request.stream, request.args["container_name"],
+                                        int(request.args.get("priority", 0)))
+    elif 'file' in request.files:
+        file = request.files['file']
+        if file.filename == '':
+            abort(400, "No file selected")
+        if file:
+            return queue_repo2docker_upload(client_id, build_id, file.stream, file.filename,
+                                            int(request.form.get("priority", 0)))
         else:
-            abort(400, "No git repo or file")
+            return abort(400, "Failed to upload file")
     else:
-        abort(400, "Failed to authenticate user")
+        abort(400, "No git repo or file")
 
 
 @application.route('/convert', methods=["POST"])
-def convert():
-    if 'Authorization' not in request.headers:
-        abort(401, 'You must be logged in to perform this function.')
-
-    token = request.headers.get('Authorization')
-    token = str.replace(str(token), 'Bearer ', '')
-    conf_app = ConfidentialAppAuthClient(os.environ["GL_CLIENT"], os.environ["GL_CLIENT_SECRET"])
-    intro_obj = conf_app.oauth2_token_introspect(token)
-
-    if "client_id" in intro_obj:
-        client_id = str(intro_obj["client_id"])
-
-        definition_entry = select_by_column("definition", definition_id=request.json["definition_id"])
-        if definition_entry is not None and len(definition_entry) == 1:
-            definition_entry = definition_entry[0]
-            if definition_entry["definition_owner"] != client_id:
-                abort(400, "You don't have permission to use this definition file")
-            else:
-                return convert_definition_file(definition_entry)
+@authenticate
+def convert(client_id):
+    definition_entry = select_by_column("definition", definition_id=request.json["definition_id"])
+    if definition_entry is not None and len(definition_entry) == 1:
+        definition_entry = definition_entry[0]
+        if definition_entry["definition_owner"] != client_id:
+            abort(400, "You don't have permission to use this definition file")
         else:
-            abort(400, "Definition ID not valid")
+            return convert_definition_file(definition_entry)
     else:
-        abort(400, "Failed to authenticate user")
+        abort(400, "Definition ID not valid")
 
 
 if __name__ == "__main__":
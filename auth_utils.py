@@ -0,0 +1,175 @@
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import abort, request
+from globus_sdk import ConfidentialAppAuthClient
+from metrics_utils import AUTH_INTROSPECTION_SECONDS
+
+_auth_client = None
+_token_cache = None
+_lock = threading.Lock()
+
+
+class TokenCache:
+    """Thread-safe LRU cache of Globus Auth token introspection results.
+
+    Parameters:
+    introspect (function): Function that takes a token and returns its
+    introspection response.
+    max_size (int): Maximum number of tokens to keep cached.
+    ttl (int): Maximum number of seconds to cache an active token for. Active
+    tokens are never cached past their "exp" time.
+    negative_ttl (int): Number of seconds to cache an invalid token for.
+
+    Attributes:
+    max_size (int): Maximum number of tokens to keep cached.
+    ttl (int): Maximum number of seconds to cache an active token for.
+    negative_ttl (int): Number of seconds to cache an invalid token for.
+    hits (int): Number of lookups answered from the cache.
+    misses (int): Number of lookups that required an introspection call.
+    """
+    def __init__(self, introspect, max_size=1024, ttl=300, negative_ttl=30):
+        self.introspect = introspect
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._introspecting = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Returns the introspection result for a token, introspecting it
+        only if it isn't cached or its cache entry has expired. Concurrent
+        misses for the same token wait for one introspection instead of each
+        making their own.
+
+        Parameters:
+        token (str): Globus Auth access token.
+
+        Returns:
+        intro_obj (dict): Introspection result. Invalid tokens have no
+        "client_id" key.
+        """
+        key = hashlib.sha256(token.encode()).hexdigest()
+
+        with self._lock:
+            intro_obj = self._lookup(key)
+            if intro_obj is not None:
+                return intro_obj
+            key_lock = self._introspecting.setdefault(key, threading.Lock())
+
+        with key_lock:
+            try:
+                with self._lock:
+                    intro_obj = self._lookup(key)
+                    if intro_obj is not None:
+                        return intro_obj
+                    self.misses += 1
+
+                now = time.time()
+                with AUTH_INTROSPECTION_SECONDS.time():
+                    response = self.introspect(token)
+                intro_obj = dict(getattr(response, "data", response))
+
+                if "client_id" in intro_obj and intro_obj.get("active", True):
+                    expires = now + self.ttl
+                    if intro_obj.get("exp"):
+                        expires = min(expires, float(intro_obj["exp"]))
+                else:
+                    intro_obj.pop("client_id", None)
+                    expires = now + self.negative_ttl
+
+                with self._lock:
+                    self._entries[key] = (expires, intro_obj)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+            finally:
+                with self._lock:
+                    if self._introspecting.get(key) is key_lock:
+                        del self._introspecting[key]
+
+        return intro_obj
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        return None
+
+    def clear(self):
+        """Removes every cached token."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns cache statistics.
+
+        Returns:
+        (dict): Number of cached tokens, hits and misses.
+        """
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def get_auth_client():
+    """Returns the process-wide Globus Auth client, creating it on first use.
+
+    Returns:
+    (ConfidentialAppAuthClient): Client authenticated with GL_CLIENT and
+    GL_CLIENT_SECRET.
+    """
+    global _auth_client
+    with _lock:
+        if _auth_client is None:
+            _auth_client = ConfidentialAppAuthClient(os.environ["GL_CLIENT"], os.environ["GL_CLIENT_SECRET"])
+    return _auth_client
+
+
+def get_token_cache():
+    """Returns the process-wide token cache, creating it on first use.
+
+    Returns:
+    (TokenCache): Cache backed by the shared Globus Auth client.
+    """
+    global _token_cache
+    with _lock:
+        if _token_cache is None:
+            _token_cache = TokenCache(lambda token: get_auth_client().oauth2_token_introspect(token),
+                                      max_size=int(os.environ.get("XCS_TOKEN_CACHE_SIZE", 1024)),
+                                      ttl=int(os.environ.get("XCS_TOKEN_CACHE_TTL", 300)))
+    return _token_cache
+
+
+def authenticate(function):
+    """Decorator for Flask views that require a Globus Auth token. The
+    client_id of the token owner is passed as the first argument to the view.
+
+    Parameters:
+    function (function): View function to wrap.
+
+    Returns:
+    (function): Wrapped view function.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if 'Authorization' not in request.headers:
+            abort(401, 'You must be logged in to perform this function.')
+
+        token = request.headers.get('Authorization')
+        token = str.replace(str(token), 'Bearer ', '')
+        intro_obj = get_token_cache().get(token)
+
+        if "client_id" in intro_obj:
+            return function(str(intro_obj["client_id"]), *args, **kwargs)
+        else:
+            abort(400, "Failed to authenticate user")
+
+    return wrapper
@@ -0,0 +1,261 @@
+import json
+import logging
+import uuid
+from pg_utils import (BUILD_KEY, BUILD_PREVIOUS_COLUMNS, BUILD_RESET_COLUMNS, build_schema, create_table_entry,
+                      search_array, select_by_any, select_by_column, transition_table_entry, upsert_table_entries)
+from sqs_queue_utils import put_message
+from status_utils import ACTIVE_STATUSES
+
+FAILED_STATUSES = {"failed", "error", "cancelled"}
+
+
+def resolve_graph(root_definition_id):
+    """Resolves the dependency graph of a definition from the pre_containers
+    and post_containers columns of the definition table.
+
+    A definition depends on the definitions in its pre_containers and on the
+    definitions that list it in their post_containers. The graph holds the
+    root, everything that depends on it directly or indirectly, and
+    everything those definitions depend on.
+
+    Parameters:
+    root_definition_id (str): ID of the definition to resolve the graph of.
+
+    Returns:
+    graph (dict): Definition entry and set of parent definition IDs of each
+    definition in the graph, keyed by definition ID.
+    """
+    entries = {}
+    parents = {}
+    children = {}
+
+    def load(definition_id):
+        if definition_id not in entries:
+            definition_entry = select_by_column("definition", definition_id=definition_id)
+            if len(definition_entry) != 1:
+                raise ValueError(f"No definition DB entry for {definition_id}")
+            entries[definition_id] = definition_entry[0]
+            parents[definition_id] = set(definition_entry[0]["pre_containers"] or [])
+            parents[definition_id] |= {entry["definition_id"]
+                                       for entry in search_array("definition", "post_containers", definition_id)}
+            children[definition_id] = set(definition_entry[0]["post_containers"] or [])
+            children[definition_id] |= {entry["definition_id"]
+                                        for entry in search_array("definition", "pre_containers", definition_id)}
+        return entries[definition_id]
+
+    load(root_definition_id)
+    stack = [root_definition_id]
+    descendants = {root_definition_id}
+    while stack:
+        for child in children[stack.pop()]:
+            if child not in descendants:
+                load(child)
+                descendants.add(child)
+                stack.append(child)
+
+    stack = list(descendants)
+    while stack:
+        for parent in parents[stack.pop()]:
+            if parent not in entries:
+                load(parent)
+                stack.append(parent)
+
+    graph = {definition_id: {"definition_entry": entries[definition_id], "parents": parents[definition_id]}
+             for definition_id in entries}
+    check_acyclic(graph)
+
+    return graph
+
+
+def check_acyclic(graph):
+    """Checks that a graph has no cycles using Kahn's algorithm.
+
+    Parameters:
+    graph (dict): Graph as returned by resolve_graph.
+
+    Raises:
+    ValueError: If the graph contains a cycle.
+    """
+    remaining = {node: set(graph[node]["parents"]) for node in graph}
+    ready = [node for node in remaining if not remaining[node]]
+    while ready:
+        node = ready.pop()
+        del remaining[node]
+        for child in remaining:
+            if node in remaining[child]:
+                remaining[child].discard(node)
+                if not remaining[child]:
+                    ready.append(child)
+
+    if remaining:
+        raise ValueError(f"Dependency cycle between {sorted(remaining)}")
+
+
+def _queue_build(build_entry, build_graph_id, priority):
+    put_message({"function_name": "build_container",
+                 "build_entry": build_entry,
+                 "to_format": build_entry["container_type"],
+                 "container_name": build_entry["container_name"],
+                 "priority": priority,
+                 "build_graph_id": build_graph_id})
+
+
+def submit_graph(root_definition_id, to_format, owner, container_names=None, priority=0):
+    """Creates build entries for every definition in the dependency graph of
+    a definition and queues the builds of definitions without dependencies.
+    The other builds wait with status "waiting" until their parents succeed.
+
+    A definition has one build per format, so graphs are refused while any
+    of their definitions is already being built to it, by another graph or
+    on its own. The builds of the graph are written at once, or not at all.
+
+    Parameters:
+    root_definition_id (str): ID of the definition to build the graph of.
+    to_format (str): "docker" or "singularity".
+    owner (str): ID of the user building the graph. Every definition in the
+    graph must belong to them.
+    container_names (dict (str)): Container name to give each definition's
+    build, keyed by definition ID. Defaults to the definition ID (with .sif
+    appended for Singularity).
+    priority (int): Priority of the builds.
+
+    Returns:
+    build_graph_id (str): ID of the build graph.
+
+    Raises:
+    ValueError: If a definition in the graph is already being built.
+    """
+    graph = resolve_graph(root_definition_id)
+    container_names = container_names or {}
+
+    for definition_id in graph:
+        if graph[definition_id]["definition_entry"]["definition_owner"] != owner:
+            raise PermissionError(f"You don't have permission to use definition {definition_id}")
+
+    # Existing builds of a definition keep their name unless a new one is given
+    names = {build_entry["definition_id"]: build_entry["container_name"]
+             for build_entry in select_by_any("build", "definition_id", list(graph))
+             if build_entry["container_type"] == to_format}
+    names.update(container_names)
+
+    build_graph_id = str(uuid.uuid4())
+    build_entries = []
+    for definition_id in graph:
+        default_name = definition_id + (".sif" if to_format == "singularity" else "")
+        build_entry = dict(build_schema)
+        build_entry["build_id"] = str(uuid.uuid4())
+        build_entry["definition_id"] = definition_id
+        build_entry["container_type"] = to_format
+        build_entry["container_owner"] = owner
+        build_entry["container_name"] = names.get(definition_id) or default_name
+        build_entry["build_status"] = "waiting" if graph[definition_id]["parents"] else "pending"
+        build_entries.append(build_entry)
+
+    try:
+        build_entries = upsert_table_entries("build", build_entries, conflict_columns=BUILD_KEY,
+                                             update_columns=BUILD_RESET_COLUMNS + ["container_name"],
+                                             previous_columns=BUILD_PREVIOUS_COLUMNS,
+                                             refuse_if={"build_status": ACTIVE_STATUSES})
+    except ValueError:
+        raise ValueError("A definition in the graph is already being built")
+
+    nodes = {}
+    ready = []
+    for build_entry in build_entries:
+        definition_id = build_entry["definition_id"]
+        nodes[definition_id] = {"build_id": build_entry["build_id"],
+                                "parents": sorted(graph[definition_id]["parents"])}
+        if not graph[definition_id]["parents"]:
+            ready.append(build_entry)
+
+    create_table_entry("build_graph", build_graph_id=build_graph_id, root_definition_id=root_definition_id,
+                       graph_owner=owner, container_type=to_format, nodes=json.dumps(nodes))
+
+    for build_entry in ready:
+        _queue_build(build_entry, build_graph_id, priority)
+
+    return build_graph_id
+
+
+def _load_graph(build_graph_id):
+    graph_entry = select_by_column("build_graph", build_graph_id=build_graph_id)
+    if len(graph_entry) != 1:
+        raise ValueError(f"No build graph {build_graph_id}")
+    graph_entry = graph_entry[0]
+    nodes = json.loads(graph_entry["nodes"])
+    builds = {build_entry["build_id"]: build_entry
+              for build_entry in select_by_any("build", "build_id", [node["build_id"] for node in nodes.values()])}
+
+    return graph_entry, nodes, builds
+
+
+def advance_graph(build_graph_id, priority=0):
+    """Queues the builds of a graph whose parents have all succeeded and
+    cancels the builds whose parents failed. Called whenever a build in the
+    graph finishes. Builds move from "waiting" atomically so concurrent calls
+    never queue a build twice.
+
+    Parameters:
+    build_graph_id (str): ID of the build graph.
+    priority (int): Priority to queue builds with.
+
+    Returns:
+    (list (str)): IDs of the builds that were queued.
+    """
+    _, nodes, builds = _load_graph(build_graph_id)
+    status = {definition_id: builds[node["build_id"]]["build_status"] for definition_id, node in nodes.items()}
+
+    queued = []
+    changed = True
+    while changed:
+        changed = False
+        for definition_id, node in nodes.items():
+            if status[definition_id] != "waiting":
+                continue
+            parent_status = [status[parent] for parent in node["parents"]]
+            if any(parent in FAILED_STATUSES for parent in parent_status):
+                if transition_table_entry("build", node["build_id"], "build_status", "waiting", "cancelled"):
+                    logging.info(f"Cancelled {node['build_id']} of graph {build_graph_id}")
+                status[definition_id] = "cancelled"
+                changed = True
+            elif all(parent == "success" for parent in parent_status):
+                if transition_table_entry("build", node["build_id"], "build_status", "waiting", "pending"):
+                    build_entry = dict(builds[node["build_id"]], build_status="pending")
+                    _queue_build(build_entry, build_graph_id, priority)
+                    queued.append(node["build_id"])
+                status[definition_id] = "pending"
+
+    return queued
+
+
+def graph_status(build_graph_id, owner):
+    """Returns the aggregate status of a build graph and the status of each
+    of its builds.
+
+    Parameters:
+    build_graph_id (str): ID of the build graph.
+    owner (str): ID of the user requesting the status.
+
+    Returns:
+    (dict): "build_graph_id", "status" ("pending", "building", "success" or
+    "failed") and "builds", the build ID and status of each definition.
+    """
+    graph_entry, nodes, builds = _load_graph(build_graph_id)
+    if graph_entry["graph_owner"] != owner:
+        raise PermissionError("You do not have access to this build graph")
+
+    statuses = {definition_id: {"build_id": node["build_id"],
+                                "build_status": builds[node["build_id"]]["build_status"]}
+                for definition_id, node in nodes.items()}
+    all_statuses = [build["build_status"] for build in statuses.values()]
+
+    if all(build_status == "success" for build_status in all_statuses):
+        status = "success"
+    elif any(build_status in FAILED_STATUSES for build_status in all_statuses):
+        status = "failed"
+    elif all(build_status in {"pending", "waiting"} for build_status in all_statuses):
+        status = "pending"
+    else:
+        status = "building"
+
+    return {"build_graph_id": build_graph_id, "status": status, "builds": statuses}
@@ -0,0 +1,100 @@
+import base64
+import datetime
+import logging
+import threading
+import boto3
+import docker
+
+_docker_client = None
+_boto3_clients = {}
+_ecr_credentials = None
+_lock = threading.Lock()
+
+
+def get_docker_client():
+    """Returns the process-wide Docker client, creating it on first use.
+
+    Returns:
+    (DockerClient): Docker client configured from the environment.
+    """
+    global _docker_client
+    with _lock:
+        if _docker_client is None:
+            _docker_client = docker.from_env()
+    return _docker_client
+
+
+def get_boto3_client(service_name):
+    """Returns the process-wide boto3 client for an AWS service, creating it
+    on first use. Clients are thread-safe once created but creating them
+    isn't, so creation is serialized.
+
+    Parameters:
+    service_name (str): Name of the AWS service, e.g. "s3".
+
+    Returns:
+    (botocore.client.BaseClient): Client for service_name.
+    """
+    with _lock:
+        if service_name not in _boto3_clients:
+            _boto3_clients[service_name] = boto3.client(service_name)
+        return _boto3_clients[service_name]
+
+
+class EcrCredentials:
+    """Logs the shared Docker client into ECR and keeps it logged in,
+    requesting a new authorization token only when the current one is close
+    to expiring.
+
+    Parameters:
+    refresh_time (int): Number of seconds before the token expires to log in
+    again.
+
+    Attributes:
+    refresh_time (int): Number of seconds before the token expires to log in
+    again.
+    registry (str): Endpoint of the ECR registry or None before logging in.
+    expires_at (datetime): Time the current token expires.
+    """
+    def __init__(self, refresh_time=1800):
+        self.refresh_time = refresh_time
+        self.registry = None
+        self.expires_at = None
+        self._lock = threading.Lock()
+
+    def _valid(self):
+        if self.registry is None:
+            return False
+        remaining = self.expires_at - datetime.datetime.now(datetime.timezone.utc)
+        return remaining.total_seconds() > self.refresh_time
+
+    def login(self):
+        """Logs Docker into ECR unless it is already logged in with a token
+        that isn't about to expire.
+
+        Returns:
+        registry (str): Endpoint of the ECR registry logged into.
+        """
+        with self._lock:
+            if not self._valid():
+                authorization = get_boto3_client("ecr").get_authorization_token()['authorizationData'][0]
+                username, password = base64.b64decode(authorization['authorizationToken']).decode().split(":", 1)
+                registry = authorization['proxyEndpoint']
+                get_docker_client().login(username=username, password=password, registry=registry, reauth=True)
+                self.registry = registry
+                self.expires_at = authorization['expiresAt']
+                logging.info(f"Logged into {registry} until {self.expires_at}")
+            return self.registry
+
+
+def ecr_login():
+    """Logs the shared Docker client into ECR if it isn't already logged in.
+
+    Returns:
+    registry (str): Endpoint of the ECR registry logged into.
+    """
+    global _ecr_credentials
+    with _lock:
+        if _ecr_credentials is None:
+            _ecr_credentials = EcrCredentials()
+    return _ecr_credentials.login()
@@ -1,54 +1,281 @@
 import datetime
+import fcntl
+import hashlib
+import json
 import logging
 import os
+import re
 import shutil
 import subprocess
 import tarfile
+import threading
 import time
 import tempfile
 import uuid
 import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from boto3.s3.transfer import TransferConfig
 import boto3
-import docker
 import namegenerator
 from spython.main import Client
 from spython.main.parse.parsers import get_parser
 from spython.main.parse.writers import get_writer
-from pg_utils import definition_schema, build_schema, create_table_entry, update_table_entry, select_by_column
+from client_utils import ecr_login, get_boto3_client, get_docker_client
+from git_cache_utils import GitError, get_git_cache, is_git_url
+from image_cache_utils import get_image_cache
+from log_utils import close_log, open_log
+from metrics_utils import BUILD_SECONDS, CONTEXT_FETCH_SECONDS, PUSH_SECONDS, UPLOAD_SECONDS
+from pg_utils import (definition_schema, build_schema, create_table_entry, update_table_entry, select_by_any,
+                      select_by_column)
 
 PROJECT_ROOT = os.path.realpath(os.path.dirname(__file__)) + "/"
+WORKSPACE_ROOT = os.path.join(PROJECT_ROOT, "workspace")
+CONTEXT_CACHE_ROOT = os.path.join(PROJECT_ROOT, "context_cache")
+BUILD_LOCK_ROOT = os.path.join(PROJECT_ROOT, "build_locks")
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=64 * 1024 ** 2, max_concurrency=4)
 
+_context_cache_lock = threading.Lock()
 
-def pull_s3_dir(definition_id):
-    """Pulls a directory of files from a definition_id folder in our
-    S3 bucket.
+_artifact_cache = None
+_artifact_cache_lock = threading.Lock()
+
+
+def hash_definition(files):
+    """Computes a content hash over the files of a definition. The hash
+    covers file names and contents, so identical definitions hash the same
+    regardless of who uploaded them.
 
     Parameters:
-    definition_id (str): Name of id to pull files from.
+    files (list (tuple)): List of (file name, binary file object) pairs. File
+    objects are read from their current position and rewound afterwards.
+
+    Returns:
+    (str): Hex SHA-256 digest of the definition.
+    """
+    digest = hashlib.sha256()
+    for file_name, file_obj in sorted(files, key=lambda file: file[0]):
+        start = file_obj.tell()
+        digest.update(file_name.encode() + b"\0")
+        for chunk in iter(lambda: file_obj.read(1024 * 1024), b""):
+            digest.update(chunk)
+        digest.update(b"\0")
+        file_obj.seek(start)
+
+    return digest.hexdigest()
+
+
+def find_cached_build(definition_hash, container_type):
+    """Finds a successful build of a definition with the same content hash.
+
+    Parameters:
+    definition_hash (str): Content hash of the definition.
+    container_type (str): "docker" or "singularity".
+
+    Returns:
+    (dict): Build entry of a pushed build or None if there isn't one.
+    """
+    if definition_hash is None:
+        return None
+
+    for build_entry in select_by_column("build", definition_hash=definition_hash,
+                                        container_type=container_type, build_status="success"):
+        if build_entry["build_location"]:
+            return build_entry
+
+    return None
+
+
+def find_cached_builds(definition_hashes):
+    """Finds successful builds of several definitions by content hash with
+    one query.
+
+    Parameters:
+    definition_hashes (iterable (str)): Content hashes of the definitions.
+
+    Returns:
+    (dict (dict)): Build entry of a pushed build keyed by (definition hash,
+    container type) for the hashes that have one.
+    """
+    definition_hashes = {definition_hash for definition_hash in definition_hashes if definition_hash is not None}
+    if not definition_hashes:
+        return {}
+
+    cached_builds = {}
+    for build_entry in select_by_any("build", "definition_hash", definition_hashes):
+        if build_entry["build_status"] == "success" and build_entry["build_location"]:
+            cached_builds.setdefault((build_entry["definition_hash"], build_entry["container_type"]), build_entry)
+
+    return cached_builds
+
+
+def _build_lock_path(build_id):
+    return os.path.join(BUILD_LOCK_ROOT, build_id + ".lock")
+
+
+def _lock_build(build_id):
+    path = _build_lock_path(build_id)
+    while True:
+        lock_file = open(path, "a")
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        # The last holder may have removed the file while this was waiting for it
+        try:
+            if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+
+def _unlock_build(build_id, lock_file):
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        os.remove(_build_lock_path(build_id))
+
+
+@contextmanager
+def in_flight(*ids):
+    """Context manager marking the builds and definitions whose workspaces
+    are in use, so garbage collection in any worker process on the host
+    leaves them alone however long the build takes. Each ID holds a shared
+    lock on a file in BUILD_LOCK_ROOT while the build runs, and the last
+    holder removes the file. Workspaces are named after the build or
+    definition ID.
+
+    Parameters:
+    *ids (str): IDs of the builds and definitions.
     """
-    bucket = boto3.resource('s3').Bucket("xtract-container-service")
-    for object in bucket.objects.filter(Prefix=definition_id):
-        if not os.path.exists(PROJECT_ROOT + os.path.dirname(object.key)):
-            os.makedirs(os.path.join(PROJECT_ROOT, os.path.dirname(object.key)))
-        bucket.download_file(object.key, PROJECT_ROOT + object.key)
+    os.makedirs(BUILD_LOCK_ROOT, exist_ok=True)
+    lock_files = []
+    try:
+        for build_id in ids:
+            lock_files.append(_lock_build(build_id))
+        yield
+    finally:
+        for build_id, lock_file in zip(ids, lock_files):
+            _unlock_build(build_id, lock_file)
 
 
-def ecr_login():
-    """Logs Docker into ECR registry.
+def build_in_flight(build_id):
+    """Returns whether a build or definition is being built by any process
+    on this host.
+
+    Parameters:
+    build_id (str): ID of the build or definition.
 
     Returns:
-    registry (str): Name of the ECR registry logged into.
+    (bool): Whether a process holds the ID with in_flight.
     """
-    ecr_client = boto3.client('ecr')
-    token = ecr_client.get_authorization_token()
-    registry = token['authorizationData'][0]['proxyEndpoint']
-    subprocess.call(
-        f"aws ecr get-login-password --region us-east-2 | docker login --username AWS --password-stdin {registry}",
-        shell=True)
+    try:
+        with open(_build_lock_path(build_id)) as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            return False
+    except FileNotFoundError:
+        return False
+
+
+@CONTEXT_FETCH_SECONDS.timed()
+def pull_s3_dir(definition_id, max_workers=8, use_cache=True):
+    """Pulls a directory of files from a definition_id folder in our
+    S3 bucket into a new directory private to the caller.
+
+    Objects are downloaded concurrently. Unless use_cache is False, the
+    directory is also kept in a local context cache and later pulls of the
+    same definition are copied from it as long as the ETags of the objects
+    in S3 haven't changed.
+
+    Parameters:
+    definition_id (str): Name of id to pull files from.
+    max_workers (int): Maximum number of objects to download at once.
+    use_cache (bool): Whether to use the local context cache.
+
+    Returns:
+    context_dir (str): Path of the directory the files were pulled to. The
+    caller is responsible for removing it.
+    """
+    s3 = get_boto3_client("s3")
+    prefix = definition_id + "/"
+    etags = {}
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket="xtract-container-service", Prefix=prefix):
+        for s3_object in page.get("Contents", []):
+            if not s3_object["Key"].endswith("/"):
+                etags[s3_object["Key"][len(prefix):]] = s3_object["ETag"]
+
+    os.makedirs(WORKSPACE_ROOT, exist_ok=True)
+    context_dir = tempfile.mkdtemp(prefix=definition_id + "_", dir=WORKSPACE_ROOT)
+    cache_dir = os.path.join(CONTEXT_CACHE_ROOT, definition_id)
+    manifest_path = os.path.join(CONTEXT_CACHE_ROOT, definition_id + ".json")
+
+    if use_cache:
+        with _context_cache_lock:
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    cached_etags = json.load(f)
+                if cached_etags == etags:
+                    shutil.copytree(cache_dir, context_dir, dirs_exist_ok=True)
+                    # The manifest's mtime is when the context was last used, for garbage collection
+                    os.utime(manifest_path)
+                    logging.info(f"Copied context of {definition_id} from the context cache")
+                    return context_dir
+
+    def download(file_name):
+        file_path = os.path.join(context_dir, file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        s3.download_file("xtract-container-service", prefix + file_name, file_path, Config=TRANSFER_CONFIG)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(download, etags))
+    except Exception:
+        shutil.rmtree(context_dir)
+        raise
+
+    if use_cache:
+        os.makedirs(CONTEXT_CACHE_ROOT, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(dir=CONTEXT_CACHE_ROOT)
+        shutil.copytree(context_dir, staging_dir, dirs_exist_ok=True)
+        with _context_cache_lock:
+            if os.path.exists(cache_dir):
+                shutil.rmtree(cache_dir)
+            os.rename(staging_dir, cache_dir)
+            with open(manifest_path, "w") as f:
+                json.dump(etags, f)
 
-    return registry
+    return context_dir
 
 
+def evict_context(definition_id):
+    """Removes the context of a definition from the context cache.
+
+    Parameters:
+    definition_id (str): ID of the definition to remove.
+
+    Returns:
+    (int): Number of bytes removed.
+    """
+    cache_dir = os.path.join(CONTEXT_CACHE_ROOT, definition_id)
+    manifest_path = os.path.join(CONTEXT_CACHE_ROOT, definition_id + ".json")
+    size = 0
+    with _context_cache_lock:
+        if os.path.exists(manifest_path):
+            size += os.path.getsize(manifest_path)
+            os.remove(manifest_path)
+        if os.path.exists(cache_dir):
+            for root, _, file_names in os.walk(cache_dir):
+                size += sum(os.path.getsize(os.path.join(root, file_name)) for file_name in file_names)
+            shutil.rmtree(cache_dir)
+
+    return size
+
+
+@PUSH_SECONDS.timed()
 def push_to_ecr(docker_image, build_id, image_name):
     """Pushes a docker image to an ECR repository.
 
@@ -60,7 +287,7 @@ def push_to_ecr(docker_image, build_id, image_name):
     Returns:
     (str): ID of pushed Docker image or None if the push fails.
     """
-    ecr_client = boto3.client("ecr")
+    ecr_client = get_boto3_client("ecr")
 
     try:
         ecr_client.describe_repositories(repositoryNames=[build_id])
@@ -68,7 +295,7 @@ def push_to_ecr(docker_image, build_id, image_name):
         ecr_client.create_repository(repositoryName=build_id)
 
     registry = ecr_login()[8:] + "/" + build_id
-    docker_client = docker.from_env()
+    docker_client = get_docker_client()
     docker_image.tag(registry,
                      tag=image_name)
 
@@ -84,23 +311,47 @@ def push_to_ecr(docker_image, build_id, image_name):
         raise e
 
 
-def build_to_singularity(definition_entry, container_location):
+def singularity_build(build_log=None, **kwargs):
+    """Runs spython's Client.build, streaming Singularity's output into a
+    build log.
+
+    Parameters:
+    build_log (BuildLog): Log to write the output to or None to let it go to
+    stdout.
+    **kwargs: Arguments of Client.build.
+
+    Returns:
+    image (str): Path of the built image.
+    """
+    if build_log is None:
+        return Client.build(sudo=False, **kwargs)
+
+    image, lines = Client.build(sudo=False, stream=True, **kwargs)
+    for line in lines:
+        build_log.write(line)
+    return image
+
+
+@BUILD_SECONDS.timed(format="singularity")
+def build_to_singularity(definition_entry, container_location, build_log=None):
     """Builds a Singularity container from a Dockerfile or Singularity file
     within the definition db.
 
     Parameters:
     definition_entry (str): Entry of definition db entry to build singularity container from.
     container_location (str): Path to location to build the container.
+    build_log (BuildLog): Log to write the build output to.
 
     Returns:
     container_location: Returns the location of the Singularity container or None if it
     fails to save.
     """
-    definition_id = definition_entry["definition_id"]
-    pull_s3_dir(definition_id)
-    Client.load(PROJECT_ROOT + definition_id)
-    Client.build(image=os.path.join(PROJECT_ROOT, container_location), sudo=False)
-    shutil.rmtree(PROJECT_ROOT + definition_id)
+    context_dir = pull_s3_dir(definition_entry["definition_id"])
+    try:
+        Client.load(context_dir)
+        singularity_build(build_log, image=os.path.join(PROJECT_ROOT, container_location))
+    finally:
+        shutil.rmtree(context_dir)
     #TODO Find a better way to error check
     if os.path.exists(PROJECT_ROOT + container_location):
         logging.info(f"Successfully built {container_location}")
@@ -109,30 +360,109 @@ def build_to_singularity(definition_entry, container_location):
         return None
 
 
-def build_to_docker(definition_entry, image_name):
+@BUILD_SECONDS.timed(format="docker")
+def build_to_docker(definition_entry, image_name, cache_from=None, build_log=None):
     """Builds a Docker image from a definition db entry.
 
     Parameters:
     definition_entry (str): Entry of definition db entry to build docker container from.
     image_name (str): Name to tag the final image with.
+    cache_from (list (str)): Images to reuse layers from.
+    build_log (BuildLog): Log to stream the build output to as it is
+    produced.
 
     Returns:
-    image (Image obj.): Docker image object or None if the container fails to build.
+    image (tuple): Docker image object and the build log or None if the container
+    fails to build.
     """
-    definition_id = definition_entry["definition_id"]
-    pull_s3_dir(definition_id)
+    context_dir = pull_s3_dir(definition_entry["definition_id"])
 
     try:
-        docker_client = docker.from_env()
-        image = docker_client.images.build(path=f"{PROJECT_ROOT}/{definition_id}",
-                                           tag=image_name, rm=True, forcerm=True)
-        return image
+        docker_client = get_docker_client()
+        logs = []
+        # The low-level API streams the output instead of returning it once the build ends
+        for chunk in docker_client.api.build(path=context_dir, tag=image_name, rm=True, forcerm=True,
+                                             cache_from=cache_from or None, decode=True):
+            logs.append(chunk)
+            if build_log is not None:
+                if "stream" in chunk:
+                    build_log.write(chunk["stream"])
+                elif "status" in chunk:
+                    build_log.write(" ".join(filter(None, [chunk.get("id"), chunk["status"],
+                                                           chunk.get("progress")])) + "\n")
+                elif "error" in chunk:
+                    build_log.write(chunk["error"] + "\n")
+            if "error" in chunk:
+                raise ValueError(chunk["error"])
+        return docker_client.images.get(image_name), logs
     except Exception as e:
         print(f"build_to_docker ERROR {e}")
         return None
     finally:
-        if os.path.exists(PROJECT_ROOT + definition_id):
-            shutil.rmtree(PROJECT_ROOT + definition_id)
+        if os.path.exists(context_dir):
+            shutil.rmtree(context_dir)
+
+
+def count_cached_layers(logs):
+    """Counts the build steps of a Docker build and how many of them were
+    served from the layer cache.
+
+    Parameters:
+    logs (list (dict)): Build log returned by build_to_docker.
+
+    Returns:
+    cached_layers (int): Number of steps that reused a cached layer.
+    total_layers (int): Number of steps in the build.
+    """
+    cached_layers = 0
+    total_layers = 0
+    for line in logs:
+        stream = line.get("stream", "")
+        if re.match(r"Step \d+/\d+ :", stream):
+            total_layers += 1
+        elif "Using cache" in stream:
+            cached_layers += 1
+
+    return cached_layers, total_layers
+
+
+def touch_image(image):
+    """Marks a Docker image and the local images it was built on as recently
+    used in the image cache.
+
+    Parameters:
+    image (Image obj.): Docker image object.
+    """
+    try:
+        get_image_cache().touch(image.id, *[layer["Id"] for layer in image.history() if layer["Id"] != "<missing>"])
+    except Exception:
+        logging.debug(f"Failed to read the history of {image.id}", exc_info=True)
+
+
+def pull_cache_image(build_entry):
+    """Pulls the previous image of a Docker build from ECR to reuse its
+    layers. Failing to pull only costs the cache so errors are logged and
+    ignored.
+
+    Parameters:
+    build_entry (dict): Build entry of the Docker container being rebuilt.
+
+    Returns:
+    (str): "<registry>/<repository>:<tag>" of the pulled image or None if
+    the build has no previous image or it couldn't be pulled.
+    """
+    # Rebuilds are reset before they are queued, so a previous build only shows in last_built
+    if not (build_entry["build_location"] or build_entry["build_time"] or build_entry["last_built"]):
+        return None
+
+    try:
+        t0 = time.time()
+        image_name = pull_docker_image(build_entry)
+        logging.info(f"Pulled {image_name} as a cache source in {time.time() - t0} seconds")
+        return image_name
+    except Exception:
+        logging.warning(f"Failed to pull the previous image of {build_entry['build_id']}", exc_info=True)
+        return None
 
 
 #TODO: Find a better way to name converted Singularity definition files
@@ -144,14 +474,12 @@ def convert_definition_file(definition_entry, singularity_def_name=None):
     singularity_def_name (str): Name to give to converted .def file if converting
     from Dockerfile0 to Singularity definition file.
     """
+    new_path = None
     try:
         definition_id = definition_entry["definition_id"]
 
         new_definition_id = str(uuid.uuid4())
-        new_path = PROJECT_ROOT + str(new_definition_id)
-        os.mkdir(new_path)
-        subprocess.call(f"aws s3 cp --recursive s3://xtract-container-service/{definition_id} {new_path}",
-                        shell=True)
+        new_path = pull_s3_dir(definition_id)
 
         for file in os.listdir(new_path):
             if file == "Dockerfile" or file.endswith(".def"):
@@ -188,7 +516,7 @@ def convert_definition_file(definition_entry, singularity_def_name=None):
 
         os.remove(input_file)
 
-        db_entry = definition_schema
+        db_entry = dict(definition_schema)
         db_entry["definition_id"] = new_definition_id
         db_entry["definition_type"] = to_format.lower()
         # Might want to change definition name at some point
@@ -198,6 +526,8 @@ def convert_definition_file(definition_entry, singularity_def_name=None):
         db_entry["replaces_container"] = definition_entry["replaces_container"]
         db_entry["definition_owner"] = definition_entry["definition_owner"]
         db_entry["location"] = "s3"
+        with open(file_path, "rb") as f:
+            db_entry["definition_hash"] = hash_definition([(os.path.basename(file_path), f)])
         create_table_entry("definition", **db_entry)
 
         logging.info("Successfully converted %s %s definition file to %s %s definition file",
@@ -206,7 +536,7 @@ def convert_definition_file(definition_entry, singularity_def_name=None):
                      os.path.basename(file_path),
                      to_format)
 
-        s3 = boto3.client('s3')
+        s3 = get_boto3_client("s3")
         s3.upload_fileobj(open(file_path, "rb"), "xtract-container-service",
                           f'{new_definition_id}/{singularity_def_name if to_format == "Singularity" else "Dockerfile"}')
 
@@ -216,27 +546,140 @@ def convert_definition_file(definition_entry, singularity_def_name=None):
         logging.error("Exception", exc_info=True)
         return "Failed"
     finally:
-        pass
-        shutil.rmtree(new_path)
+        if new_path is not None:
+            shutil.rmtree(new_path)
+
+
+@BUILD_SECONDS.timed(format="singularity")
+def build_to_singularity_from_docker(image_name, container_location, build_log=None):
+    """Builds a Singularity container from a Docker image in the local Docker
+    daemon instead of rebuilding the Dockerfile, so the layers are only ever
+    built once.
+
+    Parameters:
+    image_name (str): Name or "name:tag" of the local Docker image.
+    container_location (str): Path to location to build the container.
+    build_log (BuildLog): Log to write the build output to.
+
+    Returns:
+    container_location: Returns the location of the Singularity container or None if it
+    fails to save.
+    """
+    if ":" not in image_name.split("/")[-1]:
+        image_name += ":latest"
+    singularity_build(build_log, recipe=f"docker-daemon://{image_name}",
+                      image=os.path.join(PROJECT_ROOT, container_location))
+    if os.path.exists(PROJECT_ROOT + container_location):
+        logging.info(f"Successfully built {container_location} from {image_name}")
+        return container_location
+    else:
+        return None
+
+
+def pull_docker_image(build_entry):
+    """Pulls the image of a Docker build from ECR into the local Docker daemon.
+
+    Parameters:
+    build_entry (dict): Build entry of a Docker container.
+
+    Returns:
+    (str): "<registry>/<repository>:<tag>" of the pulled image.
+    """
+    repository, tag = container_location(build_entry).split(":", 1)
+    registry = ecr_login()[8:] + "/" + repository
+    get_docker_client().images.pull(registry, tag=tag)
+    return f"{registry}:{tag}"
+
+
+def _finish_singularity(build_entry, definition_entry, container_name):
+    """Uploads a built Singularity container to S3 and marks its build as
+    successful.
+    """
+    build_id = build_entry["build_id"]
+    update_table_entry("build", build_id, **{"build_status": "pushing"})
+    s3 = get_boto3_client("s3")
+    with open(PROJECT_ROOT + container_name, 'rb') as f, UPLOAD_SECONDS.time(kind="singularity"):
+        s3.upload_fileobj(f, "xtract-container-service", f"{build_id}/{os.path.basename(container_name)}")
+    build_time = datetime.datetime.now(datetime.timezone.utc)
+    image_size = os.path.getsize(PROJECT_ROOT + container_name)
+    update_table_entry("build", build_id, **{"build_status": "success",
+                                             "build_time": build_time,
+                                             "container_size": image_size,
+                                             "build_location": f"{build_id}/{os.path.basename(container_name)}",
+                                             "definition_hash": definition_entry["definition_hash"]})
+    get_artifact_cache().invalidate(build_id)
+
+    os.remove(PROJECT_ROOT + container_name)
+
+
+def _singularity_from_docker_build(definition_entry, container_name, build_log=None):
+    """Builds a Singularity container from an existing successful Docker build
+    of the same definition. Returns None if there isn't one or it can't be
+    converted, in which case the Dockerfile is built from scratch.
+    """
+    docker_build = find_cached_build(definition_entry["definition_hash"], "docker")
+    if docker_build is None:
+        return None
+
+    try:
+        t0 = time.time()
+        image_name = pull_docker_image(docker_build)
+        image = get_docker_client().images.get(image_name)
+        with get_image_cache().in_use(image.id):
+            singularity_image = build_to_singularity_from_docker(image_name, container_name, build_log)
+        logging.info(f"Built {container_name} from {docker_build['build_id']} in {time.time() - t0} seconds")
+        return singularity_image
+    except Exception as e:
+        logging.warning(f"Failed to convert {docker_build['build_id']}, building from the Dockerfile",
+                        exc_info=True)
+        if build_log is not None:
+            build_log.write(f"Failed to convert {docker_build['build_id']} ({e}), building from the Dockerfile\n")
+        return None
 
 
-def build_container(build_entry, to_format, container_name):
+def build_container(build_entry, to_format, container_name, singularity_entry=None, singularity_name=None):
     """Automated pipeline for building a recipe file from the
-    definition db to a container.
+    definition db to a container. The output of the build is streamed to
+    its build log.
 
     Parameters:
     build_entry (dict): Build entry from PostgreSQl of container to build.
-    to_format (str): Format of container to build. Either "singularity"
-    or "docker". If "docker", the recipe type must be a Dockerfile0.
+    to_format (str): Format of container to build. Either "singularity",
+    "docker" or "both". If "docker" or "both", the recipe type must be a
+    Dockerfile. "both" builds the Docker image once and converts the local
+    image to Singularity.
     container_name (str): Name to give the container or path for path for
     Singularity container.
-    build_id (str): UUID to give to a new build entry. build_id should be None if
-    a build entry exists for definition_id.
+    singularity_entry (dict): Build entry of the Singularity container when
+    to_format is "both".
+    singularity_name (str): Path for the Singularity container when
+    to_format is "both".
 
     Returns:
     build_id (str): Build id of the built container or failed if the container
     failed to build.
     """
+    build_log = open_log(build_entry["build_id"])
+    singularity_log = open_log(singularity_entry["build_id"]) if singularity_entry is not None else None
+    try:
+        with in_flight(build_entry["build_id"], build_entry["definition_id"]):
+            return _build_container(build_entry, to_format, container_name, singularity_entry, singularity_name,
+                                    build_log, singularity_log)
+    except Exception as e:
+        build_log.write(f"Build failed: {e}\n")
+        if singularity_log is not None:
+            singularity_log.write(f"Build failed: {e}\n")
+        raise
+    finally:
+        close_log(build_log)
+        if singularity_log is not None:
+            close_log(singularity_log)
+
+
+def _build_container(build_entry, to_format, container_name, singularity_entry, singularity_name, build_log,
+                     singularity_log):
+    """Builds a container for build_container, writing its output to the build logs."""
+    failed_entry = build_entry
     try:
         definition_id = build_entry["definition_id"]
         build_id = build_entry["build_id"]
@@ -244,104 +687,472 @@ def build_container(build_entry, to_format, container_name):
 
         logging.info(f"Created build entry for {build_id}")
 
-        if definition_entry["definition_type"] == "singularity" and to_format == "docker":
+        if definition_entry["definition_type"] == "singularity" and to_format in ["docker", "both"]:
             update_table_entry("build", build_id, **{"build_status": "error"})
+            if singularity_entry is not None:
+                update_table_entry("build", singularity_entry["build_id"], **{"build_status": "error"})
             raise ValueError("Can't build Docker container from Singularity file")
 
         update_table_entry("build", build_id, **{"build_status": "building"})
-        if to_format == "docker":
+        if to_format in ["docker", "both"]:
+            if to_format == "both":
+                if singularity_entry is None or not singularity_name or not singularity_name.endswith(".sif"):
+                    raise ValueError("Invalid Singularity container name")
+                update_table_entry("build", singularity_entry["build_id"], **{"build_status": "building"})
+            cache_image = pull_cache_image(build_entry)
+            cache_image_id = get_docker_client().images.get(cache_image).id if cache_image else None
             t0 = time.time()
-            docker_image = build_to_docker(definition_entry, container_name)
+            with get_image_cache().in_use(cache_image_id):
+                docker_image = build_to_docker(definition_entry, container_name,
+                                               cache_from=[cache_image] if cache_image else None,
+                                               build_log=build_log)
             if docker_image:
-                docker_client = docker.from_env()
-                docker_image = docker_image[0]
-
-                # for image in docker_client.df()["Images"]:
-                #     if any(list(map(lambda x: container_name in x, image["RepoTags"]))):
-                #         container_size = image["Size"]
-                #         break
-                #     else:
-                #         container_size = None
-                update_table_entry("build", build_id, **{"build_status": "success"})
-                logging.info(f"Built {build_id} in {time.time() - t0} seconds")
-                t0 = time.time()
-                logging.info(f"Pushing {build_id}")
-                response = push_to_ecr(docker_image, build_id,
-                                       container_name)
-                logging.info(f"Finished pushing {build_id} in {time.time() - t0}")
-                if response is not None:
-                    last_built = build_entry["build_time"] if build_entry["build_time"] else None
-                    build_time = datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                    update_table_entry("build", build_id, **{"build_status": "success",
-                                                             "build_time": build_time,
-                                                             "last_built": last_built})
-                    docker_client.images.remove(response, force=True)
-                    return build_id
-                else:
-                    docker_client.images.remove(container_name.id, force=True)
-                    raise ValueError("Failed to push")
+                docker_client = get_docker_client()
+                docker_image, logs = docker_image
+                # Pinned until the build finishes so pruning can't remove it while it is pushed or converted
+                with get_image_cache().in_use(docker_image.id):
+                    cached_layers, total_layers = count_cached_layers(logs)
+                    logging.info(f"{build_id} reused {cached_layers} of {total_layers} layers")
+
+                    # for image in docker_client.df()["Images"]:
+                    #     if any(list(map(lambda x: container_name in x, image["RepoTags"]))):
+                    #         container_size = image["Size"]
+                    #         break
+                    #     else:
+                    #         container_size = None
+                    # Not final until the image is pushed, so waiters and child builds don't start early
+                    update_table_entry("build", build_id, **{"build_status": "pushing",
+                                                             "cached_layers": cached_layers,
+                                                             "total_layers": total_layers})
+                    logging.info(f"Built {build_id} in {time.time() - t0} seconds")
+                    t0 = time.time()
+                    logging.info(f"Pushing {build_id}")
+                    build_log.write(f"Reused {cached_layers} of {total_layers} layers, pushing {build_id}\n")
+                    response = push_to_ecr(docker_image, build_id,
+                                           container_name)
+                    logging.info(f"Finished pushing {build_id} in {time.time() - t0}")
+                    if response is not None:
+                        build_time = datetime.datetime.now(datetime.timezone.utc)
+                        update_table_entry("build", build_id,
+                                           **{"build_status": "success",
+                                              "build_time": build_time,
+                                              "build_location": f"{build_id}:{container_name}",
+                                              "definition_hash": definition_entry["definition_hash"]})
+                        get_artifact_cache().invalidate(build_id)
+                        try:
+                            if to_format == "both":
+                                # The Docker build is done, so only the Singularity build fails from here on
+                                failed_entry = singularity_entry
+                                t0 = time.time()
+                                singularity_image = build_to_singularity_from_docker(container_name, singularity_name,
+                                                                                     singularity_log)
+                                if not singularity_image:
+                                    raise ValueError("Failed to build singularity container")
+                                logging.info(f"Converted {build_id} to Singularity in {time.time() - t0} seconds")
+                                _finish_singularity(singularity_entry, definition_entry, singularity_name)
+                        finally:
+                            # Built images stay on the daemon as a layer cache until the image cache evicts them
+                            touch_image(docker_image)
+                        return build_id
+                    else:
+                        docker_client.images.remove(container_name.id, force=True)
+                        raise ValueError("Failed to push")
             else:
                 raise ValueError("Failed to build docker container")
 
         elif to_format == "singularity":
-            if container_name.endswith(".sif"):
-                singularity_image = build_to_singularity(definition_entry, container_name)
-            else:
+            if not container_name.endswith(".sif"):
                 raise ValueError("Invalid Singularity container name")
+            singularity_image = None
+            if definition_entry["definition_type"] == "docker":
+                singularity_image = _singularity_from_docker_build(definition_entry, container_name, build_log)
+            if not singularity_image:
+                singularity_image = build_to_singularity(definition_entry, container_name, build_log)
             if singularity_image:
-                update_table_entry("build", build_id, **{"build_status": "pushing"})
-                s3 = boto3.client("s3")
-                s3.upload_fileobj(open(PROJECT_ROOT + singularity_image, 'rb'),
-                                  "xtract-container-service",
-                                  f"{build_id}/{os.path.basename(container_name)}")
-                build_time = datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                last_built = build_entry["build_time"] if build_entry["build_time"] else None
-                image_size = os.path.getsize(PROJECT_ROOT + container_name)
-                update_table_entry("build", build_id, **{"build_status": "pushing",
-                                                         "build_time": build_time,
-                                                         "last_built": last_built,
-                                                         "container_size": image_size})
-
-                os.remove(PROJECT_ROOT + container_name)
+                _finish_singularity(build_entry, definition_entry, container_name)
                 return build_id
             else:
                 raise ValueError("Failed to build singularity container")
 
     except Exception as e:
         logging.error("Exception", exc_info=True)
-        update_table_entry("build", build_entry["build_id"], **{"build_status": "failed"})
+        update_table_entry("build", failed_entry["build_id"], **{"build_status": "failed"})
+        if failed_entry is build_entry and singularity_entry is not None:
+            update_table_entry("build", singularity_entry["build_id"], **{"build_status": "failed"})
 
         raise e
 
 
+def container_location(build_entry):
+    """Returns where the container of a build is stored. Builds served from
+    another build with the same definition hash point at that build's
+    container.
+
+    Parameters:
+    build_entry (dict): Build entry of the container.
+
+    Returns:
+    (str): "<ECR repository>:<tag>" for Docker containers or the S3 key for
+    Singularity containers.
+    """
+    if build_entry["build_location"]:
+        return build_entry["build_location"]
+    elif build_entry["container_type"] == "docker":
+        return f"{build_entry['build_id']}:{build_entry['container_name']}"
+    else:
+        return f"{build_entry['build_id']}/{build_entry['container_name']}"
+
+
+def stream_container(build_entry, byte_range=None, chunk_size=2 * 1024 * 1024):
+    """Streams a Docker container from ECR as a .tar or a Singularity container
+    from S3 without writing it to disk. The container is located before this
+    returns so errors are raised before any bytes are sent.
+
+    Parameters:
+    build_entry (dict): Build entry of the container to pull.
+    byte_range (tuple (int)): Satisfiable (start, end) byte offsets, end
+    exclusive, to stream part of a Singularity container. Docker containers
+    are always streamed whole.
+    chunk_size (int): Maximum size of each chunk in bytes.
+
+    Returns:
+    chunks (generator (bytes)): Generator of chunks of the container.
+    info (dict): "content_length" of the streamed bytes (None if unknown)
+    and "content_range" and "total_size" when a range of a Singularity
+    container was requested.
+    """
+    if build_entry["container_type"] == "docker":
+        image = get_docker_client().images.get(pull_docker_image(build_entry))
+
+        return image.save(chunk_size=chunk_size), {"content_length": None}
+    elif build_entry["container_type"] == "singularity":
+        s3 = get_boto3_client("s3")
+        params = {"Bucket": "xtract-container-service", "Key": container_location(build_entry)}
+        if byte_range is not None:
+            start, end = byte_range
+            params["Range"] = f"bytes={start}-{end - 1}"
+        response = s3.get_object(**params)
+        info = {"content_length": response["ContentLength"]}
+        if "ContentRange" in response:
+            info["content_range"] = response["ContentRange"]
+            info["total_size"] = int(response["ContentRange"].split("/")[-1])
+
+        def chunks():
+            try:
+                for chunk in response["Body"].iter_chunks(chunk_size):
+                    yield chunk
+            finally:
+                response["Body"].close()
+
+        return chunks(), info
+    else:
+        raise ValueError(f"Unknown container type {build_entry['container_type']}")
+
+
+class ClosingChunks:
+    """Iterator over the chunks of a container that calls on_close when it is
+    closed. Unlike a generator's finally block, on_close also runs when the
+    client disconnects before the first chunk and the chunks are never
+    iterated.
+
+    Parameters:
+    chunks (iterator (bytes)): Chunks of the container.
+    on_close (function): Function to call once when the chunks are closed.
+    """
+    def __init__(self, chunks, on_close=None):
+        self._chunks = chunks
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        """Closes the chunks and calls on_close if it wasn't called yet."""
+        try:
+            if hasattr(self._chunks, "close"):
+                self._chunks.close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close()
+
+
+class ArtifactCache:
+    """Size-bounded LRU cache of pulled containers on local disk, keyed by
+    build_id and build_time so a rebuilt container is never served stale.
+
+    Concurrent pulls of an uncached container share one fetch: the first pull
+    streams the container to its client while writing it to the cache, and
+    the others wait for the file to be complete and read it from disk, or
+    stream it from ECR or S3 themselves if it takes longer than fill_timeout.
+
+    Parameters:
+    cache_dir (str): Directory to store containers in.
+    max_bytes (int): Maximum total size of cached containers.
+    fill_timeout (int): Number of seconds to wait for another pull to cache
+    a container before streaming it without the cache.
+
+    Attributes:
+    cache_dir (str): Directory to store containers in.
+    max_bytes (int): Maximum total size of cached containers.
+    fill_timeout (int): Number of seconds to wait for another pull to cache
+    a container.
+    hits (int): Number of pulls served from the cache.
+    misses (int): Number of pulls that fetched from ECR or S3.
+    bytes_served (int): Number of bytes streamed to clients.
+    evictions (int): Number of containers evicted from the cache.
+    """
+    def __init__(self, cache_dir=os.path.join(PROJECT_ROOT, "artifact_cache"), max_bytes=20 * 1024 ** 3,
+                 fill_timeout=60):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fill_timeout = fill_timeout
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._fills = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        paths = [os.path.join(cache_dir, file_name) for file_name in os.listdir(cache_dir)]
+        for path in sorted(paths, key=os.path.getmtime):
+            if path.endswith(".part"):
+                os.remove(path)
+            else:
+                self._entries[os.path.basename(path)] = os.path.getsize(path)
+        self._evict()
+
+    def _key(self, build_entry):
+        build_hash = hashlib.sha1(str(build_entry["build_time"]).encode()).hexdigest()[:16]
+        extension = ".tar" if build_entry["container_type"] == "docker" else ".sif"
+        return f"{build_entry['build_id']}_{build_hash}{extension}"
+
+    def _evict(self):
+        """Removes least recently used containers until the cache fits in
+        max_bytes. Must be called with self._lock held.
+        """
+        while self._entries and sum(self._entries.values()) > self.max_bytes:
+            file_name, _ = self._entries.popitem(last=False)
+            os.remove(os.path.join(self.cache_dir, file_name))
+            self.evictions += 1
+
+    def _count(self, chunks):
+        for chunk in chunks:
+            with self._lock:
+                self.bytes_served += len(chunk)
+            yield chunk
+
+    def _read(self, file_obj, byte_range, chunk_size):
+        size = os.fstat(file_obj.fileno()).st_size
+        info = {"content_length": size}
+        start, end = 0, size
+        if byte_range is not None:
+            start, end = byte_range[0], min(byte_range[1], size)
+            if not 0 <= start < end:
+                file_obj.close()
+                raise ValueError(f"Range {byte_range} not satisfiable")
+            info = {"content_length": end - start, "content_range": f"bytes {start}-{end - 1}/{size}",
+                    "total_size": size}
+
+        def chunks():
+            with file_obj:
+                file_obj.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = file_obj.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+
+        return ClosingChunks(self._count(chunks()), file_obj.close), info
+
+    def _fill(self, build_entry, file_name, chunk_size):
+        with self._lock:
+            fill = self._fills[file_name]
+
+        def release():
+            if os.path.exists(path + ".part"):
+                os.remove(path + ".part")
+            with self._lock:
+                if self._fills.get(file_name) is fill:
+                    del self._fills[file_name]
+            fill.set()
+
+        path = os.path.join(self.cache_dir, file_name)
+        try:
+            source, info = stream_container(build_entry, chunk_size=chunk_size)
+        except Exception:
+            release()
+            raise
+
+        def chunks():
+            size = 0
+            try:
+                with open(path + ".part", "wb") as f:
+                    for chunk in source:
+                        f.write(chunk)
+                        size += len(chunk)
+                        yield chunk
+                os.replace(path + ".part", path)
+                with self._lock:
+                    self._entries[file_name] = size
+                    self._evict()
+            finally:
+                release()
+
+        def close():
+            # Runs even if the client left before the first chunk, when chunks() never started
+            if hasattr(source, "close"):
+                source.close()
+            release()
+
+        return ClosingChunks(self._count(chunks()), close), info
+
+    def size(self, build_entry):
+        """Returns the size of a Singularity container, from the cache if it
+        is cached or from S3 otherwise, so byte ranges can be resolved
+        before streaming it.
+
+        Parameters:
+        build_entry (dict): Build entry of the container.
+
+        Returns:
+        (int): Size of the container in bytes.
+        """
+        file_name = self._key(build_entry)
+        with self._lock:
+            if file_name in self._entries:
+                return self._entries[file_name]
+        if build_entry["container_type"] != "singularity":
+            raise ValueError("Only the size of Singularity containers is known before they are streamed")
+        response = get_boto3_client("s3").head_object(Bucket="xtract-container-service",
+                                                       Key=container_location(build_entry))
+        return response["ContentLength"]
+
+    def stream(self, build_entry, byte_range=None, chunk_size=2 * 1024 * 1024):
+        """Streams a container from the cache, fetching it with
+        stream_container and caching it if it isn't cached.
+
+        Parameters:
+        build_entry (dict): Build entry of the container to pull.
+        byte_range (tuple (int)): Satisfiable (start, end) byte offsets, end
+        exclusive, or None for the whole container. Uncached ranges are
+        streamed from S3 without being cached.
+        chunk_size (int): Maximum size of each chunk in bytes.
+
+        Returns:
+        chunks (ClosingChunks): Chunks of the container, which must be closed
+        even if they aren't iterated.
+        info (dict): Same as the info returned by stream_container.
+        """
+        file_name = self._key(build_entry)
+        while True:
+            with self._lock:
+                if file_name in self._entries:
+                    self._entries.move_to_end(file_name)
+                    self.hits += 1
+                    file_obj = open(os.path.join(self.cache_dir, file_name), "rb")
+                    return self._read(file_obj, byte_range, chunk_size)
+
+                fill = self._fills.get(file_name)
+                if fill is None:
+                    self.misses += 1
+                    if byte_range is None:
+                        self._fills[file_name] = threading.Event()
+            if fill is not None:
+                if fill.wait(self.fill_timeout):
+                    continue
+                logging.info(f"Timed out waiting for {file_name} to be cached, streaming it without the cache")
+            elif byte_range is None:
+                return self._fill(build_entry, file_name, chunk_size)
+            chunks, info = stream_container(build_entry, byte_range=byte_range, chunk_size=chunk_size)
+            return ClosingChunks(self._count(chunks)), info
+
+    def shrink(self, max_bytes):
+        """Removes least recently used containers until max_bytes have been
+        freed or the cache is empty.
+
+        Parameters:
+        max_bytes (int): Number of bytes to free.
+
+        Returns:
+        (int): Number of bytes freed.
+        """
+        freed = 0
+        with self._lock:
+            while self._entries and freed < max_bytes:
+                file_name, size = self._entries.popitem(last=False)
+                os.remove(os.path.join(self.cache_dir, file_name))
+                self.evictions += 1
+                freed += size
+
+        return freed
+
+    def invalidate(self, build_id):
+        """Removes every cached container of a build.
+
+        Parameters:
+        build_id (str): ID of the build to remove.
+        """
+        with self._lock:
+            for file_name in [name for name in self._entries if name.startswith(f"{build_id}_")]:
+                del self._entries[file_name]
+                os.remove(os.path.join(self.cache_dir, file_name))
+
+    def stats(self):
+        """Returns cache statistics.
+
+        Returns:
+        (dict): Number and total size of cached containers, hits, misses,
+        bytes served and evictions.
+        """
+        with self._lock:
+            return {"containers": len(self._entries), "size": sum(self._entries.values()),
+                    "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses,
+                    "bytes_served": self.bytes_served, "evictions": self.evictions}
+
+
+def get_artifact_cache():
+    """Returns the process-wide artifact cache, creating it on first use.
+
+    The cache size in bytes can be set with the XCS_ARTIFACT_CACHE_SIZE
+    environment variable.
+
+    Returns:
+    (ArtifactCache): The shared artifact cache.
+    """
+    global _artifact_cache
+    with _artifact_cache_lock:
+        if _artifact_cache is None:
+            _artifact_cache = ArtifactCache(max_bytes=int(os.environ.get("XCS_ARTIFACT_CACHE_SIZE",
+                                                                         20 * 1024 ** 3)))
+    return _artifact_cache
+
+
 def pull_container(build_entry):
-    """Pulls Docker containers from ECR and Singularity containers from S3.
+    """Pulls Docker containers from ECR and Singularity containers from S3
+    to a file in PROJECT_ROOT.
 
     Parameters:
-    owner_id (str): ID of definition file owner as returned by Globus Auth.
-    token introspection.
-    build_id (str): ID of container to pull.
+    build_entry (dict): Build entry of the container to pull.
 
     Returns:
-    (file obj.): File object of container.
+    file_name (str): Path of the pulled container or None if the pull fails.
     """
     build_id = build_entry["build_id"]
     file_name = PROJECT_ROOT + build_id + (".tar" if build_entry["container_type"] == "docker" else ".sif")
     try:
-        if build_entry["container_type"] == "docker":
-            registry = ecr_login()[8:] + "/" + build_id
-            docker_client = docker.from_env()
-            image = docker_client.images.pull(registry, tag=build_entry["container_name"])
-            with open(file_name, "wb") as f:
-                for chunk in image.save():
-                    f.write(chunk)
-            return file_name
-        elif build_entry["container_type"] == "singularity":
-            s3 = boto3.client('s3')
-            s3.download_file('xtract-container-service', os.path.join(build_entry["build_id"],
-                                                                      build_entry["container_name"]),
-                             file_name)
-            return file_name
+        chunks, _ = stream_container(build_entry)
+        with open(file_name, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        return file_name
     except Exception as e:
         if os.path.exists(file_name):
             os.remove(file_name)
@@ -352,57 +1163,145 @@ def pull_container(build_entry):
 # Apache uses the www-data user when running which causes issues with repo2docker, so you have to add
 # "--user-id YOUD_ID --user-name YOUR_USER" where YOUR_ID and YOUR_USER aren't preexisting on the system.
 # Check the repo2docker documentation for more information.
-def repo2docker_container(client_id, build_id, target, container_name):
-    """Takes a .zip or .tar file object or git repo link and attempts to run repo2docker on it.
+def run_logged(cmd, build_log):
+    """Runs a shell command, streaming its stdout and stderr into a build log.
+
+    Parameters:
+    cmd (str): Command to run.
+    build_log (BuildLog): Log to write the output to.
+
+    Returns:
+    (int): Exit code of the command.
+    """
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in iter(process.stdout.readline, b""):
+        build_log.write(line)
+    process.stdout.close()
+    return process.wait()
+
+
+def repo2docker_container(client_id, build_id, target, container_name, definition_hash=None, ref=None):
+    """Takes a .zip or .tar file or git repo link and attempts to run repo2docker on it.
 
     Note:
     The definition information for a container will only be stored if the container successfully
-    builds.
+    builds. The output of repo2docker is streamed to the build log.
 
     Parameters:
     client_id (str): ID of the build owner.
     build_id (str): ID to give to the build entry.
-    target (file obj. or str.): A link to a github repository or a file object.
+    target (str): A link to a git repository, an s3:// link to an uploaded .zip or .tar file or the
+    path to a local one.
     container_name (str): Name to give to container.
+    definition_hash (str): Hash of the uploaded file if it was hashed while it was uploaded.
+    ref (str): Branch, tag or commit of the git repository to build or None for its default branch.
     """
-    if isinstance(target, str) and target.startswith("https://github.com"):
+    build_log = open_log(build_id)
+    try:
+        with in_flight(build_id):
+            result = _repo2docker_container(client_id, build_id, target, container_name, build_log,
+                                            definition_hash=definition_hash, ref=ref)
+        if result == "Failed":
+            build_log.write("Build failed\n")
+    finally:
+        close_log(build_log)
+
+    # Uploads are deleted however the build ends, but kept when it raises so a retry can fetch them again.
+    # The lifecycle rule on uploads/ removes those whose retries never finish.
+    if target.startswith("s3://"):
+        bucket, key = target[len("s3://"):].split("/", 1)
+        get_boto3_client("s3").delete_object(Bucket=bucket, Key=key)
+    return result
+
+
+def _repo2docker_container(client_id, build_id, target, container_name, build_log, definition_hash=None,
+                           ref=None):
+    """Runs repo2docker for repo2docker_container, writing its output to the build log."""
+    upload = None
+    if is_git_url(target):
         target_type = "git"
         temp_dir = ""
-        cmd = f"jupyter-repo2docker --no-run --image-name {container_name} {target}"
     else:
-        file_obj = open(target, "rb")
-        if zipfile.is_zipfile(file_obj):
-            target_type = ".zip"
-            with zipfile.ZipFile(file_obj) as zip_obj:
-                temp_dir = tempfile.mkdtemp()
-                zip_obj.extractall(path=temp_dir)
-        else:
-            try:
-                # For some reason literally any file will pass through this tarfile check
-                with tarfile.TarFile(fileobj=file_obj) as tar_obj:
+        if target.startswith("s3://"):
+            # Uploaded archives are streamed to S3 by the API and fetched by whichever node builds them
+            upload = target[len("s3://"):].split("/", 1)
+            os.makedirs(WORKSPACE_ROOT, exist_ok=True)
+            target = tempfile.mkstemp(prefix=build_id + "_", dir=WORKSPACE_ROOT)[1]
+            get_boto3_client("s3").download_file(*upload, target, Config=TRANSFER_CONFIG)
+        with open(target, "rb") as file_obj:
+            if definition_hash is None:
+                definition_hash = hash_definition([("repo2docker", file_obj)])
+            if zipfile.is_zipfile(file_obj):
+                target_type = ".zip"
+                with zipfile.ZipFile(file_obj) as zip_obj:
                     temp_dir = tempfile.mkdtemp()
-                    tar_obj.extractall(path=temp_dir)
-
-                if len(os.listdir(temp_dir)) == 0:
-                    os.removedirs(temp_dir)
+                    zip_obj.extractall(path=temp_dir)
+            else:
+                try:
+                    file_obj.seek(0)
+                    # For some reason literally any file will pass through this tarfile check
+                    with tarfile.TarFile(fileobj=file_obj) as tar_obj:
+                        temp_dir = tempfile.mkdtemp()
+                        tar_obj.extractall(path=temp_dir)
+
+                    if len(os.listdir(temp_dir)) == 0:
+                        os.removedirs(temp_dir)
+                        os.remove(target)
+                        return "Failed"
+                    target_type = ".tar"
+                except tarfile.TarError:
+                    os.remove(target)
                     return "Failed"
-                target_type = ".tar"
-            except tarfile.TarError:
-                os.remove(target)
-                return "Failed"
 
-        cmd = f"jupyter-repo2docker --no-run --image-name {container_name} {temp_dir}"
-    build_entry = build_schema
+    build_entry = dict(build_schema)
     build_entry["build_id"] = build_id
     build_entry["container_name"] = container_name
     build_entry["container_type"] = "docker"
     build_entry["container_owner"] = client_id
     build_entry["build_status"] = "building"
-    build_entry["build_time"] = datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-    create_table_entry("build", **build_entry)
+    build_entry["build_time"] = datetime.datetime.now(datetime.timezone.utc)
+    # The task may be a redelivery of one whose worker died after creating the entry
+    if select_by_column("build", build_id=build_id):
+        update_table_entry("build", build_id, build_status="building", build_time=build_entry["build_time"])
+    else:
+        create_table_entry("build", **build_entry)
+
+    if target_type == "git":
+        git_cache = get_git_cache()
+        try:
+            commit = git_cache.resolve(target, ref)
+        except GitError as e:
+            build_log.write(f"{e}\n")
+            update_table_entry("build", build_id, build_status="failed")
+            return "Failed"
+        build_log.write(f"Resolved {ref or 'HEAD'} of {target} to {commit}\n")
+        # Builds of the same commit reuse its image, whatever URL or ref they were requested with
+        definition_hash = hashlib.sha256(b"git\0" + commit.encode()).hexdigest()
+
+    cached_build = find_cached_build(definition_hash, "docker")
+    if cached_build is not None:
+        update_table_entry("build", build_id, build_status="success",
+                           definition_id=cached_build["definition_id"],
+                           build_location=container_location(cached_build),
+                           container_size=cached_build["container_size"],
+                           definition_hash=definition_hash)
+        logging.info(f"Reused build {cached_build['build_id']} for {build_id}")
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        if os.path.exists(target):
+            os.remove(target)
+        return build_id
 
-    subprocess.call(cmd, shell=True)
-    client = docker.from_env()
+    if target_type == "git":
+        os.makedirs(WORKSPACE_ROOT, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix=build_id + "_", dir=WORKSPACE_ROOT)
+        git_cache.checkout(target, commit, temp_dir)
+    cmd = f"jupyter-repo2docker --no-run --image-name {container_name} {temp_dir}"
+    with BUILD_SECONDS.time(format="repo2docker"):
+        exit_code = run_logged(cmd, build_log)
+    if exit_code:
+        build_log.write(f"repo2docker exited with code {exit_code}\n")
+    client = get_docker_client()
     try:
         docker_image = client.images.get(container_name)
         update_table_entry("build", build_id, build_status="pushing")
@@ -420,13 +1319,20 @@ def repo2docker_container(client_id, build_id, target, container_name):
                        definition_type="docker",
                        definition_name=container_name,
                        location=target if target_type == "git" else "s3",
-                       definition_owner=client_id)
+                       definition_owner=client_id,
+                       definition_hash=definition_hash)
 
     if target_type == ".zip" or target_type == ".tar":
-        s3 = boto3.client('s3')
-
-        s3.upload_fileobj(file_obj, "xtract-container-service",
-                          f'{definition_id}/{container_name + target_type}')
+        s3 = get_boto3_client("s3")
+        definition_key = f'{definition_id}/{container_name + target_type}'
+
+        with UPLOAD_SECONDS.time(kind="archive"):
+            if upload is not None:
+                # Copied within S3 instead of sending the archive again
+                s3.copy({"Bucket": upload[0], "Key": upload[1]}, "xtract-container-service", definition_key,
+                        Config=TRANSFER_CONFIG)
+            else:
+                s3.upload_file(target, "xtract-container-service", definition_key, Config=TRANSFER_CONFIG)
 
     #for image in client.df()["Images"]:
         #if any(list(map(lambda x: container_name in x, image["RepoTags"]))):
@@ -438,8 +1344,11 @@ def repo2docker_container(client_id, build_id, target, container_name):
     update_table_entry("build", build_id, definition_id=definition_id)
     
     try:
-        response = push_to_ecr(docker_image, build_id, container_name)
-        update_table_entry("build", build_id, **{"build_status": "success"})
+        with get_image_cache().in_use(docker_image.id):
+            response = push_to_ecr(docker_image, build_id, container_name)
+        update_table_entry("build", build_id, **{"build_status": "success",
+                                                 "build_location": f"{build_id}:{container_name}",
+                                                 "definition_hash": definition_hash})
         client.images.remove(response, force=True)
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir)
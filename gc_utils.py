@@ -0,0 +1,263 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from client_utils import get_docker_client
+from container_handler import (CONTEXT_CACHE_ROOT, PROJECT_ROOT, WORKSPACE_ROOT, build_in_flight, evict_context,
+                               get_artifact_cache)
+from git_cache_utils import get_git_cache
+from image_cache_utils import get_image_cache
+
+UUID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+_garbage_collector = None
+_garbage_collector_lock = threading.Lock()
+
+
+def path_size(path):
+    """Returns the number of bytes of a file or of the files in a directory.
+
+    Parameters:
+    path (str): Path of the file or directory.
+
+    Returns:
+    (int): Size in bytes.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(root, file_name))
+            except OSError:
+                pass
+    return size
+
+
+def remove_path(path):
+    """Removes a file or directory and returns the number of bytes freed.
+
+    Parameters:
+    path (str): Path of the file or directory.
+
+    Returns:
+    (int): Number of bytes freed.
+    """
+    size = path_size(path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+    return size
+
+
+class GarbageCollector:
+    """Frees disk space on the volumes of PROJECT_ROOT and the Docker root
+    when they fill up. Once a volume is more than high_watermark full, files
+    are evicted until it is at most low_watermark full, in this order:
+
+    1. Build directories in the workspace and leftover .sif and .tar files
+    and <definition_id> directories in PROJECT_ROOT, oldest first. Builds
+    remove these themselves so anything older than min_age was left behind,
+    except the workspaces of builds still running in any worker on the host.
+    2. Contexts in the context cache, least recently used first.
+    3. Git mirrors in the git mirror cache, least recently used first.
+    4. Containers in the artifact cache, least recently used first.
+    5. Docker images, least recently used first, through the image cache.
+
+    Collection never pauses the workers. Images in use by a build are pinned
+    by the image cache and files younger than min_age are never removed.
+
+    Parameters:
+    high_watermark (float): Fraction of a volume in use that triggers
+    collection.
+    low_watermark (float): Fraction of a volume in use to collect down to.
+    min_age (int): Number of seconds since a leftover file was last modified
+    before it can be removed.
+
+    Attributes:
+    high_watermark (float): Fraction of a volume in use that triggers
+    collection.
+    low_watermark (float): Fraction of a volume in use to collect down to.
+    min_age (int): Number of seconds since a leftover file was last modified
+    before it can be removed.
+    reclaimed_bytes (dict (int)): Total number of bytes freed, keyed by
+    "leftovers", "context_cache", "git_cache", "artifact_cache" and
+    "images".
+    runs (int): Number of collections that freed space.
+    last_run (float): Time of the last collection that freed space.
+    """
+    def __init__(self, high_watermark=0.85, low_watermark=0.7, min_age=3600):
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.min_age = min_age
+        self.reclaimed_bytes = {"leftovers": 0, "context_cache": 0, "git_cache": 0, "artifact_cache": 0,
+                                "images": 0}
+        self.runs = 0
+        self.last_run = None
+        self._docker_root = None
+        self._lock = threading.Lock()
+
+    def docker_root(self):
+        """Returns the root directory of the Docker daemon if it is on this
+        machine.
+
+        Returns:
+        (str): Path of the Docker root or None if it isn't accessible.
+        """
+        if self._docker_root is None:
+            try:
+                self._docker_root = get_docker_client().info()["DockerRootDir"]
+            except Exception:
+                logging.warning("Failed to find the Docker root", exc_info=True)
+                return None
+        return self._docker_root if os.path.exists(self._docker_root) else None
+
+    def usage(self):
+        """Returns the disk usage of the volumes of PROJECT_ROOT and the
+        Docker root.
+
+        Returns:
+        (dict): "total", "used" and "free" bytes and the "fraction" used of
+        "project_root" and "docker_root", which is None if the Docker root
+        isn't accessible.
+        """
+        usage = {}
+        for name, path in [("project_root", PROJECT_ROOT), ("docker_root", self.docker_root())]:
+            if path is None:
+                usage[name] = None
+            else:
+                disk = shutil.disk_usage(path)
+                usage[name] = {"total": disk.total, "used": disk.used, "free": disk.free,
+                               "fraction": disk.used / disk.total}
+        return usage
+
+    def _bytes_over(self, path):
+        disk = shutil.disk_usage(path)
+        if disk.used <= disk.total * self.high_watermark:
+            return 0
+        return int(disk.used - disk.total * self.low_watermark)
+
+    def _leftovers(self):
+        now = time.time()
+        paths = []
+        if os.path.exists(WORKSPACE_ROOT):
+            # Workspaces are named <build or definition ID>_<random suffix>
+            paths += [os.path.join(WORKSPACE_ROOT, name) for name in os.listdir(WORKSPACE_ROOT)
+                      if not build_in_flight(name.split("_", 1)[0])]
+        for name in os.listdir(PROJECT_ROOT):
+            path = os.path.join(PROJECT_ROOT, name)
+            if name.endswith((".sif", ".tar")) and os.path.isfile(path):
+                paths.append(path)
+            elif UUID_PATTERN.match(name) and os.path.isdir(path):
+                paths.append(path)
+
+        paths = [(os.path.getmtime(path), path) for path in paths]
+        return [path for mtime, path in sorted(paths) if now - mtime >= self.min_age]
+
+    def _contexts(self):
+        if not os.path.exists(CONTEXT_CACHE_ROOT):
+            return []
+        manifests = [os.path.join(CONTEXT_CACHE_ROOT, name) for name in os.listdir(CONTEXT_CACHE_ROOT)
+                     if name.endswith(".json")]
+        return [os.path.basename(path)[:-len(".json")] for path in sorted(manifests, key=os.path.getmtime)]
+
+    def _collect_files(self, bytes_needed, reclaimed):
+        for path in self._leftovers():
+            if reclaimed["leftovers"] >= bytes_needed:
+                return bytes_needed - reclaimed["leftovers"]
+            try:
+                reclaimed["leftovers"] += remove_path(path)
+                logging.info(f"Removed leftover {path}")
+            except OSError:
+                logging.warning(f"Failed to remove {path}", exc_info=True)
+        bytes_needed -= reclaimed["leftovers"]
+
+        for definition_id in self._contexts():
+            if reclaimed["context_cache"] >= bytes_needed:
+                return bytes_needed - reclaimed["context_cache"]
+            reclaimed["context_cache"] += evict_context(definition_id)
+        bytes_needed -= reclaimed["context_cache"]
+
+        if bytes_needed > 0:
+            reclaimed["git_cache"] += get_git_cache().shrink(bytes_needed)
+            bytes_needed -= reclaimed["git_cache"]
+
+        if bytes_needed > 0:
+            reclaimed["artifact_cache"] += get_artifact_cache().shrink(bytes_needed)
+            bytes_needed -= reclaimed["artifact_cache"]
+
+        return bytes_needed
+
+    def _collect_images(self, bytes_needed, reclaimed):
+        image_cache = get_image_cache()
+        usage = image_cache.usage()
+        reclaimed["images"] += image_cache.prune(max_bytes=max(0, usage - bytes_needed))
+
+    def collect(self):
+        """Frees space on the volumes of PROJECT_ROOT and the Docker root if
+        they are more than high_watermark full.
+
+        Returns:
+        (dict (int)): Number of bytes freed, keyed by "leftovers",
+        "context_cache", "git_cache", "artifact_cache" and "images".
+        """
+        with self._lock:
+            reclaimed = dict.fromkeys(self.reclaimed_bytes, 0)
+            docker_root = self.docker_root()
+            same_volume = docker_root is not None and os.stat(docker_root).st_dev == os.stat(PROJECT_ROOT).st_dev
+
+            bytes_needed = self._bytes_over(PROJECT_ROOT)
+            if bytes_needed > 0:
+                logging.info(f"{PROJECT_ROOT} is over {self.high_watermark:.0%} full, freeing {bytes_needed} bytes")
+                bytes_needed = self._collect_files(bytes_needed, reclaimed)
+                if bytes_needed > 0 and same_volume:
+                    self._collect_images(bytes_needed, reclaimed)
+
+            if docker_root is not None and not same_volume:
+                bytes_needed = self._bytes_over(docker_root)
+                if bytes_needed > 0:
+                    logging.info(f"{docker_root} is over {self.high_watermark:.0%} full, freeing {bytes_needed} bytes")
+                    self._collect_images(bytes_needed, reclaimed)
+
+            if any(reclaimed.values()):
+                self.runs += 1
+                self.last_run = time.time()
+                for kind in reclaimed:
+                    self.reclaimed_bytes[kind] += reclaimed[kind]
+                logging.info(f"Garbage collection freed {sum(reclaimed.values())} bytes: {reclaimed}")
+
+            return reclaimed
+
+    def stats(self):
+        """Returns garbage collection statistics and the current disk usage.
+
+        Returns:
+        (dict): "high_watermark", "low_watermark", "reclaimed_bytes", "runs",
+        "last_run" and "usage" as returned by usage.
+        """
+        return {"high_watermark": self.high_watermark, "low_watermark": self.low_watermark,
+                "reclaimed_bytes": dict(self.reclaimed_bytes), "runs": self.runs, "last_run": self.last_run,
+                "usage": self.usage()}
+
+
+def get_garbage_collector():
+    """Returns the process-wide garbage collector, creating it on first use.
+    Its watermarks are read from XCS_GC_HIGH_WATERMARK and
+    XCS_GC_LOW_WATERMARK and its minimum age in seconds from XCS_GC_MIN_AGE.
+
+    Returns:
+    (GarbageCollector): The garbage collector.
+    """
+    global _garbage_collector
+    with _garbage_collector_lock:
+        if _garbage_collector is None:
+            _garbage_collector = GarbageCollector(
+                high_watermark=float(os.environ.get("XCS_GC_HIGH_WATERMARK", 0.85)),
+                low_watermark=float(os.environ.get("XCS_GC_LOW_WATERMARK", 0.7)),
+                min_age=int(os.environ.get("XCS_GC_MIN_AGE", 3600)))
+    return _garbage_collector
@@ -0,0 +1,227 @@
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+PROJECT_ROOT = os.path.realpath(os.path.dirname(__file__)) + "/"
+GIT_CACHE_ROOT = os.path.join(PROJECT_ROOT, "git_cache")
+# Only https so users can't build from paths on the worker or clone with its SSH credentials
+GIT_SCHEMES = ("https://",)
+
+_git_cache = None
+_git_cache_lock = threading.Lock()
+
+
+class GitError(RuntimeError):
+    """Raised when a git command fails."""
+
+
+def is_git_url(target):
+    """Returns whether a repo2docker target is an https git repository rather
+    than an uploaded file. Other git URLs aren't accepted from users.
+
+    Parameters:
+    target (str): Target of a repo2docker build.
+
+    Returns:
+    (bool): Whether target is a git URL.
+    """
+    return isinstance(target, str) and target.startswith(GIT_SCHEMES)
+
+
+def run_git(args, cwd=None):
+    """Runs a git command without prompting for credentials.
+
+    Parameters:
+    args (list (str)): Arguments to git.
+    cwd (str): Directory to run the command in.
+
+    Returns:
+    (str): Standard output of the command.
+
+    Raises:
+    GitError: If the command fails.
+    """
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    process = subprocess.run(["git"] + args, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    if process.returncode:
+        raise GitError(f"git {' '.join(args)} failed: {process.stderr.strip()}")
+    return process.stdout
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(root, file_name))
+            except OSError:
+                pass
+    return size
+
+
+class GitMirrorCache:
+    """Bare mirrors of the git repositories built by repo2docker, keyed by
+    URL. The first build of a repository clones it, later builds only fetch
+    what changed, and each build gets a shallow checkout of a single commit
+    from the local mirror. Mirrors are locked with flock so builds in other
+    processes on the same machine share them safely.
+
+    Parameters:
+    root (str): Directory to keep the mirrors in.
+
+    Attributes:
+    root (str): Directory the mirrors are kept in.
+    clones (int): Number of repositories cloned.
+    fetches (int): Number of incremental fetches into existing mirrors.
+    """
+    def __init__(self, root=GIT_CACHE_ROOT):
+        self.root = root
+        self.clones = 0
+        self.fetches = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def mirror_path(self, url):
+        """Returns the path of the mirror of a repository.
+
+        Parameters:
+        url (str): URL of the repository.
+
+        Returns:
+        (str): Path of the bare mirror.
+        """
+        return os.path.join(self.root, hashlib.sha256(url.encode()).hexdigest()[:32] + ".git")
+
+    @contextlib.contextmanager
+    def _locked(self, path, blocking=True):
+        with open(path + ".lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _update(self, url, path):
+        if os.path.exists(os.path.join(path, "HEAD")):
+            run_git(["fetch", "--prune", "--quiet", "origin"], cwd=path)
+            self.fetches += 1
+        else:
+            # Cloned next to the mirror and renamed so an interrupted clone never looks like a mirror
+            clone_path = tempfile.mkdtemp(prefix=".clone_", dir=self.root)
+            try:
+                run_git(["clone", "--mirror", "--quiet", url, clone_path])
+                run_git(["config", "uploadpack.allowAnySHA1InWant", "true"], cwd=clone_path)
+                os.rename(clone_path, path)
+            finally:
+                if os.path.exists(clone_path):
+                    shutil.rmtree(clone_path)
+            self.clones += 1
+        os.utime(path)
+
+    def resolve(self, url, ref=None):
+        """Updates the mirror of a repository and resolves a ref to a commit.
+
+        Parameters:
+        url (str): URL of the repository.
+        ref (str): Branch, tag or commit to resolve or None for the default
+        branch.
+
+        Returns:
+        (str): SHA of the commit.
+
+        Raises:
+        GitError: If the repository can't be fetched or ref doesn't exist.
+        """
+        path = self.mirror_path(url)
+        with self._locked(path):
+            self._update(url, path)
+            try:
+                return run_git(["rev-parse", "--verify", "--quiet", f"{ref or 'HEAD'}^{{commit}}"], cwd=path).strip()
+            except GitError:
+                raise GitError(f"{ref or 'HEAD'} is not a commit of {url}")
+
+    def checkout(self, url, commit, dest):
+        """Checks out a single commit of a repository from its mirror without
+        its history.
+
+        Parameters:
+        url (str): URL of the repository, which must have been resolved.
+        commit (str): SHA of the commit to check out.
+        dest (str): Empty or missing directory to check the commit out to.
+
+        Raises:
+        GitError: If the commit isn't in the mirror.
+        """
+        path = self.mirror_path(url)
+        with self._locked(path):
+            run_git(["init", "--quiet", dest])
+            run_git(["fetch", "--depth", "1", "--quiet", "file://" + path, commit], cwd=dest)
+            run_git(["checkout", "--quiet", "--detach", "FETCH_HEAD"], cwd=dest)
+            os.utime(path)
+
+    def mirrors(self):
+        """Returns the paths of the mirrors, least recently used first.
+
+        Returns:
+        (list (str)): Paths of the mirrors.
+        """
+        paths = [os.path.join(self.root, name) for name in os.listdir(self.root)
+                 if name.endswith(".git") and not name.startswith(".")]
+        return sorted(paths, key=os.path.getmtime)
+
+    def shrink(self, bytes_needed):
+        """Removes mirrors, least recently used first, until bytes_needed
+        bytes are freed. Mirrors in use are skipped.
+
+        Parameters:
+        bytes_needed (int): Number of bytes to free.
+
+        Returns:
+        (int): Number of bytes freed.
+        """
+        freed = 0
+        for path in self.mirrors():
+            if freed >= bytes_needed:
+                break
+            with self._locked(path, blocking=False) as locked:
+                if not locked:
+                    continue
+                size = _dir_size(path)
+                shutil.rmtree(path)
+                freed += size
+                logging.info(f"Removed git mirror {path}")
+        return freed
+
+    def stats(self):
+        """Returns mirror cache statistics.
+
+        Returns:
+        (dict): "mirrors", "bytes", "clones" and "fetches".
+        """
+        mirrors = self.mirrors()
+        return {"mirrors": len(mirrors), "bytes": sum(_dir_size(path) for path in mirrors),
+                "clones": self.clones, "fetches": self.fetches}
+
+
+def get_git_cache():
+    """Returns the process-wide git mirror cache, creating it on first use.
+    Mirrors are kept in XCS_GIT_CACHE_DIR or git_cache in PROJECT_ROOT.
+
+    Returns:
+    (GitMirrorCache): The git mirror cache.
+    """
+    global _git_cache
+    with _git_cache_lock:
+        if _git_cache is None:
+            _git_cache = GitMirrorCache(os.environ.get("XCS_GIT_CACHE_DIR", GIT_CACHE_ROOT))
+    return _git_cache
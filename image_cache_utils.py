@@ -0,0 +1,183 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from client_utils import get_docker_client
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+class ImageCache:
+    """Keeps a size-bounded set of recently used Docker images on the local
+    daemon so rebuilds can reuse their layers. Pruning evicts the least
+    recently used images until the images on disk fit in max_bytes, instead of
+    removing every unused image.
+
+    Images are used when they are pulled as a cache_from source or built.
+    Images that were never used by this process count as last used when they
+    were created, and images in use by a build or a container are never
+    evicted.
+
+    Listing the images on disk walks every image, layer and volume on the
+    daemon, so periodic prunes only list them when this process used an
+    image since the last listing or check_time seconds have passed, in case
+    images were added some other way.
+
+    Parameters:
+    max_bytes (int): Maximum number of bytes of images to keep.
+    check_time (int): Maximum number of seconds between listings of the
+    images on disk when no image was used.
+
+    Attributes:
+    max_bytes (int): Maximum number of bytes of images to keep.
+    check_time (int): Maximum number of seconds between listings of the
+    images on disk when no image was used.
+    last_used (dict (float)): Time each image was last used, keyed by image
+    ID.
+    reclaimed_bytes (int): Total number of bytes evicted.
+    evictions (int): Total number of images evicted.
+    """
+    def __init__(self, max_bytes=50 * 1024 ** 3, check_time=600):
+        self.max_bytes = max_bytes
+        self.check_time = check_time
+        self.last_used = {}
+        self.reclaimed_bytes = 0
+        self.evictions = 0
+        self._pinned = {}
+        self._used = True
+        self._last_check = 0
+        self._lock = threading.Lock()
+
+    def touch(self, *image_ids):
+        """Marks images as used now.
+
+        Parameters:
+        *image_ids (str): IDs of the images.
+        """
+        now = time.time()
+        with self._lock:
+            for image_id in image_ids:
+                if image_id:
+                    self.last_used[image_id] = now
+                    self._used = True
+
+    @contextmanager
+    def in_use(self, *image_ids):
+        """Context manager that keeps images from being evicted while a build
+        uses them and marks them as used when it exits.
+
+        Parameters:
+        *image_ids (str): IDs of the images.
+        """
+        image_ids = [image_id for image_id in image_ids if image_id]
+        with self._lock:
+            for image_id in image_ids:
+                self._pinned[image_id] = self._pinned.get(image_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for image_id in image_ids:
+                    self._pinned[image_id] -= 1
+                    if not self._pinned[image_id]:
+                        del self._pinned[image_id]
+            self.touch(*image_ids)
+
+    def usage(self):
+        """Returns the number of bytes of images on disk.
+
+        Returns:
+        (int): Size of every layer on disk, counting shared layers once.
+        """
+        return get_docker_client().df()["LayersSize"]
+
+    def prune(self, max_bytes=None):
+        """Removes the least recently used images until the images on disk
+        fit in max_bytes.
+
+        Parameters:
+        max_bytes (int): Number of bytes to prune down to. Defaults to
+        self.max_bytes, in which case nothing is done unless an image was
+        used since the last prune or check_time seconds have passed.
+
+        Returns:
+        (int): Estimated number of bytes reclaimed.
+        """
+        with self._lock:
+            if max_bytes is None:
+                if not self._used and time.time() - self._last_check < self.check_time:
+                    return 0
+                self._used = False
+                self._last_check = time.time()
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        client = get_docker_client()
+        try:
+            df = client.df()
+        except Exception:
+            with self._lock:
+                self._used = True
+            raise
+        usage = df["LayersSize"]
+        if usage <= max_bytes:
+            return 0
+
+        with self._lock:
+            candidates = [image for image in df["Images"]
+                          if image["Id"] not in self._pinned and image.get("Containers", 0) <= 0]
+            candidates.sort(key=lambda image: self.last_used.get(image["Id"], image["Created"]))
+
+        reclaimed = 0
+        for image in candidates:
+            if usage - reclaimed <= max_bytes:
+                break
+            with self._lock:
+                if image["Id"] in self._pinned:
+                    continue
+            try:
+                # Forced so images tagged both locally and for ECR are removed, images used by containers
+                # were skipped above
+                client.images.remove(image["Id"], force=True)
+            except Exception as e:
+                # Images with children or used since the listing stay
+                logging.debug(f"Not evicting {image['Id']}: {e}")
+                continue
+            shared = image.get("SharedSize", -1)
+            freed = image["Size"] - shared if shared > 0 else image["Size"]
+            reclaimed += freed
+            with self._lock:
+                self.last_used.pop(image["Id"], None)
+                self.reclaimed_bytes += freed
+                self.evictions += 1
+            logging.info(f"Evicted image {image['Id']} ({image.get('RepoTags')})")
+
+        return reclaimed
+
+    def stats(self):
+        """Returns statistics of the image cache.
+
+        Returns:
+        (dict): "max_bytes", "tracked_images", "pinned_images",
+        "reclaimed_bytes" and "evictions".
+        """
+        with self._lock:
+            return {"max_bytes": self.max_bytes,
+                    "tracked_images": len(self.last_used),
+                    "pinned_images": len(self._pinned),
+                    "reclaimed_bytes": self.reclaimed_bytes,
+                    "evictions": self.evictions}
+
+
+def get_image_cache():
+    """Returns the process-wide image cache, creating it on first use. Its
+    size is read from XCS_IMAGE_CACHE_SIZE in bytes.
+
+    Returns:
+    (ImageCache): The image cache.
+    """
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache(max_bytes=int(os.environ.get("XCS_IMAGE_CACHE_SIZE", 50 * 1024 ** 3)))
+    return _image_cache
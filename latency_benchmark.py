@@ -0,0 +1,120 @@
+"""Measures queue-to-start latency of the worker loop before and after long polling.
+
+"sleep" is the original TaskManager.execute_work loop, which receives one
+message without waiting and sleeps 5 seconds after every receive. "long_poll"
+is the current TaskManager, which long polls and receives again as soon as a
+task finishes. Both receive from an in-memory queue that adds a simulated SQS
+round trip to every receive, with tasks queued at random intervals while one
+worker thread is idle.
+
+Usage:
+    python latency_benchmark.py --tasks 25 --interval 3 --round_trip 0.02
+"""
+import argparse
+import csv
+import random
+import sys
+import threading
+import time
+from memory_queue_utils import MemoryQueueClient
+from task_manager import TaskManager
+
+
+class RoundTripQueueClient(MemoryQueueClient):
+    """In-memory queue whose receives return round_trip seconds after they
+    find messages, and are counted.
+
+    Parameters:
+    round_trip (float): Seconds each receive takes to return.
+
+    Attributes:
+    receives (int): Number of receives made.
+    """
+    def __init__(self, round_trip):
+        super().__init__("latency-benchmark")
+        self.round_trip = round_trip
+        self.receives = 0
+
+    def receive_batch(self, n=10, wait_time=0, visibility_timeout=None):
+        self.receives += 1
+        messages = super().receive_batch(n, wait_time=wait_time, visibility_timeout=visibility_timeout)
+        time.sleep(self.round_trip)
+        return messages
+
+
+def sleep_worker(queue, run, stop, sleep_time=5):
+    """The worker loop before long polling."""
+    while not stop.is_set():
+        messages = queue.receive_batch(1)
+        if messages:
+            run(messages[0])
+        time.sleep(sleep_time)
+
+
+def measure(mode, tasks, interval, round_trip):
+    """Queues tasks at random intervals and records how long each waited to
+    start.
+
+    Parameters:
+    mode (str): "sleep" or "long_poll".
+    tasks (int): Number of tasks to queue.
+    interval (float): Maximum number of seconds between tasks.
+    round_trip (float): Seconds each receive takes on top of its wait.
+
+    Returns:
+    latencies (list (float)): Seconds each task waited to start.
+    receives_per_second (float): Receives made per second.
+    """
+    queue = RoundTripQueueClient(round_trip)
+    latencies = []
+    finished = threading.Semaphore(0)
+
+    def run(message):
+        latencies.append(time.time() - message.body["queued_at"])
+        message.delete()
+        finished.release()
+
+    stop = threading.Event()
+    if mode == "sleep":
+        threading.Thread(target=sleep_worker, args=(queue, run, stop), daemon=True).start()
+    else:
+        manager = TaskManager(max_threads=1, min_threads=1, kill_time=3600, queue_client=queue)
+        manager.functions = {"task": lambda: finished.release()}
+        manager.queue_latencies.clear()
+        manager.scale()
+
+    start_time = time.time()
+    for _ in range(tasks):
+        time.sleep(random.uniform(0, interval))
+        queue.put_message({"function_name": "task"})
+        finished.acquire()
+    total_time = time.time() - start_time
+    stop.set()
+
+    if mode == "long_poll":
+        latencies = list(manager.queue_latencies)
+        manager.drain()
+    return latencies, queue.receives / total_time
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=25)
+    parser.add_argument("--interval", type=float, default=3)
+    parser.add_argument("--round_trip", type=float, default=0.02)
+    parser.add_argument("--modes", nargs="+", choices=["sleep", "long_poll"], default=["sleep", "long_poll"])
+    args = parser.parse_args()
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["mode", "tasks", "mean_latency", "p50_latency", "p95_latency", "max_latency",
+                     "receives_per_second"])
+    for mode in args.modes:
+        latencies, receive_rate = measure(mode, args.tasks, args.interval, args.round_trip)
+        writer.writerow([mode, len(latencies), round(sum(latencies) / len(latencies), 3),
+                         round(percentile(latencies, 0.5), 3), round(percentile(latencies, 0.95), 3),
+                         round(max(latencies), 3), round(receive_rate, 3)])
@@ -0,0 +1,296 @@
+import logging
+import threading
+import time
+from client_utils import get_boto3_client
+
+LOG_PREFIX = "logs"
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def log_key(build_id, offset):
+    """Returns the S3 key of the chunk of a build's log starting at a byte
+    offset. Keys sort in log order.
+
+    Parameters:
+    build_id (str): ID of the build.
+    offset (int): Byte offset of the chunk in the log.
+
+    Returns:
+    (str): S3 key of the chunk.
+    """
+    return f"{LOG_PREFIX}/{build_id}/{offset:015d}.log"
+
+
+class BuildLog:
+    """Output of a running build. The most recent max_bytes are kept in
+    memory for live tails and everything is uploaded to S3 in chunks as the
+    build runs, so the whole log survives the build and can be tailed from
+    other nodes.
+
+    Output waiting to be uploaded is also capped at max_bytes. If uploads
+    keep failing the oldest of it is dropped, and the next chunk uploaded
+    starts with a note of how many bytes are missing from the log in S3.
+
+    Parameters:
+    build_id (str): ID of the build.
+    max_bytes (int): Number of bytes of the log to keep in memory.
+    chunk_bytes (int): Number of bytes after which a chunk is uploaded.
+    flush_time (float): Number of seconds after which a chunk is uploaded
+    even if it is smaller than chunk_bytes.
+
+    Attributes:
+    build_id (str): ID of the build.
+    max_bytes (int): Number of bytes of the log kept in memory.
+    size (int): Number of bytes written.
+    dropped (int): Number of bytes dropped without being uploaded.
+    closed (bool): Whether the build finished.
+    """
+    def __init__(self, build_id, max_bytes=1024 ** 2, chunk_bytes=256 * 1024, flush_time=5):
+        self.build_id = build_id
+        self.max_bytes = max_bytes
+        self.chunk_bytes = chunk_bytes
+        self.flush_time = flush_time
+        self.size = 0
+        self.dropped = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._pending = bytearray()
+        self._unreported = 0
+        self._flushed = 0
+        self._last_flush = time.time()
+        self._changed = threading.Condition()
+        self._upload_lock = threading.Lock()
+
+    def write(self, text):
+        """Appends output to the log.
+
+        Parameters:
+        text (str or bytes): Output to append.
+        """
+        data = text.encode(errors="replace") if isinstance(text, str) else bytes(text)
+        if not data:
+            return
+        with self._changed:
+            self._buffer += data
+            if len(self._buffer) > self.max_bytes:
+                del self._buffer[:len(self._buffer) - self.max_bytes]
+            self._pending += data
+            self._drop_pending()
+            self.size += len(data)
+            self._changed.notify_all()
+            flush = len(self._pending) >= self.chunk_bytes or time.time() - self._last_flush >= self.flush_time
+        if flush:
+            self.flush()
+
+    def _drop_pending(self):
+        """Drops the oldest output waiting to be uploaded beyond max_bytes.
+        Must be called with self._changed held.
+        """
+        if len(self._pending) > self.max_bytes:
+            dropped = len(self._pending) - self.max_bytes
+            del self._pending[:dropped]
+            self.dropped += dropped
+            self._unreported += dropped
+
+    def flush(self):
+        """Uploads the output written since the last upload to S3 as a new
+        chunk. Failed uploads are retried with the next chunk.
+        """
+        with self._upload_lock:
+            with self._changed:
+                data = bytes(self._pending)
+                unreported = self._unreported
+                offset = self._flushed
+                self._pending.clear()
+                self._unreported = 0
+                self._last_flush = time.time()
+            if not data:
+                return
+            body = data
+            if unreported:
+                body = f"[{unreported} bytes of log dropped because they couldn't be uploaded]\n".encode() + data
+            try:
+                get_boto3_client("s3").put_object(Bucket="xtract-container-service",
+                                                  Key=log_key(self.build_id, offset), Body=body)
+                self._flushed += len(body)
+            except Exception:
+                logging.error(f"Failed to upload the log of {self.build_id}", exc_info=True)
+                with self._changed:
+                    self._pending[:0] = data
+                    self._unreported += unreported
+                    self._drop_pending()
+
+    def read(self, offset):
+        """Returns the output kept in memory from a byte offset.
+
+        Parameters:
+        offset (int): Byte offset to read from.
+
+        Returns:
+        data (bytes): Output from offset or from the oldest byte still in
+        memory if offset was dropped from the buffer.
+        next_offset (int): Byte offset to read from next.
+        """
+        with self._changed:
+            start = self.size - len(self._buffer)
+            return bytes(self._buffer[max(0, offset - start):]), self.size
+
+    def wait(self, offset, timeout):
+        """Waits until output past a byte offset is written or the build
+        finishes.
+
+        Parameters:
+        offset (int): Byte offset already read.
+        timeout (float): Maximum number of seconds to wait.
+
+        Returns:
+        (bool): Whether there is output past offset or the build finished.
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: self.size > offset or self.closed, timeout)
+
+    def close(self):
+        """Uploads the rest of the log and marks the build finished."""
+        self.flush()
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+
+
+def open_log(build_id):
+    """Starts the log of a build, replacing the log of its previous build.
+
+    Parameters:
+    build_id (str): ID of the build.
+
+    Returns:
+    (BuildLog): Log to write the build's output to.
+    """
+    try:
+        s3 = get_boto3_client("s3")
+        old_chunks = [{"Key": key} for key, _ in _log_chunks(build_id)]
+        for start in range(0, len(old_chunks), 1000):
+            s3.delete_objects(Bucket="xtract-container-service", Delete={"Objects": old_chunks[start:start + 1000]})
+    except Exception:
+        logging.error(f"Failed to remove the previous log of {build_id}", exc_info=True)
+
+    build_log = BuildLog(build_id)
+    with _logs_lock:
+        _logs[build_id] = build_log
+    return build_log
+
+
+def close_log(build_log):
+    """Finishes the log of a build. Later reads of the log come from S3.
+
+    Parameters:
+    build_log (BuildLog): Log of the build.
+    """
+    try:
+        build_log.close()
+    finally:
+        with _logs_lock:
+            if _logs.get(build_log.build_id) is build_log:
+                del _logs[build_log.build_id]
+
+
+def get_log(build_id):
+    """Returns the log of a build running in this process.
+
+    Parameters:
+    build_id (str): ID of the build.
+
+    Returns:
+    (BuildLog): Log of the build or None if it isn't running here.
+    """
+    with _logs_lock:
+        return _logs.get(build_id)
+
+
+def _log_chunks(build_id):
+    s3 = get_boto3_client("s3")
+    chunks = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket="xtract-container-service",
+                                                             Prefix=f"{LOG_PREFIX}/{build_id}/"):
+        for s3_object in page.get("Contents", []):
+            chunks.append((s3_object["Key"], s3_object["Size"]))
+    return sorted(chunks)
+
+
+def read_log(build_id, offset=0):
+    """Reads a build's log from a byte offset, from memory if the build is
+    running in this process and from S3 otherwise.
+
+    Parameters:
+    build_id (str): ID of the build.
+    offset (int): Byte offset to read from. Negative offsets count from the
+    end of the log.
+
+    Returns:
+    data (bytes): Output from offset.
+    next_offset (int): Byte offset to read from next.
+    build_log (BuildLog): Log of the build if it is running in this process
+    or None.
+    """
+    build_log = get_log(build_id)
+    if build_log is not None:
+        if offset < 0:
+            offset = max(0, build_log.size + offset)
+        data, next_offset = build_log.read(offset)
+        return data, next_offset, build_log
+
+    chunks = _log_chunks(build_id)
+    size = sum(chunk_size for _, chunk_size in chunks)
+    if offset < 0:
+        offset = max(0, size + offset)
+
+    s3 = get_boto3_client("s3")
+    data = bytearray()
+    chunk_offset = 0
+    for key, chunk_size in chunks:
+        if chunk_offset + chunk_size > offset:
+            params = {"Bucket": "xtract-container-service", "Key": key}
+            if offset > chunk_offset:
+                params["Range"] = f"bytes={offset - chunk_offset}-"
+            data += s3.get_object(**params)["Body"].read()
+        chunk_offset += chunk_size
+
+    return bytes(data), max(offset, size), None
+
+
+def follow_log(build_id, offset=0, finished=None, poll_time=2, max_time=3600):
+    """Generates a build's log from a byte offset as it is written, until the
+    build finishes. Output of builds running in this process is sent as soon
+    as it is written and output of builds on other nodes as soon as its chunk
+    is uploaded.
+
+    Parameters:
+    build_id (str): ID of the build.
+    offset (int): Byte offset to start from. Negative offsets count from the
+    end of the log.
+    finished (function): Function returning whether the build finished.
+    It is only called when there is no new output.
+    poll_time (float): Number of seconds between reads of logs in S3.
+    max_time (float): Number of seconds after which the generator ends even
+    if the build hasn't finished.
+
+    Returns:
+    (generator (bytes)): Chunks of the log.
+    """
+    deadline = time.time() + max_time
+    while time.time() < deadline:
+        data, offset, build_log = read_log(build_id, offset)
+        if data:
+            yield data
+        elif build_log is not None and not build_log.closed:
+            build_log.wait(offset, min(15, max(0, deadline - time.time())))
+        elif finished is None or finished():
+            # Read once more so the output written before the build finished is always sent
+            data, offset, _ = read_log(build_id, offset)
+            if data:
+                yield data
+            return
+        else:
+            time.sleep(poll_time)
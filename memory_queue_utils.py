@@ -0,0 +1,132 @@
+import itertools
+import threading
+import time
+import uuid
+from sqs_queue_utils import Message
+
+
+class MemoryQueueClient:
+    """Queue client that keeps messages in memory with the same visibility
+    semantics as SQS, for running the service and the TaskManager without
+    AWS or a database. Messages are lost when the process exits.
+
+    Parameters:
+    queue_name (str): Name of the queue.
+    visibility_timeout (int): Number of seconds received messages stay
+    invisible when receive_batch isn't given a visibility timeout.
+
+    Attributes:
+    queue_name (str): Name of the queue.
+    visibility_timeout (int): Default visibility timeout in seconds.
+    """
+    def __init__(self, queue_name="xtract-container-service", visibility_timeout=300):
+        self.queue_name = queue_name
+        self.visibility_timeout = visibility_timeout
+        self._messages = {}
+        self._ids = itertools.count()
+        self._ready = threading.Condition()
+
+    def _visible(self, now):
+        return [message_id for message_id, message in self._messages.items() if message["visible_at"] <= now]
+
+    def receive_batch(self, n=10, wait_time=0, visibility_timeout=None):
+        """Receives up to n messages from the queue in the order they were
+        queued.
+
+        Parameters:
+        n (int): Maximum number of messages to receive.
+        wait_time (float): Number of seconds to wait for a message.
+        visibility_timeout (int): Number of seconds the messages stay
+        invisible to other receivers or None for the default.
+
+        Returns:
+        messages (list (Message)): List of received messages.
+        """
+        visibility_timeout = self.visibility_timeout if visibility_timeout is None else visibility_timeout
+        deadline = time.time() + wait_time
+        with self._ready:
+            while True:
+                now = time.time()
+                visible = self._visible(now)
+                if visible or now >= deadline:
+                    break
+                invisible = [message["visible_at"] for message in self._messages.values()]
+                self._ready.wait(min([deadline] + invisible) - now)
+
+            received = []
+            for message_id in sorted(visible)[:max(1, n)]:
+                message = self._messages[message_id]
+                message["receipt_handle"] = (message_id, str(uuid.uuid4()))
+                message["receive_count"] += 1
+                message["visible_at"] = now + visibility_timeout
+                received.append(Message(self, dict(message["body"]), message["receipt_handle"],
+                                        message["receive_count"]))
+
+        return received
+
+    def _received(self, receipt_handle):
+        message = self._messages.get(receipt_handle[0])
+        if message is None or message["receipt_handle"] != receipt_handle:
+            raise ValueError("Message was received again by another receiver or deleted")
+        return message
+
+    def delete_message(self, receipt_handle):
+        """Deletes a received message from the queue.
+
+        Parameters:
+        receipt_handle (tuple): Receipt handle of the message.
+        """
+        with self._ready:
+            self._received(receipt_handle)
+            del self._messages[receipt_handle[0]]
+
+    def change_message_visibility(self, receipt_handle, timeout):
+        """Sets the number of seconds until a received message is visible
+        again.
+
+        Parameters:
+        receipt_handle (tuple): Receipt handle of the message.
+        timeout (int): Seconds from now until the message can be received
+        again.
+        """
+        with self._ready:
+            self._received(receipt_handle)["visible_at"] = time.time() + timeout
+            self._ready.notify_all()
+
+    def put_message(self, message):
+        """Places a message on the queue.
+
+        Parameters:
+        message (dict): Message to queue.
+
+        Returns:
+        (dict): "MessageId" of the message.
+        """
+        with self._ready:
+            message_id = next(self._ids)
+            self._messages[message_id] = {"body": dict(message, queued_at=time.time()), "receive_count": 0,
+                                          "visible_at": 0, "receipt_handle": None}
+            self._ready.notify_all()
+        return {"MessageId": str(message_id)}
+
+    def send_batch(self, messages):
+        """Places messages on the queue.
+
+        Parameters:
+        messages (list (dict)): Messages to queue.
+
+        Returns:
+        failed (list (dict)): Always empty.
+        """
+        for message in messages:
+            self.put_message(message)
+        return []
+
+    def approximate_depth(self):
+        """Returns the number of visible messages in the queue.
+
+        Returns:
+        (int): Number of visible messages.
+        """
+        with self._ready:
+            return len(self._visible(time.time()))
@@ -0,0 +1,288 @@
+import bisect
+import functools
+import http.server
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+_metrics = []
+_metrics_lock = threading.Lock()
+
+
+def _format_labels(label_names, label_values, extra=""):
+    labels = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        labels.append(f'{name}="{value}"')
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class of Prometheus metrics. Metrics register themselves when
+    they are created so render_metrics includes them. Recording a sample
+    only takes a lock and a few additions, so metrics can be recorded on hot
+    paths.
+
+    Parameters:
+    name (str): Name of the metric.
+    documentation (str): Help text of the metric.
+    label_names (list (str)): Names of the labels of the metric.
+
+    Attributes:
+    name (str): Name of the metric.
+    documentation (str): Help text of the metric.
+    label_names (tuple (str)): Names of the labels of the metric.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _metrics_lock:
+            _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self):
+        """Returns the samples of the metric.
+
+        Returns:
+        (list (tuple)): (suffix, label values, extra label, value) of each
+        sample.
+        """
+        raise NotImplementedError
+
+    def render(self):
+        """Renders the metric in the Prometheus text format.
+
+        Returns:
+        (str): Lines of the metric.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, label_values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.label_names, label_values, extra)} "
+                         f"{_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Count of events that only goes up. Its name should end in _total."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Adds to the counter.
+
+        Parameters:
+        amount (float): Amount to add.
+        **labels (str): Values of the labels of the metric.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [("", key, "", value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """Value that goes up and down, computed by a function when it is
+    scraped.
+
+    Parameters:
+    name (str): Name of the metric.
+    documentation (str): Help text of the metric.
+    label_names (list (str)): Names of the labels of the metric.
+    function (function): Function returning a dict of values keyed by tuples
+    of label values, or a number if the gauge has no labels.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, label_names=(), function=None):
+        super().__init__(name, documentation, label_names)
+        self.function = function
+
+    def set_function(self, function):
+        """Sets the function computing the gauge.
+
+        Parameters:
+        function (function): Function returning a dict of values keyed by
+        tuples of label values, or a number if the gauge has no labels.
+        """
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return []
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [("", key, "", value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """Distribution of durations or sizes in cumulative buckets.
+
+    Parameters:
+    name (str): Name of the metric.
+    documentation (str): Help text of the metric.
+    label_names (list (str)): Names of the labels of the metric.
+    buckets (tuple (float)): Upper bounds of the buckets in increasing
+    order. A +Inf bucket is always added.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        """Records a sample.
+
+        Parameters:
+        value (float): Value of the sample.
+        **labels (str): Values of the labels of the metric.
+        """
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts[0][idx] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager recording how many seconds its body takes, even if
+        it raises.
+
+        Parameters:
+        **labels (str): Values of the labels of the metric.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def timed(self, **labels):
+        """Decorator recording how many seconds each call of a function takes.
+
+        Parameters:
+        **labels (str): Values of the labels of the metric.
+
+        Returns:
+        (function): Decorator.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def time_iter(self, iterable, **labels):
+        """Generates the items of an iterable, recording how many seconds it
+        took to exhaust or close it.
+
+        Parameters:
+        iterable (iterable): Items to generate.
+        **labels (str): Values of the labels of the metric.
+
+        Returns:
+        (generator): Items of iterable.
+        """
+        with self.time(**labels):
+            yield from iterable
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = sorted((key, (list(counts[0]), counts[1], counts[2])) for key, counts in self._values.items())
+        for key, (bucket_counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", key, f'le="{_format_value(bound)}"', cumulative))
+            samples.append(("_sum", key, "", total))
+            samples.append(("_count", key, "", count))
+        return samples
+
+
+def render_metrics():
+    """Renders every metric in the Prometheus text format.
+
+    Returns:
+    (str): Text of the metrics.
+    """
+    with _metrics_lock:
+        metrics = list(_metrics)
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+def serve_metrics(port):
+    """Serves render_metrics on /metrics from a daemon thread, for processes
+    without the API such as workers.
+
+    Parameters:
+    port (int): Port to listen on.
+
+    Returns:
+    (http.server.ThreadingHTTPServer): The server.
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+QUEUE_WAIT_SECONDS = Histogram("xcs_queue_wait_seconds", "Seconds between a task being queued and a thread "
+                               "starting it.", ["function"])
+CONTEXT_FETCH_SECONDS = Histogram("xcs_context_fetch_seconds", "Seconds to fetch a definition's build context "
+                                  "from S3 or the context cache.")
+BUILD_SECONDS = Histogram("xcs_build_seconds", "Seconds to build a container.", ["format"])
+PUSH_SECONDS = Histogram("xcs_push_seconds", "Seconds to push a Docker image to ECR.")
+UPLOAD_SECONDS = Histogram("xcs_upload_seconds", "Seconds to upload a file to S3.", ["kind"])
+EXPORT_SECONDS = Histogram("xcs_export_seconds", "Seconds to stream a container to a client.", ["format"])
+DB_TRANSACTION_SECONDS = Histogram("xcs_db_transaction_seconds", "Seconds pooled database connections are "
+                                   "checked out for a transaction.",
+                                   buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+AUTH_INTROSPECTION_SECONDS = Histogram("xcs_auth_introspection_seconds", "Seconds to introspect a token with "
+                                       "Globus Auth on a token cache miss.")
+WORKER_THREADS = Gauge("xcs_worker_threads", "Number of build threads by state.", ["state"])
+WORKER_THREAD_LIMIT = Gauge("xcs_worker_thread_limit", "Minimum and maximum number of build threads.", ["bound"])
+TASK_RETRIES = Counter("xcs_task_retries_total", "Number of failed task attempts that were retried.", ["function"])
+TASK_FAILURES = Counter("xcs_task_failures_total", "Number of tasks moved to the dead-letter queue.", ["function"])
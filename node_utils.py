@@ -0,0 +1,114 @@
+import datetime
+import logging
+import os
+import shutil
+import socket
+import threading
+import uuid
+from client_utils import get_docker_client
+from pg_utils import create_table_entry, select_all_rows, update_table_entry
+
+PROJECT_ROOT = os.path.realpath(os.path.dirname(__file__)) + "/"
+
+
+def detect_formats():
+    """Detects the container formats this machine can build. Docker needs a
+    reachable Docker daemon and Singularity needs the singularity binary.
+
+    Returns:
+    formats (list (str)): Formats this machine can build.
+    """
+    formats = []
+    try:
+        get_docker_client().ping()
+        formats.append("docker")
+    except Exception:
+        logging.warning("Docker daemon isn't reachable, not building Docker containers")
+    if shutil.which("singularity"):
+        formats.append("singularity")
+    else:
+        logging.warning("singularity isn't installed, not building Singularity containers")
+
+    return formats
+
+
+class NodeHeartbeat:
+    """Registers a build node in the node table and keeps its entry up to
+    date from a background thread, so the API and operators can see which
+    nodes are alive, what they can build and how busy they are.
+
+    Parameters:
+    manager (TaskManager): Task manager running the node's builds.
+    heartbeat_time (int): Number of seconds between heartbeats.
+    node_id (str): ID to register the node under. Defaults to a new UUID.
+
+    Attributes:
+    manager (TaskManager): Task manager running the node's builds.
+    heartbeat_time (int): Number of seconds between heartbeats.
+    node_id (str): ID the node is registered under.
+    """
+    def __init__(self, manager, heartbeat_time=15, node_id=None):
+        self.manager = manager
+        self.heartbeat_time = heartbeat_time
+        self.node_id = node_id if node_id is not None else str(uuid.uuid4())
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _status(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return {"formats": list(self.manager.formats), "cpu_count": os.cpu_count(),
+                "disk_free": shutil.disk_usage(PROJECT_ROOT).free,
+                "max_threads": self.manager.max_threads, "busy_threads": self.manager.busy_threads,
+                "held_tasks": len(self.manager.scheduler), "last_heartbeat": now}
+
+    def beat(self):
+        """Writes the node's current capacity and load to its entry."""
+        update_table_entry("node", self.node_id, node_status="running", **self._status())
+
+    def _run(self):
+        while not self._stop.wait(self.heartbeat_time):
+            try:
+                self.beat()
+            except Exception:
+                logging.error("Failed to send node heartbeat", exc_info=True)
+
+    def start(self):
+        """Registers the node and starts sending heartbeats."""
+        create_table_entry("node", node_id=self.node_id, hostname=socket.gethostname(), node_status="running",
+                           started_at=datetime.datetime.now(datetime.timezone.utc), **self._status())
+        logging.info(f"Registered node {self.node_id} building {self.manager.formats}")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops sending heartbeats and marks the node as stopped."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        update_table_entry("node", self.node_id, node_status="stopped",
+                           last_heartbeat=datetime.datetime.now(datetime.timezone.utc))
+        logging.info(f"Stopped node {self.node_id}")
+
+
+def list_nodes(max_age=60):
+    """Returns the entries of the registered nodes.
+
+    Parameters:
+    max_age (int): Number of seconds since its last heartbeat after which a
+    running node is considered dead.
+
+    Returns:
+    nodes (list (dict)): Node entries with an "alive" flag, timestamps
+    converted to ISO 8601 strings.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    nodes = []
+    for node in select_all_rows("node"):
+        node["alive"] = (node["node_status"] == "running" and node["last_heartbeat"] is not None and
+                         (now - node["last_heartbeat"]).total_seconds() <= max_age)
+        for column in ["started_at", "last_heartbeat"]:
+            if node[column] is not None:
+                node[column] = node[column].isoformat()
+        nodes.append(node)
+
+    return nodes
@@ -0,0 +1,197 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from pg_utils import get_connection, get_listener
+from sqs_queue_utils import Message
+
+JOB_TABLE = {"job_id": "BIGSERIAL PRIMARY KEY", "queue_name": "TEXT NOT NULL",
+             "body": "TEXT NOT NULL", "receive_count": "INT NOT NULL DEFAULT 0",
+             "visible_at": "TIMESTAMPTZ NOT NULL DEFAULT now()", "lease_token": "TEXT",
+             "queued_at": "TIMESTAMPTZ NOT NULL DEFAULT now()"}
+
+NOTIFY_CHANNEL = "xcs_jobs"
+
+_job_table_ready = False
+_job_table_lock = threading.Lock()
+
+
+def prep_job_table():
+    """Creates the jobs table and its claim index if they don't exist."""
+    global _job_table_ready
+    with _job_table_lock:
+        if _job_table_ready:
+            return
+        with get_connection() as conn:
+            cur = conn.cursor()
+            columns = [column + " " + JOB_TABLE[column] for column in JOB_TABLE]
+            cur.execute(f"""CREATE TABLE IF NOT EXISTS jobs ({", ".join(columns)})""")
+            cur.execute("CREATE INDEX IF NOT EXISTS jobs_claim_idx ON jobs (queue_name, visible_at, job_id)")
+            cur.close()
+        _job_table_ready = True
+        logging.info("Succesfully created jobs table")
+
+
+class PostgresQueueClient:
+    """Queue client that keeps jobs in the jobs table of the service's
+    PostgreSQL database. Any number of workers on any number of nodes can
+    claim jobs at once. Claims use SELECT ... FOR UPDATE SKIP LOCKED so each
+    job goes to one worker, and a claim is a lease that expires when the job's
+    visible_at passes. Each claim gets a new lease token, so a worker whose
+    lease expired can't delete or extend the job once someone else claims
+    it. Receivers wait on LISTEN/NOTIFY instead of polling.
+
+    Parameters:
+    queue_name (str): Name of the queue.
+    visibility_timeout (int): Number of seconds a claim lasts when
+    receive_batch isn't given a visibility timeout.
+    poll_time (float): Maximum number of seconds to wait for a notification
+    before checking for expired leases.
+
+    Attributes:
+    queue_name (str): Name of the queue.
+    visibility_timeout (int): Default lease length in seconds.
+    poll_time (float): Maximum number of seconds between claim attempts while
+    waiting.
+    """
+    def __init__(self, queue_name="xtract-container-service", visibility_timeout=300, poll_time=5):
+        self.queue_name = queue_name
+        self.visibility_timeout = visibility_timeout
+        self.poll_time = poll_time
+        prep_job_table()
+        self._listener = get_listener(NOTIFY_CHANNEL)
+
+    def _claim(self, n, visibility_timeout):
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""WITH claimed AS (
+                               SELECT job_id FROM jobs
+                               WHERE queue_name = %s AND visible_at <= now()
+                               ORDER BY job_id
+                               LIMIT %s
+                               FOR UPDATE SKIP LOCKED)
+                           UPDATE jobs
+                           SET visible_at = now() + %s * interval '1 second',
+                               receive_count = jobs.receive_count + 1,
+                               lease_token = %s
+                           FROM claimed
+                           WHERE jobs.job_id = claimed.job_id
+                           RETURNING jobs.job_id, jobs.body, jobs.receive_count, jobs.lease_token""",
+                        (self.queue_name, n, visibility_timeout, str(uuid.uuid4())))
+            rows = cur.fetchall()
+            cur.close()
+
+        return [Message(self, json.loads(body), (job_id, lease_token), receive_count)
+                for job_id, body, receive_count, lease_token in sorted(rows)]
+
+    def receive_batch(self, n=10, wait_time=0, visibility_timeout=None):
+        """Claims up to n jobs from the queue in the order they were queued.
+
+        Parameters:
+        n (int): Maximum number of jobs to claim.
+        wait_time (float): Number of seconds to wait for a job.
+        visibility_timeout (int): Number of seconds the claim lasts or None
+        for the default.
+
+        Returns:
+        messages (list (Message)): List of claimed jobs.
+        """
+        visibility_timeout = self.visibility_timeout if visibility_timeout is None else visibility_timeout
+        deadline = time.time() + wait_time
+        while True:
+            version = self._listener.version(self.queue_name)
+            messages = self._claim(max(1, n), visibility_timeout)
+            remaining_time = deadline - time.time()
+            if messages or remaining_time <= 0:
+                return messages
+            self._listener.wait(self.queue_name, version, min(remaining_time, self.poll_time))
+
+    def delete_message(self, receipt_handle):
+        """Deletes a claimed job.
+
+        Parameters:
+        receipt_handle (tuple): Job ID and lease token of the claim.
+        """
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM jobs WHERE job_id = %s AND lease_token = %s", receipt_handle)
+            deleted = cur.rowcount
+            cur.close()
+        if not deleted:
+            raise ValueError(f"Lease on job {receipt_handle[0]} expired")
+
+    def change_message_visibility(self, receipt_handle, timeout):
+        """Sets the number of seconds until a claimed job can be claimed
+        again.
+
+        Parameters:
+        receipt_handle (tuple): Job ID and lease token of the claim.
+        timeout (int): Seconds from now until the job can be claimed again.
+        """
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""UPDATE jobs SET visible_at = now() + %s * interval '1 second'
+                           WHERE job_id = %s AND lease_token = %s""",
+                        (timeout, *receipt_handle))
+            updated = cur.rowcount
+            if updated and timeout <= 0:
+                cur.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, self.queue_name))
+            cur.close()
+        if not updated:
+            raise ValueError(f"Lease on job {receipt_handle[0]} expired")
+
+    def put_message(self, message):
+        """Places a job on the queue.
+
+        Parameters:
+        message (dict): Message to queue.
+
+        Returns:
+        (dict): "MessageId" of the job.
+        """
+        return {"MessageId": str(self._insert([message])[0])}
+
+    def _insert(self, messages):
+        with get_connection() as conn:
+            cur = conn.cursor()
+            job_ids = []
+            for message in messages:
+                cur.execute("INSERT INTO jobs (queue_name, body) VALUES (%s, %s) RETURNING job_id",
+                            (self.queue_name, json.dumps(dict(message, queued_at=time.time()), default=str)))
+                job_ids.append(cur.fetchone()[0])
+            # Delivered when the transaction commits
+            cur.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, self.queue_name))
+            cur.close()
+
+        return job_ids
+
+    def send_batch(self, messages):
+        """Places jobs on the queue in one transaction.
+
+        Parameters:
+        messages (list (dict)): Messages to queue.
+
+        Returns:
+        failed (list (dict)): Always empty, either every job is queued or an
+        error is raised.
+        """
+        if messages:
+            self._insert(messages)
+        return []
+
+    def approximate_depth(self):
+        """Returns the number of jobs waiting to be claimed. Unlike SQS this
+        is exact.
+
+        Returns:
+        (int): Number of claimable jobs.
+        """
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT count(*) FROM jobs WHERE queue_name = %s AND visible_at <= now()",
+                        (self.queue_name,))
+            depth = cur.fetchone()[0]
+            cur.close()
+
+        return depth
@@ -1,28 +1,71 @@
 import os
 import logging
+import select
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 from configparser import ConfigParser
+from metrics_utils import DB_TRANSACTION_SECONDS
 
 
 DEFINITION_TABLE = {"definition_id": "TEXT PRIMARY KEY",
                     "definition_type": "TEXT", "definition_name": "TEXT",
                     "pre_containers": "TEXT []", "post_containers": "TEXT []",
                     "replaces_container": "TEXT []", "location": "TEXT",
-                    "definition_owner": "TEXT"}
+                    "definition_owner": "TEXT", "definition_hash": "TEXT"}
 
 BUILD_TABLE = {"build_id": "TEXT PRIMARY KEY",
                "definition_id": "TEXT REFERENCES definition(definition_id)",
-               "build_time": "TEXT", "build_version": "INT",
-               "last_built": "TEXT", "container_type": "TEXT",
+               "build_time": "TIMESTAMPTZ", "build_version": "INT",
+               "last_built": "TIMESTAMPTZ", "container_type": "TEXT",
                "container_size": "INT", "build_status": "TEXT",
                "container_owner": "TEXT", "build_location": "TEXT",
-               "container_name": "TEXT"}
+               "container_name": "TEXT", "definition_hash": "TEXT",
+               "cached_layers": "INT", "total_layers": "INT"}
+
+BUILD_GRAPH_TABLE = {"build_graph_id": "TEXT PRIMARY KEY",
+                     "root_definition_id": "TEXT REFERENCES definition(definition_id)",
+                     "graph_owner": "TEXT", "container_type": "TEXT",
+                     "nodes": "TEXT"}
+
+NODE_TABLE = {"node_id": "TEXT PRIMARY KEY", "hostname": "TEXT",
+              "formats": "TEXT []", "cpu_count": "INT",
+              "disk_free": "BIGINT", "max_threads": "INT",
+              "busy_threads": "INT", "held_tasks": "INT",
+              "node_status": "TEXT", "started_at": "TIMESTAMPTZ",
+              "last_heartbeat": "TIMESTAMPTZ"}
+
+TABLES = {"definition": DEFINITION_TABLE, "build": BUILD_TABLE, "build_graph": BUILD_GRAPH_TABLE,
+          "node": NODE_TABLE}
 
 build_schema = dict(zip(BUILD_TABLE.keys(), [None] * len(BUILD_TABLE)))
 definition_schema = dict(zip(DEFINITION_TABLE.keys(), [None] * len(DEFINITION_TABLE)))
 PROJECT_ROOT = os.path.realpath(os.path.dirname(__file__)) + "/"
 
+BUILD_STATUS_CHANNEL = "xcs_build_status"
+
+# A definition has at most one build per container format
+BUILD_KEY = ("definition_id", "container_type")
+
+# Columns of an existing build cleared when its definition is built again, and where the previous build time is kept
+BUILD_RESET_COLUMNS = ["build_status", "build_location", "container_size", "build_time", "definition_hash",
+                       "cached_layers", "total_layers"]
+BUILD_PREVIOUS_COLUMNS = {"build_time": "last_built"}
+
+# Held while migrating so concurrent processes apply each migration once
+MIGRATION_LOCK_ID = 7233
+
+_config_cache = {}
+_pool = None
+_pool_lock = threading.Lock()
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
 def config(config_file=os.path.join(PROJECT_ROOT, 'database.ini'),
            section='postgresql'):
     """Reads PosrgreSQL credentials from a .ini file.
@@ -34,6 +77,9 @@ def config(config_file=os.path.join(PROJECT_ROOT, 'database.ini'),
     Returns:
     credentials (dict (str)): Dictionary with credentials.
     """
+    if (config_file, section) in _config_cache:
+        return dict(_config_cache[(config_file, section)])
+
     parser = ConfigParser()
     parser.read(config_file)
 
@@ -47,7 +93,9 @@ def config(config_file=os.path.join(PROJECT_ROOT, 'database.ini'),
     else:
         raise Exception(f"Section {section} not found in the {config_file} file")
 
-    return credentials
+    _config_cache[(config_file, section)] = credentials
+
+    return dict(credentials)
 
 
 def create_connection(config_file=os.path.join(PROJECT_ROOT, 'database.ini')):
@@ -65,6 +113,202 @@ def create_connection(config_file=os.path.join(PROJECT_ROOT, 'database.ini')):
     return conn
 
 
+class ConnectionPool:
+    """Bounded, thread-safe pool of PostgreSQL connections. Returned
+    connections are kept open for reuse, up to max_connections.
+
+    Parameters:
+    min_connections (int): Number of connections to open up front.
+    max_connections (int): Maximum number of connections open at once.
+    Callers block until a connection is returned once this is reached.
+    health_check_time (int): Seconds a connection may sit idle before it is
+    checked with a "SELECT 1" on checkout.
+    config_file (str): Path to file to read credentials from.
+
+    Attributes:
+    max_connections (int): Maximum number of connections open at once.
+    health_check_time (int): Seconds a connection may sit idle before it is
+    checked on checkout.
+    """
+    def __init__(self, min_connections=1, max_connections=10, health_check_time=60,
+                 config_file=os.path.join(PROJECT_ROOT, 'database.ini')):
+        self.max_connections = max_connections
+        self.health_check_time = health_check_time
+        self._credentials = config(config_file=config_file)
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._idle = [psycopg2.connect(**self._credentials) for _ in range(min(min_connections, max_connections))]
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._reconnects = 0
+
+    def _healthy(self, conn):
+        """Checks whether a pooled connection is still usable.
+
+        Parameters:
+        conn (Connection Obj.): Connection to check.
+
+        Returns:
+        (bool): Whether the connection can be handed out.
+        """
+        if conn.closed:
+            return False
+        if time.time() - self._last_used.get(id(conn), time.time()) < self.health_check_time:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Checks a connection out of the pool, blocking while the pool is
+        exhausted.
+
+        Returns:
+        conn (Connection Obj.): Connection object to database.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._waits += 1
+            self._slots.acquire()
+
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            self._checkouts += 1
+
+        try:
+            if conn is not None and not self._healthy(conn):
+                self._last_used.pop(id(conn), None)
+                conn.close()
+                conn = None
+                with self._lock:
+                    self._reconnects += 1
+            if conn is None:
+                conn = psycopg2.connect(**self._credentials)
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+            raise
+
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Returns a connection to the pool.
+
+        Parameters:
+        conn (Connection Obj.): Connection to return.
+        close (bool): Whether to discard the connection instead of reusing it.
+        """
+        try:
+            if not close and not conn.closed and \
+                    conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            close = True
+        close = close or bool(conn.closed)
+        try:
+            if close:
+                self._last_used.pop(id(conn), None)
+                conn.close()
+            else:
+                self._last_used[id(conn)] = time.time()
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                if not close:
+                    self._idle.append(conn)
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks out a connection, commits on success,
+        rolls back on error and always returns it to the pool.
+
+        Yields:
+        conn (Connection Obj.): Connection object to database.
+        """
+        conn = self.getconn()
+        broken = False
+        start_time = time.perf_counter()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            DB_TRANSACTION_SECONDS.observe(time.perf_counter() - start_time)
+            self.putconn(conn, close=broken)
+
+    def stats(self):
+        """Returns pool utilization statistics.
+
+        Returns:
+        (dict): Maximum size, connections in use and idle, and counters for
+        checkouts, checkouts that had to wait and reconnects.
+        """
+        with self._lock:
+            return {"max_connections": self.max_connections,
+                    "in_use": self._in_use,
+                    "idle": len(self._idle),
+                    "checkouts": self._checkouts,
+                    "waits": self._waits,
+                    "reconnects": self._reconnects}
+
+    def closeall(self):
+        """Closes every idle connection held by the pool."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._last_used.pop(id(conn), None)
+            conn.close()
+
+
+def get_pool():
+    """Returns the process-wide connection pool, creating it on first use.
+
+    The pool size can be set with the XCS_DB_POOL_SIZE environment variable.
+
+    Returns:
+    (ConnectionPool): The shared connection pool.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(max_connections=int(os.environ.get("XCS_DB_POOL_SIZE", 10)))
+    return _pool
+
+
+def get_connection():
+    """Context manager for a pooled database connection.
+
+    Yields:
+    conn (Connection Obj.): Connection object to database.
+    """
+    return get_pool().connection()
+
+
+def pool_stats():
+    """Returns utilization statistics of the shared connection pool.
+
+    Returns:
+    (dict): Statistics from ConnectionPool.stats or an empty dict if no
+    pool has been created yet.
+    """
+    return _pool.stats() if _pool is not None else {}
+
+
 def table_exists(table_name):
     """Checks whether a table exists in the database.
 
@@ -74,19 +318,19 @@ def table_exists(table_name):
     Returns:
     (bool): Whether the table exists.
     """
-    conn = create_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM information_schema.tables WHERE TABLE_NAME=%s", (table_name,))
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM information_schema.tables WHERE TABLE_NAME=%s", (table_name,))
+        exists = bool(cur.rowcount)
+        cur.close()
 
-    return bool(cur.rowcount)
+    return exists
 
 
 def prep_database():
     """Creates tables containing Container and Build information
     using the conn object.
     """
-    conn = create_connection()
-    cur = conn.cursor()
     definition_table_columns = []
     build_table_columns = []
 
@@ -99,34 +343,154 @@ def prep_database():
     definition_command = f"""CREATE TABLE definition ({", ".join(definition_table_columns)})"""
     build_command = f"""CREATE TABLE build ({", ".join(build_table_columns)})"""
 
-    cur.execute(definition_command)
-    cur.execute(build_command)
-
-    cur.close()
-    conn.commit()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(definition_command)
+        cur.execute(build_command)
+        cur.close()
 
     logging.info("Succesfully created tables")
 
 
+def update_schema():
+    """Creates the tables in TABLES that don't exist and adds columns that
+    are in TABLES but missing from the tables in the database. New columns are always appended to the end of
+    the table dictionaries so their order matches the database.
+    """
+    with get_connection() as conn:
+        cur = conn.cursor()
+        for table_name, table in TABLES.items():
+            columns = [column + " " + table[column] for column in table]
+            cur.execute(f"""CREATE TABLE IF NOT EXISTS {table_name} ({", ".join(columns)})""")
+        for table_name, table in TABLES.items():
+            for column in table:
+                cur.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column} {table[column]}")
+        cur.close()
+
+    logging.info("Succesfully updated tables")
+    migrate()
+
+
+def _build_times_to_timestamptz(cur):
+    cur.execute("""SELECT column_name FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = 'build'
+                   AND column_name IN ('build_time', 'last_built') AND data_type = 'text'""")
+    for (column,) in cur.fetchall():
+        # Times were written with strftime("%m/%d/%Y, %H:%M:%S") in the server's local time
+        cur.execute(f"""ALTER TABLE build ALTER COLUMN {column} TYPE TIMESTAMPTZ
+                        USING to_timestamp(NULLIF({column}, ''), 'MM/DD/YYYY, HH24:MI:SS')""")
+
+
+def _index_build_lookups(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS build_owner_idx ON build (container_owner, build_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS build_hash_idx ON build (definition_hash, container_type)")
+
+
+def _unique_definition_builds(cur):
+    # Concurrent requests could create several builds of a definition for a format. The latest one is kept and the
+    # others are detached from the definition, so they can still be looked up by ID.
+    cur.execute(f"""UPDATE build SET definition_id = NULL
+                    WHERE build_id IN (
+                        SELECT build_id FROM (
+                            SELECT build_id, row_number() OVER (PARTITION BY {", ".join(BUILD_KEY)}
+                                                                ORDER BY build_time DESC NULLS LAST, build_id) AS rank
+                            FROM build WHERE definition_id IS NOT NULL) AS ranked
+                        WHERE rank > 1)""")
+    if cur.rowcount:
+        logging.warning(f"Detached {cur.rowcount} duplicate builds from their definitions")
+    # Its index also serves the lookups of a definition's build for a format
+    cur.execute(f"ALTER TABLE build ADD CONSTRAINT build_definition_format_key UNIQUE ({', '.join(BUILD_KEY)})")
+
+
+# (version, description, function applying the migration to a cursor), in the order they are applied
+MIGRATIONS = [(1, "Store build times as timestamptz", _build_times_to_timestamptz),
+              (2, "Index builds by owner and definition hash", _index_build_lookups),
+              (3, "Allow one build per definition and format", _unique_definition_builds)]
+
+
+def migrate():
+    """Applies the migrations in MIGRATIONS that haven't been applied to the
+    database yet, each in its own transaction, and records them in the
+    schema_migrations table. Processes starting at the same time wait for
+    each other, so every migration is applied once.
+
+    Returns:
+    (list (int)): Versions of the migrations applied.
+    """
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        cur.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                           version INT PRIMARY KEY, description TEXT,
+                           applied_at TIMESTAMPTZ NOT NULL DEFAULT now())""")
+        cur.close()
+
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+            if cur.fetchone() is None:
+                migration(cur)
+                cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                            (version, description))
+                applied.append(version)
+                logging.info(f"Applied migration {version}: {description}")
+            cur.close()
+
+    return applied
+
+
+def schema_version():
+    """Returns the version of the last migration applied to the database.
+
+    Returns:
+    (int): Version of the last migration or 0 if none were applied.
+    """
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute("SELECT coalesce(max(version), 0) FROM schema_migrations")
+            version = cur.fetchone()[0]
+        else:
+            version = 0
+        cur.close()
+
+    return version
+
+
+def notify_status(cur, table_name, id, columns):
+    """Notifies listeners of BUILD_STATUS_CHANNEL with the build ID when a
+    write changes a build's status. The notification is delivered when the
+    transaction commits.
+
+    Parameters:
+    cur (Cursor Obj.): Cursor of the transaction writing the entry.
+    table_name (str): Name of the table written to.
+    id (str): ID of the entry written.
+    columns (iterable (str)): Names of the columns written.
+    """
+    if table_name == "build" and "build_status" in columns:
+        cur.execute("SELECT pg_notify(%s, %s)", (BUILD_STATUS_CHANNEL, id))
+
+
 def create_table_entry(table_name, **columns):
     """Creates a new entry in a table.
 
     Parameters:
     table_name (str): Name of table to create an entry to. Currently
-    either "definition" or "build".
+    "definition", "build", "build_graph" or "node".
     **columns (str): The value to write passed with the name
     of the column to write to. E.g. id="1234a". If no value
     for a column is passed then None is defaulted.
     """
-    assert table_name in ["definition", "build"], "Not a valid table"
+    assert table_name in TABLES, "Not a valid table"
 
-    conn = create_connection()
     entry = []
 
-    if table_name == "definition":
-        table = DEFINITION_TABLE
-    elif table_name == "build":
-        table = BUILD_TABLE
+    table = TABLES[table_name]
 
     assert set(list(columns.keys())) <= set(table), "Column does not exist in table"
 
@@ -140,31 +504,111 @@ def create_table_entry(table_name, **columns):
 
     entry = tuple(entry)
 
-    cur = conn.cursor()
-    cur.execute(statement, entry)
-    conn.commit()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(statement, entry)
+        notify_status(cur, table_name, columns.get(f"{table_name}_id"), columns)
+        cur.close()
     logging.info(f"Successfully created entry to {table_name} table")
 
 
+def upsert_table_entries(table_name, entries, conflict_columns=None, update_columns=None, previous_columns=None,
+                         refuse_if=None):
+    """Creates several entries of a table with one multi-row INSERT. Entries
+    that conflict with an existing entry update it instead, so a find or
+    create is a single atomic statement.
+
+    Parameters:
+    table_name (str): Name of table to write to. Currently
+    "definition", "build", "build_graph" or "node".
+    entries (list (dict)): Entries to write, keyed by column name. Missing
+    columns are written as None. No two entries may conflict.
+    conflict_columns (iterable (str)): Columns of the unique constraint
+    entries conflict on. Defaults to the ID column.
+    update_columns (iterable (str)): Columns of a conflicting entry to
+    overwrite, clearing them where the new entry's value is None. Defaults
+    to every column but the conflict columns.
+    previous_columns (dict (str)): Columns to keep the existing value of an
+    overwritten column in, keyed by the overwritten column, e.g.
+    {"build_time": "last_built"}. They are left alone if the existing
+    value is None.
+    refuse_if (dict (iterable)): Values that keep an existing entry from
+    being overwritten, keyed by column, e.g. {"build_status": ["building"]}.
+
+    Returns:
+    rows (list (dict)): Entries as written, in no particular order.
+
+    Raises:
+    ValueError: If an entry conflicts with an existing entry that refuse_if
+    keeps from being overwritten. Nothing is written.
+    """
+    assert table_name in TABLES, "Not a valid table"
+
+    table = TABLES[table_name]
+    conflict_columns = list(conflict_columns or [f"{table_name}_id"])
+    if update_columns is None:
+        update_columns = [column for column in table if column not in conflict_columns]
+    previous_columns = previous_columns or {}
+    refuse_if = refuse_if or {}
+
+    for entry in entries:
+        assert set(entry) <= set(table), "Column does not exist in table"
+    assert set(conflict_columns) | set(update_columns) | set(previous_columns) | set(previous_columns.values()) \
+        | set(refuse_if) <= set(table), "Column does not exist in table"
+
+    if not entries:
+        return []
+
+    updates = [f"{column} = EXCLUDED.{column}" for column in update_columns]
+    updates.extend(f"{previous} = COALESCE({table_name}.{column}, {table_name}.{previous})"
+                   for column, previous in previous_columns.items())
+    updates = ", ".join(updates)
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        # Conflicting entries that aren't updated aren't returned either
+        refusals = [cur.mogrify(f"COALESCE({table_name}.{column} = ANY(%s), FALSE)", (list(values),)).decode()
+                    for column, values in refuse_if.items()]
+        where = f"WHERE NOT ({' OR '.join(refusals)})" if refusals else ""
+        statement = f"""INSERT INTO {table_name} ({", ".join(table)}) VALUES %s
+                    ON CONFLICT ({", ".join(conflict_columns)}) DO UPDATE SET {updates} {where}
+                    RETURNING *"""
+        results = psycopg2.extras.execute_values(cur, statement, [tuple(entry.get(column) for column in table)
+                                                                  for entry in entries],
+                                                 page_size=len(entries), fetch=True)
+        rows = [dict(zip(table, result)) for result in results]
+        if len(rows) < len(entries):
+            written = {tuple(row[column] for column in conflict_columns) for row in rows}
+            refused = [tuple(entry.get(column) for column in conflict_columns) for entry in entries
+                       if tuple(entry.get(column) for column in conflict_columns) not in written]
+            # Raised before committing so none of the entries are written
+            raise ValueError(f"Can't overwrite {table_name} entries {refused}")
+        if table_name == "build":
+            cur.execute("SELECT pg_notify(%s, build_id) FROM unnest(%s) AS build_id",
+                        (BUILD_STATUS_CHANNEL, [row["build_id"] for row in rows]))
+        cur.close()
+    logging.info(f"Successfully wrote {len(entries)} entries to {table_name} table")
+
+    return rows
+
+
 def update_table_entry(table_name, id, **columns):
     """Updates an existing table.
 
     Parameters:
     table_name (str): Name of table to create an entry to. Currently
-    either "definition" or "build".
+    "definition", "build", "build_graph" or "node".
     id (str): ID of the entry to change.
     **columns (str): The value to write passed with the name
     of the column to write to. E.g. recipe="1234a".
     """
-    assert table_name in ["definition", "build"], "Not a valid table"
+    assert table_name in TABLES, "Not a valid table"
 
     values = list(columns.values())
     columns = list(columns.keys())
+    column_names = columns
 
-    if table_name == "definition":
-        table = DEFINITION_TABLE
-    elif table_name == "build":
-        table = BUILD_TABLE
+    table = TABLES[table_name]
 
     assert set(columns) <= set(table), "Column does not exist in table"
 
@@ -174,10 +618,11 @@ def update_table_entry(table_name, id, **columns):
     statement = f"""UPDATE {table_name}
                 SET {columns}
                 WHERE {table_name}_id = %s"""
-    conn = create_connection()
-    cur = conn.cursor()
-    cur.execute(statement, tuple(values))
-    conn.commit()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(statement, tuple(values))
+        notify_status(cur, table_name, id, column_names)
+        cur.close()
     logging.info(f"Successfully inserted {values[:-1]} into entry with id {id}.")
 
 
@@ -186,26 +631,23 @@ def select_all_rows(table_name):
 
     Parameters:
     table_name (str): Name of table to create an entry to. Currently
-    either "definition" or "build".
+    "definition", "build", "build_graph" or "node".
 
     Returns:
     rows (list (dict)): List of dictionaries containing the
     columns and their values
     """
-    assert table_name in ["definition", "build"], "Not a valid table"
+    assert table_name in TABLES, "Not a valid table"
 
-    if table_name == "definition":
-        table = DEFINITION_TABLE
-    elif table_name == "build":
-        table = BUILD_TABLE
+    table = TABLES[table_name]
 
     rows = []
 
-    conn = create_connection()
-    cur = conn.cursor()
-    cur.execute(f"SELECT * FROM {table_name}")
-
-    results = cur.fetchall()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT * FROM {table_name}")
+        results = cur.fetchall()
+        cur.close()
 
     for result in results:
         rows.append(dict(zip(table, result)))
@@ -218,29 +660,26 @@ def search_array(table_name, array, value):
 
     Parameters:
     table_name (str): Name of table to create an entry to. Currently
-    either "definition" or "build".
+    "definition", "build", "build_graph" or "node".
     array (str): Name of array column to search.
     value: Value inside of array to search for.
 
     Returns:
     rows (list(dict)): List of rows that match the values.
     """
-    assert table_name in ["definition", "build"], "Not a valid table"
+    assert table_name in TABLES, "Not a valid table"
 
-    if table_name == "definition":
-        table = DEFINITION_TABLE
-    elif table_name == "build":
-        table = BUILD_TABLE
+    table = TABLES[table_name]
 
     assert array in table, "Array does not exist"
 
     rows = []
 
-    conn = create_connection()
-    cur = conn.cursor()
-    cur.execute(f"SELECT * FROM {table_name} WHERE '{value}'=ANY({array})")
-
-    results = cur.fetchall()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT * FROM {table_name} WHERE %s=ANY({array})", (value,))
+        results = cur.fetchall()
+        cur.close()
 
     for result in results:
         rows.append(dict(zip(table, result)))
@@ -255,19 +694,16 @@ def select_by_column(table_name, **columns):
 
     Parameters:
     table_name (str): Name of table to create an entry to. Currently
-    either "definition" or "build".
+    "definition", "build", "build_graph" or "node".
     **columns (str): The value to search passed with the value
     to search for. E.g. recipe="1234a".
 
     Returns:
     rows (list(dict)): List of rows that match the values.
     """
-    assert table_name in ["definition", "build"], "Not a valid table"
+    assert table_name in TABLES, "Not a valid table"
 
-    if table_name == "definition":
-        table = DEFINITION_TABLE
-    elif table_name == "build":
-        table = BUILD_TABLE
+    table = TABLES[table_name]
 
     values = list(columns.values())
     columns = list(columns.keys())
@@ -277,12 +713,12 @@ def select_by_column(table_name, **columns):
 
     rows = []
 
-    conn = create_connection()
-    cur = conn.cursor()
-    cur.execute(f"""SELECT * FROM {table_name} WHERE {"=%s AND ".join(columns) + "=%s"}""",
-                values)
-
-    results = cur.fetchall()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""SELECT * FROM {table_name} WHERE {"=%s AND ".join(columns) + "=%s"}""",
+                    values)
+        results = cur.fetchall()
+        cur.close()
 
     for result in results:
         rows.append(dict(zip(table, result)))
@@ -291,3 +727,177 @@ def select_by_column(table_name, **columns):
 
     return rows
 
+
+def select_by_any(table_name, column, values):
+    """Selects every row where a column matches any of a list of values.
+
+    Parameters:
+    table_name (str): Name of table to search. Currently
+    "definition", "build", "build_graph" or "node".
+    column (str): Name of column to match.
+    values (list): Values to match.
+
+    Returns:
+    rows (list(dict)): List of rows that match the values.
+    """
+    assert table_name in TABLES, "Not a valid table"
+
+    table = TABLES[table_name]
+
+    assert column in table, "Column does not exist in table"
+
+    rows = []
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT * FROM {table_name} WHERE {column} = ANY(%s)", (list(values),))
+        results = cur.fetchall()
+        cur.close()
+
+    for result in results:
+        rows.append(dict(zip(table, result)))
+
+    logging.info(f"Successfully queried {len(values)} values of {column}")
+
+    return rows
+
+
+def transition_table_entry(table_name, id, column, old_value, new_value):
+    """Atomically changes a column of an entry only if it has an expected
+    value.
+
+    Parameters:
+    table_name (str): Name of table to update. Currently
+    "definition", "build", "build_graph" or "node".
+    id (str): ID of the entry to change.
+    column (str): Name of the column to change.
+    old_value: Value the column must have for the change to be made.
+    new_value: Value to write to the column.
+
+    Returns:
+    (bool): Whether the entry was changed.
+    """
+    assert table_name in TABLES, "Not a valid table"
+    assert column in TABLES[table_name], "Column does not exist in table"
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""UPDATE {table_name}
+                    SET {column} = %s
+                    WHERE {table_name}_id = %s AND {column} = %s""", (new_value, id, old_value))
+        changed = cur.rowcount == 1
+        if changed:
+            notify_status(cur, table_name, id, [column])
+        cur.close()
+
+    return changed
+
+
+class NotificationListener:
+    """Holds a dedicated connection LISTENing on a notification channel and
+    wakes the threads waiting for notifications with a given payload, so
+    they don't have to poll the database. One listener per channel is shared
+    by the whole process.
+
+    Only the max_payloads most recently notified payloads are tracked, so
+    notifications about builds that finished long ago don't pile up in a
+    long-running process. A waiter whose payload is dropped wakes up early,
+    or at worst at its timeout, and checks the database again.
+
+    Parameters:
+    channel (str): Name of the channel to listen on.
+    max_payloads (int): Maximum number of payloads to track.
+
+    Attributes:
+    channel (str): Name of the channel listened on.
+    max_payloads (int): Maximum number of payloads tracked.
+    notifications (int): Number of notifications received.
+    """
+    def __init__(self, channel, max_payloads=10000):
+        self.channel = channel
+        self.max_payloads = max_payloads
+        self.notifications = 0
+        self._ready = threading.Condition()
+        self._versions = OrderedDict()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = create_connection()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f"LISTEN {self.channel}")
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    with self._ready:
+                        while conn.notifies:
+                            payload = conn.notifies.pop(0).payload
+                            self._versions[payload] = self._versions.get(payload, 0) + 1
+                            self._versions.move_to_end(payload)
+                            if len(self._versions) > self.max_payloads:
+                                self._versions.popitem(last=False)
+                            self.notifications += 1
+                        self._ready.notify_all()
+            except Exception:
+                logging.error(f"Listener on {self.channel} lost its connection", exc_info=True)
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def start(self):
+        """Starts the listening thread if it isn't running."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, daemon=True)
+                self._thread.start()
+
+    def version(self, payload):
+        """Returns the number of notifications received with a payload. Read
+        it before checking the database, then wait on it, so a notification
+        sent in between isn't missed.
+
+        Parameters:
+        payload (str): Payload of the notifications.
+
+        Returns:
+        (int): Number of notifications with payload.
+        """
+        with self._ready:
+            return self._versions.get(payload, 0)
+
+    def wait(self, payload, version, timeout):
+        """Waits until a notification with a payload arrives after version
+        was read.
+
+        Parameters:
+        payload (str): Payload of the notifications.
+        version (int): Version returned by version.
+        timeout (float): Maximum number of seconds to wait.
+
+        Returns:
+        (bool): Whether a notification arrived.
+        """
+        with self._ready:
+            return self._ready.wait_for(lambda: self._versions.get(payload, 0) != version, timeout)
+
+
+def get_listener(channel):
+    """Returns the process-wide listener of a notification channel, starting
+    it on first use.
+
+    Parameters:
+    channel (str): Name of the channel.
+
+    Returns:
+    (NotificationListener): Listener of channel.
+    """
+    with _listeners_lock:
+        if channel not in _listeners:
+            _listeners[channel] = NotificationListener(channel)
+            _listeners[channel].start()
+        return _listeners[channel]
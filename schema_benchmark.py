@@ -0,0 +1,154 @@
+"""Measures build table lookups before and after the schema migrations.
+
+Fills a build table in the pre-migration layout (no indexes but the primary
+key, times stored as text) with synthetic rows, times the lookups the API
+runs on every request, applies the migrations in pg_utils.MIGRATIONS and
+times them again. Everything happens in a scratch schema of the database in
+database.ini, which is dropped afterwards.
+
+Usage:
+    python schema_benchmark.py --rows 2000000 --queries 200
+"""
+import argparse
+import csv
+import hashlib
+import random
+import sys
+import time
+import uuid
+from pg_utils import BUILD_KEY, BUILD_TABLE, DEFINITION_TABLE, MIGRATIONS, create_connection
+
+SCHEMA = "xcs_schema_benchmark"
+OWNERS = 1000
+
+LOOKUPS = {"find_build": "SELECT * FROM build WHERE definition_id = %s AND container_type = %s",
+           "owner_build": "SELECT * FROM build WHERE container_owner = %s AND build_id = %s",
+           "cached_build": """SELECT * FROM build
+                              WHERE definition_hash = %s AND container_type = %s AND build_status = %s"""}
+
+
+def fill(cur, rows):
+    """Creates the pre-migration definition and build tables with a
+    definition per two builds, one per format.
+
+    Parameters:
+    cur (Cursor Obj.): Cursor with the scratch schema on its search path.
+    rows (int): Number of builds to create.
+    """
+    legacy_build_table = dict(BUILD_TABLE, build_time="TEXT", last_built="TEXT")
+    for table_name, table in [("definition", DEFINITION_TABLE), ("build", legacy_build_table)]:
+        cur.execute(f"""CREATE TABLE {table_name} ({", ".join(column + " " + table[column] for column in table)})""")
+
+    cur.execute("""INSERT INTO definition (definition_id, definition_type, definition_owner, definition_hash)
+                   SELECT 'definition-' || i, 'docker', 'owner-' || (i %% %s), md5(i::text)
+                   FROM generate_series(0, %s) AS i""", (OWNERS, rows // 2))
+    cur.execute("""INSERT INTO build (build_id, definition_id, container_type, container_owner, build_status,
+                                      build_time, definition_hash, build_location)
+                   SELECT 'build-' || i, 'definition-' || (i / 2), (ARRAY['docker', 'singularity'])[i %% 2 + 1],
+                          'owner-' || ((i / 2) %% %s), 'success',
+                          to_char(now() - i * interval '1 second', 'MM/DD/YYYY, HH24:MI:SS'),
+                          md5((i / 2)::text), 'build-' || i
+                   FROM generate_series(0, %s - 1) AS i""", (OWNERS, rows))
+    cur.execute("ANALYZE definition")
+    cur.execute("ANALYZE build")
+
+
+def time_lookups(cur, rows, queries):
+    """Times the lookups in LOOKUPS and the find or create of a build.
+
+    Parameters:
+    cur (Cursor Obj.): Cursor with the scratch schema on its search path.
+    rows (int): Number of builds in the table.
+    queries (int): Number of times to run each lookup.
+
+    Returns:
+    (dict (list (float))): Seconds each run took, keyed by lookup.
+    """
+    timings = {}
+    for name, query in LOOKUPS.items():
+        timings[name] = []
+        for _ in range(queries):
+            i = random.randrange(rows)
+            params = {"find_build": (f"definition-{i // 2}", "docker"),
+                      "owner_build": (f"owner-{(i // 2) % OWNERS}", f"build-{i}"),
+                      "cached_build": (hashlib.md5(str(i // 2).encode()).hexdigest(), "docker", "success")}[name]
+            start_time = time.perf_counter()
+            cur.execute(query, params)
+            cur.fetchall()
+            timings[name].append(time.perf_counter() - start_time)
+
+    # Before the unique constraint a find or create is a lookup followed by an insert, afterwards one upsert
+    timings["find_or_create"] = []
+    cur.execute(f"""SELECT count(*) FROM pg_constraint
+                    WHERE conname = 'build_definition_format_key' AND connamespace = '{SCHEMA}'::regnamespace""")
+    unique = cur.fetchone()[0] > 0
+    for _ in range(queries):
+        definition_id = f"definition-{random.randrange(rows // 2)}"
+        start_time = time.perf_counter()
+        if unique:
+            cur.execute(f"""INSERT INTO build (build_id, definition_id, container_type, build_status)
+                            VALUES (%s, %s, 'docker', 'pending')
+                            ON CONFLICT ({", ".join(BUILD_KEY)}) DO UPDATE SET build_status = EXCLUDED.build_status
+                            RETURNING *""", (str(uuid.uuid4()), definition_id))
+            cur.fetchall()
+        else:
+            cur.execute(LOOKUPS["find_build"], (definition_id, "docker"))
+            build_id = cur.fetchone()[0]
+            cur.execute("UPDATE build SET build_status = 'pending' WHERE build_id = %s", (build_id,))
+        timings["find_or_create"].append(time.perf_counter() - start_time)
+
+    return timings
+
+
+def percentile(values, fraction):
+    """Returns the value below which a fraction of values fall.
+
+    Parameters:
+    values (list (float)): Values.
+    fraction (float): Fraction between 0 and 1.
+
+    Returns:
+    (float): The percentile.
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["phase", "operation", "runs", "mean_ms", "p95_ms"])
+
+    conn = create_connection()
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"SET search_path TO {SCHEMA}")
+    try:
+        start_time = time.perf_counter()
+        fill(cur, args.rows)
+        writer.writerow(["setup", f"fill {args.rows} rows", 1, round((time.perf_counter() - start_time) * 1000, 1), ""])
+
+        for name, timings in time_lookups(cur, args.rows, args.queries).items():
+            writer.writerow(["before", name, len(timings), round(sum(timings) / len(timings) * 1000, 3),
+                             round(percentile(timings, 0.95) * 1000, 3)])
+
+        for version, description, migration in MIGRATIONS:
+            start_time = time.perf_counter()
+            migration(cur)
+            writer.writerow(["migrate", f"{version}: {description}", 1,
+                             round((time.perf_counter() - start_time) * 1000, 1), ""])
+        cur.execute("ANALYZE build")
+
+        for name, timings in time_lookups(cur, args.rows, args.queries).items():
+            writer.writerow(["after", name, len(timings), round(sum(timings) / len(timings) * 1000, 3),
+                             round(percentile(timings, 0.95) * 1000, 3)])
+    finally:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.close()
+        conn.close()
@@ -1,43 +1,499 @@
+import itertools
 import json
-import boto3
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from client_utils import get_boto3_client
 
+_queue_clients = {}
+_lock = threading.Lock()
 
-def get_message(queue_name="xtract-container-service"):
-    """Receives a message from an SQS queue.
+
+class MissingQueue(RuntimeError):
+    """Raised when a queue the service needs doesn't exist."""
+
+
+class Message:
+    """A message received from a queue. The message stays on the queue,
+    invisible to other receivers, until it is deleted or its visibility
+    timeout ends.
+
+    Parameters:
+    queue_client (QueueClient): Client of the queue the message came from,
+    of any backend.
+    body (dict): Decoded body of the message.
+    receipt_handle (str): Receipt handle of this receive of the message.
+    receive_count (int): Number of times the message has been received.
+
+    Attributes:
+    body (dict): Decoded body of the message.
+    receipt_handle (str): Receipt handle of this receive of the message.
+    receive_count (int): Number of times the message has been received.
+    """
+    def __init__(self, queue_client, body, receipt_handle, receive_count=1):
+        self.queue_client = queue_client
+        self.body = body
+        self.receipt_handle = receipt_handle
+        self.receive_count = receive_count
+
+    def delete(self):
+        """Deletes the message from the queue."""
+        self.queue_client.delete_message(self.receipt_handle)
+
+    def change_visibility(self, timeout):
+        """Sets the number of seconds until the message is visible again.
+
+        Parameters:
+        timeout (int): Seconds from now until the message can be received
+        again. 0 makes it visible immediately.
+        """
+        self.queue_client.change_message_visibility(self.receipt_handle, timeout)
+
+    @contextmanager
+    def heartbeat(self, timeout=300):
+        """Context manager that keeps the message invisible while a task runs
+        by extending its visibility timeout from a background thread. If the
+        process dies the heartbeat stops and the message becomes visible to
+        other workers within timeout seconds.
+
+        Parameters:
+        timeout (int): Visibility timeout to keep extending the message to.
+        """
+        stop = threading.Event()
+
+        def extend():
+            while not stop.wait(timeout / 3):
+                try:
+                    self.change_visibility(timeout)
+                except Exception:
+                    logging.error("Failed to extend message visibility", exc_info=True)
+
+        self.change_visibility(timeout)
+        thread = threading.Thread(target=extend, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+    def dead_letter(self, queue_name):
+        """Moves the message to a dead-letter queue.
+
+        Parameters:
+        queue_name (str): Name of the dead-letter queue.
+        """
+        get_queue_client(queue_name).put_message(self.body)
+        self.delete()
+
+
+class QueueClient:
+    """Client for an SQS queue that reuses one boto3 client and queue URL for
+    the whole process and receives and sends messages in batches.
+
+    Parameters:
+    queue_name (str): Name of the SQS queue.
+
+    Attributes:
+    queue_name (str): Name of the SQS queue.
+    """
+    def __init__(self, queue_name="xtract-container-service"):
+        self.queue_name = queue_name
+        self._client = None
+        self._queue_url = None
+
+    @property
+    def client(self):
+        """boto3 SQS client shared by every thread in the process."""
+        if self._client is None:
+            self._client = get_boto3_client("sqs")
+        return self._client
+
+    @property
+    def queue_url(self):
+        """URL of the queue, looked up once.
+
+        Raises:
+        MissingQueue: If the queue doesn't exist. Queues aren't created here
+        since they need a visibility timeout and a dead-letter redrive
+        policy.
+        """
+        if self._queue_url is None:
+            try:
+                self._queue_url = self.client.get_queue_url(QueueName=self.queue_name)["QueueUrl"]
+            except self.client.exceptions.QueueDoesNotExist:
+                raise MissingQueue(f"SQS queue {self.queue_name} doesn't exist")
+        return self._queue_url
+
+    def receive_batch(self, n=10, wait_time=0, visibility_timeout=None):
+        """Receives up to n messages from the queue.
+
+        Parameters:
+        n (int): Maximum number of messages to receive, at most 10.
+        wait_time (float): Number of seconds (at most 20) to long poll for,
+        rounded up to a whole second.
+        visibility_timeout (int): Number of seconds the messages stay
+        invisible to other receivers or None for the queue's default.
+
+        Returns:
+        messages (list (Message)): List of received messages. Messages are
+        not deleted from the queue until Message.delete is called.
+        """
+        params = {"QueueUrl": self.queue_url, "MaxNumberOfMessages": max(1, min(n, 10)),
+                  "WaitTimeSeconds": min(20, math.ceil(wait_time)), "AttributeNames": ["ApproximateReceiveCount"]}
+        if visibility_timeout is not None:
+            params["VisibilityTimeout"] = visibility_timeout
+        response = self.client.receive_message(**params)
+
+        return [Message(self, json.loads(message["Body"]), message["ReceiptHandle"],
+                        int(message.get("Attributes", {}).get("ApproximateReceiveCount", 1)))
+                for message in response.get("Messages", [])]
+
+    def delete_message(self, receipt_handle):
+        """Deletes a received message from the queue.
+
+        Parameters:
+        receipt_handle (str): Receipt handle of the message.
+        """
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle)
+
+    def change_message_visibility(self, receipt_handle, timeout):
+        """Sets the number of seconds until a received message is visible
+        again.
+
+        Parameters:
+        receipt_handle (str): Receipt handle of the message.
+        timeout (int): Seconds from now until the message can be received
+        again.
+        """
+        self.client.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle,
+                                              VisibilityTimeout=timeout)
+
+    def put_message(self, message):
+        """Places a message on the queue.
+
+        Parameters:
+        message (dict): Message to pass to SQS.
+
+        Returns:
+        response (dict): Response from SQS
+        """
+        return self.client.send_message(QueueUrl=self.queue_url,
+                                        MessageBody=json.dumps(dict(message, queued_at=time.time()), default=str))
+
+    def send_batch(self, messages):
+        """Places messages on the queue using as few requests as possible.
+
+        Parameters:
+        messages (list (dict)): Messages to pass to SQS.
+
+        Returns:
+        failed (list (dict)): Messages SQS failed to queue.
+        """
+        failed = []
+        for start in range(0, len(messages), 10):
+            chunk = messages[start:start + 10]
+            response = self.client.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{"Id": str(idx), "MessageBody": json.dumps(dict(message, queued_at=time.time()), default=str)}
+                         for idx, message in enumerate(chunk)])
+            failed.extend(chunk[int(entry["Id"])] for entry in response.get("Failed", []))
+
+        return failed
+
+    def approximate_depth(self):
+        """Returns the approximate number of messages waiting in the queue.
+
+        Returns:
+        (int): Approximate number of visible messages.
+        """
+        response = self.client.get_queue_attributes(QueueUrl=self.queue_url,
+                                                    AttributeNames=["ApproximateNumberOfMessages"])
+        return int(response["Attributes"]["ApproximateNumberOfMessages"])
+
+
+class MultiQueueClient:
+    """Receives from several queues as if they were one. Each queue has its
+    own receiver thread that long polls it while someone is waiting for
+    messages and adds what it receives to a shared buffer, so a message on
+    any of the queues is picked up as soon as it arrives and an idle worker
+    makes one long poll per queue every poll_time seconds. Used by workers
+    that pull tasks from the queue of each set of formats they can build.
+
+    Polls last no longer than the wait of the callers they were made for.
+    Messages nobody takes, because several queues returned at once or a poll
+    returned after its callers left, are made visible again right away
+    instead of sitting in the buffer where no heartbeat keeps them invisible.
+
+    Parameters:
+    queue_clients (list (QueueClient)): Clients of the queues to receive
+    from, of any backend.
+    poll_time (int): Maximum number of seconds (at most 20) each receiver
+    long polls its queue for.
+
+    Attributes:
+    queue_clients (list (QueueClient)): Clients of the queues to receive
+    from.
+    poll_time (int): Maximum number of seconds each receiver long polls its
+    queue for.
+    """
+    def __init__(self, queue_clients, poll_time=20):
+        self.queue_clients = list(queue_clients)
+        self.poll_time = poll_time
+        self._buffer = deque()
+        self._waiting = 0
+        self._wanted = 1
+        self._deadline = 0
+        self._visibility_timeout = None
+        self._closed = False
+        self._error = None
+        self._receivers = None
+        self._ready = threading.Condition()
+
+    def _start_receivers(self):
+        if self._receivers is None:
+            self._receivers = [threading.Thread(target=self._receive, args=(queue_client,), daemon=True)
+                               for queue_client in self.queue_clients]
+            for receiver in self._receivers:
+                receiver.start()
+
+    def _receive(self, queue_client):
+        while True:
+            with self._ready:
+                while not self._closed and (not self._waiting or self._buffer):
+                    self._ready.wait()
+                if self._closed:
+                    return
+                n, visibility_timeout = self._wanted, self._visibility_timeout
+                wait_time = min(self.poll_time, max(0, math.ceil(self._deadline - time.time())))
+
+            try:
+                messages = queue_client.receive_batch(n, wait_time=wait_time, visibility_timeout=visibility_timeout)
+            except Exception as e:
+                with self._ready:
+                    self._error = e
+                    self._ready.notify_all()
+                time.sleep(1)
+                continue
+
+            with self._ready:
+                closed = self._closed
+                if not closed and self._waiting:
+                    self._buffer.extend(messages)
+                    messages = []
+                    self._ready.notify_all()
+            release_messages(messages)
+            if closed:
+                return
+
+    def receive_batch(self, n=10, wait_time=0, visibility_timeout=None):
+        """Receives up to n messages from whichever queues have any, waiting
+        for the receivers to deliver some.
+
+        Parameters:
+        n (int): Maximum number of messages to receive.
+        wait_time (float): Number of seconds to wait for a message.
+        visibility_timeout (int): Number of seconds the messages stay
+        invisible to other receivers or None for each queue's default.
+
+        Returns:
+        messages (list (Message)): List of received messages.
+
+        Raises:
+        Exception: The error of a receiver that failed while no messages
+        were waiting.
+        """
+        deadline = time.time() + wait_time
+        leftovers = []
+        with self._ready:
+            self._start_receivers()
+            self._waiting += 1
+            self._deadline = max(self._deadline, deadline) if self._waiting > 1 else deadline
+            self._wanted = max(1, min(n, 10))
+            self._visibility_timeout = visibility_timeout
+            self._ready.notify_all()
+            try:
+                while not self._buffer and not self._closed:
+                    if self._error is not None:
+                        error, self._error = self._error, None
+                        raise error
+                    remaining_time = deadline - time.time()
+                    if remaining_time <= 0:
+                        break
+                    self._ready.wait(remaining_time)
+                messages = [self._buffer.popleft() for _ in range(min(max(1, n), len(self._buffer)))]
+            finally:
+                self._waiting -= 1
+                if not self._waiting:
+                    leftovers = list(self._buffer)
+                    self._buffer.clear()
+                self._ready.notify_all()
+
+        release_messages(leftovers)
+        return messages
+
+    def close(self):
+        """Stops the receivers and makes the messages they received but
+        nobody took visible to other workers again. Messages received by
+        polls still in flight are released when the polls return.
+        """
+        with self._ready:
+            self._closed = True
+            messages = list(self._buffer)
+            self._buffer.clear()
+            self._ready.notify_all()
+        release_messages(messages)
+
+    def approximate_depth(self):
+        """Returns the approximate number of messages waiting in all of the
+        queues, including those received but not yet taken.
+
+        Returns:
+        (int): Approximate number of visible messages.
+        """
+        with self._ready:
+            buffered = len(self._buffer)
+        return buffered + sum(queue_client.approximate_depth() for queue_client in self.queue_clients)
+
+
+def release_messages(messages):
+    """Makes received messages visible to other receivers again without
+    waiting for their visibility timeout.
+
+    Parameters:
+    messages (list (Message)): Messages to release.
+    """
+    for message in messages:
+        try:
+            message.change_visibility(0)
+        except Exception:
+            logging.error("Failed to release message", exc_info=True)
+
+
+def task_formats(message):
+    """Returns the container formats a worker must be able to build to run a
+    task.
 
     Parameters:
-    queue_name (str): Name of queue to pull off of.
+    message (dict): Message of the task.
 
     Returns:
-    message (dict): Dict. of received message.
+    (set (str)): Subset of {"docker", "singularity"}.
     """
-    sqs = boto3.resource('sqs')
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
-    response = queue.receive_messages(MaxNumberOfMessages=1)
+    if message.get("function_name") == "repo2docker_container":
+        return {"docker"}
+    elif message.get("to_format") == "both":
+        return {"docker", "singularity"}
+    elif message.get("to_format") in ["docker", "singularity"]:
+        return {message["to_format"]}
+    else:
+        return set()
+
+
+def format_queue_name(formats, queue_name="xtract-container-service"):
+    """Returns the name of the queue of tasks that need a set of formats.
+
+    Parameters:
+    formats (set (str)): Formats the tasks need.
+    queue_name (str): Name of the queue tasks that need no format go to.
+
+    Returns:
+    (str): queue_name followed by the sorted formats, e.g.
+    "xtract-container-service-docker-singularity".
+    """
+    return "-".join([queue_name] + sorted(formats))
+
 
-    if len(response) == 1:
-        response = response[0]
-        message = json.loads(response.body)
-        response.delete()
+def get_format_queue_client(formats, queue_name="xtract-container-service"):
+    """Returns a client receiving every task that can be run with a set of
+    formats, from the queue of each subset of the formats.
 
-        return message
+    Parameters:
+    formats (list (str)): Formats the worker can build.
+    queue_name (str): Name of the queue tasks that need no format go to.
+
+    Returns:
+    (MultiQueueClient): Client of the queues.
+    """
+    formats = sorted(set(formats))
+    subsets = [subset for size in range(len(formats), -1, -1) for subset in itertools.combinations(formats, size)]
+    return MultiQueueClient([get_queue_client(format_queue_name(subset, queue_name)) for subset in subsets])
+
+
+def queue_backend(backend):
+    """Returns the queue client class of a queue backend.
+
+    Parameters:
+    backend (str): "sqs", "postgres" or "memory".
+
+    Returns:
+    (type): QueueClient, PostgresQueueClient or MemoryQueueClient.
+    """
+    if backend == "sqs":
+        return QueueClient
+    elif backend == "postgres":
+        from pg_queue_utils import PostgresQueueClient
+        return PostgresQueueClient
+    elif backend == "memory":
+        from memory_queue_utils import MemoryQueueClient
+        return MemoryQueueClient
     else:
-        return None
+        raise ValueError(f"Unknown queue backend {backend}")
+
+
+def get_queue_client(queue_name="xtract-container-service"):
+    """Returns the process-wide client for a queue. The queue backend is read
+    from XCS_QUEUE_BACKEND, "sqs" by default, "postgres" to keep jobs in the
+    service's database or "memory" to run without AWS or a database.
+
+    Parameters:
+    queue_name (str): Name of the queue.
+
+    Returns:
+    (QueueClient): Client for queue_name.
+    """
+    with _lock:
+        if queue_name not in _queue_clients:
+            _queue_clients[queue_name] = queue_backend(os.environ.get("XCS_QUEUE_BACKEND", "sqs"))(queue_name)
+        return _queue_clients[queue_name]
 
 
 def put_message(message, queue_name="xtract-container-service"):
-    """Places a message on an SQS queue.
+    """Places a message on the queue of the formats its task needs, so only
+    workers that can build them receive it.
+
+    Parameters:
+    message (dict): Message to queue.
+    queue_name (str): Queue to put message on, before the formats are
+    appended.
+
+    Returns:
+    response (dict): Response from the queue backend
+    """
+    return get_queue_client(format_queue_name(task_formats(message), queue_name)).put_message(message)
+
+
+def put_messages(messages, queue_name="xtract-container-service"):
+    """Places several messages on the queues of the formats their tasks need
+    in batches of 10.
 
     Parameters:
-    message (dict): Message to pass to SQS.
-    queue_name (str): SQS to put message on.
+    messages (list (dict)): Messages to queue.
+    queue_name (str): Queue to put messages on, before the formats are
+    appended.
 
     Returns:
-    response (dict): Response from SQS
+    failed (list (dict)): Messages that failed to queue.
     """
-    message = json.dumps(message)
-    sqs = boto3.resource('sqs')
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
-    response = queue.send_message(MessageBody=message)
+    routed = {}
+    for message in messages:
+        routed.setdefault(format_queue_name(task_formats(message), queue_name), []).append(message)
 
-    return response
+    failed = []
+    for routed_queue_name, routed_messages in routed.items():
+        failed.extend(get_queue_client(routed_queue_name).send_batch(routed_messages))
+    return failed
@@ -0,0 +1,96 @@
+import json
+import time
+from pg_utils import BUILD_STATUS_CHANNEL, get_listener, select_by_column
+
+FINAL_STATUSES = {"success", "failed", "error", "cancelled"}
+ACTIVE_STATUSES = {"waiting", "pending", "building", "pushing"}
+
+
+def json_default(value):
+    """Serializes the values of database entries that json can't, such as
+    timestamps.
+
+    Parameters:
+    value: Value to serialize.
+
+    Returns:
+    (str): ISO 8601 string of a timestamp or str of anything else.
+    """
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def get_build(build_id, owner):
+    """Returns the build entry of a build owned by a user.
+
+    Parameters:
+    build_id (str): ID of the build.
+    owner (str): ID of the user requesting the build.
+
+    Returns:
+    (dict): Build entry or None if the user has no build build_id.
+    """
+    build_entry = select_by_column("build", container_owner=owner, build_id=build_id)
+    if build_entry is not None and len(build_entry) == 1:
+        return build_entry[0]
+    return None
+
+
+def wait_for_change(build_id, owner, build_status=None, timeout=30):
+    """Waits until the status of a build differs from a known status. Wakes
+    on the notifications update_table_entry sends when a build's status is
+    written, so the database is only queried when something changed.
+
+    Parameters:
+    build_id (str): ID of the build.
+    owner (str): ID of the user requesting the build.
+    build_status (str): Status the caller already knows or None to return
+    the current entry right away.
+    timeout (float): Maximum number of seconds to wait.
+
+    Returns:
+    (dict): Build entry, which still has build_status if the timeout passed,
+    or None if the user has no build build_id.
+    """
+    listener = get_listener(BUILD_STATUS_CHANNEL)
+    deadline = time.time() + timeout
+    while True:
+        version = listener.version(build_id)
+        build_entry = get_build(build_id, owner)
+        remaining_time = deadline - time.time()
+        if (build_entry is None or build_entry["build_status"] != build_status or
+                build_entry["build_status"] in FINAL_STATUSES or remaining_time <= 0):
+            return build_entry
+        listener.wait(build_id, version, remaining_time)
+
+
+def status_events(build_id, owner, keepalive_time=15, max_time=3600):
+    """Generates the server-sent events of a build's status transitions,
+    starting with its current status and ending once it reaches a final
+    status.
+
+    Parameters:
+    build_id (str): ID of the build.
+    owner (str): ID of the user requesting the build.
+    keepalive_time (float): Number of seconds without a transition after
+    which a comment is sent to keep the connection open.
+    max_time (float): Number of seconds after which the stream ends even if
+    the build hasn't finished. Clients reconnect to keep following it.
+
+    Returns:
+    (generator (str)): "status" events with the build entry as JSON data.
+    """
+    deadline = time.time() + max_time
+    build_status = None
+    while time.time() < deadline:
+        build_entry = wait_for_change(build_id, owner, build_status,
+                                      timeout=min(keepalive_time, max(0, deadline - time.time())))
+        if build_entry is None:
+            yield "event: error\ndata: \"Build ID not valid\"\n\n"
+            return
+        if build_entry["build_status"] == build_status:
+            yield ": keepalive\n\n"
+            continue
+        build_status = build_entry["build_status"]
+        yield f"event: status\ndata: {json.dumps(build_entry, default=json_default)}\n\n"
+        if build_status in FINAL_STATUSES:
+            return
@@ -1,100 +1,446 @@
-import docker
+import heapq
+import itertools
+import logging
 import threading
 import time
-import uuid
+from collections import deque
+from build_graph import advance_graph
 from container_handler import build_container, repo2docker_container
-from sqs_queue_utils import get_message
+from gc_utils import get_garbage_collector
+from image_cache_utils import get_image_cache
+from metrics_utils import QUEUE_WAIT_SECONDS, TASK_FAILURES, TASK_RETRIES, WORKER_THREAD_LIMIT, WORKER_THREADS
+from pg_utils import update_table_entry
+from sqs_queue_utils import get_format_queue_client, release_messages
+
+MAX_BACKOFF = 60
+
+
+def task_owner(task):
+    """Returns the ID of the user who submitted a task.
+
+    Parameters:
+    task (dict): Body of a task message.
+
+    Returns:
+    (str): Owner of the task or None if it has no owner.
+    """
+    if "build_entry" in task:
+        return task["build_entry"].get("container_owner")
+    return task.get("client_id")
+
+
+class FairScheduler:
+    """Schedules tasks fairly between the users who submitted them.
+
+    Tasks are kept in a queue per owner and owners are served round robin,
+    one task per turn, so an owner with hundreds of queued tasks gets the
+    same share of threads as an owner with one. Priorities only order the
+    tasks within an owner's queue, highest first, so an owner can't take
+    other owners' turns by raising the priority of its tasks.
+
+    Parameters:
+    max_owner_tasks (int): Maximum number of tasks of one owner to run at
+    once or None for no limit.
+
+    Attributes:
+    max_owner_tasks (int): Maximum number of tasks of one owner to run at once.
+    """
+    def __init__(self, max_owner_tasks=None):
+        self.max_owner_tasks = max_owner_tasks
+        self._queues = {}
+        self._order = deque()
+        self._running = {}
+        self._waits = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def add(self, message):
+        """Adds a task to its owner's queue.
+
+        Parameters:
+        message (Message): Message of the task.
+        """
+        owner = task_owner(message.body)
+        if owner not in self._queues:
+            self._queues[owner] = []
+            self._order.append(owner)
+        heapq.heappush(self._queues[owner], (-int(message.body.get("priority", 0)), next(self._counter), message))
+
+    def pop(self):
+        """Removes the next task to run.
+
+        Returns:
+        (tuple): Owner and message of the next task or None if every queued
+        task belongs to an owner already running max_owner_tasks tasks.
+        """
+        eligible = [owner for owner in self._order
+                    if self.max_owner_tasks is None or self._running.get(owner, 0) < self.max_owner_tasks]
+        if not eligible:
+            return None
+
+        owner = eligible[0]
+        _, _, message = heapq.heappop(self._queues[owner])
+
+        self._order.remove(owner)
+        if self._queues[owner]:
+            self._order.append(owner)
+        else:
+            del self._queues[owner]
+        self._running[owner] = self._running.get(owner, 0) + 1
+
+        queued_at = message.body.get("queued_at")
+        if queued_at is not None:
+            count, total, longest = self._waits.get(owner, (0, 0, 0))
+            wait = time.time() - queued_at
+            self._waits[owner] = (count + 1, total + wait, max(longest, wait))
+
+        return owner, message
+
+    def done(self, owner):
+        """Marks a task of an owner as finished.
+
+        Parameters:
+        owner (str): Owner of the finished task.
+        """
+        self._running[owner] -= 1
+        if self._running[owner] == 0:
+            del self._running[owner]
+
+    def clear(self):
+        """Removes every queued message. Running tasks are still counted
+        until they are marked as finished.
+
+        Returns:
+        (list (Message)): Messages that were queued.
+        """
+        messages = self.messages()
+        self._queues.clear()
+        self._order.clear()
+        return messages
+
+    def messages(self):
+        """Returns every queued message.
+
+        Returns:
+        (list (Message)): Queued messages.
+        """
+        return [message for queue in self._queues.values() for _, _, message in queue]
+
+    def stats(self):
+        """Returns per-owner scheduling statistics.
+
+        Returns:
+        (dict): For each owner, the number of queued and running tasks and
+        the number, mean and max of seconds tasks waited to start.
+        """
+        owners = set(self._queues) | set(self._running) | set(self._waits)
+        stats = {}
+        for owner in owners:
+            count, total, longest = self._waits.get(owner, (0, 0, 0))
+            stats[str(owner)] = {"queued": len(self._queues.get(owner, [])),
+                                 "running": self._running.get(owner, 0),
+                                 "started": count,
+                                 "mean_wait": total / count if count else None,
+                                 "max_wait": longest if count else None}
+        return stats
 
 
 class TaskManager:
-    """Manager for threads and various container building tasks.
+    """Manager for a pool of threads performing container building tasks.
+
+    The pool keeps between min_threads and max_threads threads running and
+    scales with the number of tasks in flight and waiting on the queue.
 
     Parameters:
     max_threads (int): Maximum number of threads to run.
-    idle_time (int): Time to wait before idling a thread.
-    kill_time (int): Time to wait before killing a thread.
+    min_threads (int): Number of threads to keep running while idle.
+    kill_time (int): Time to wait before killing a thread above min_threads.
     max_retry (int): Max number of retries for a function.
+    wait_time (int): Number of seconds (at most 20) an idle thread long polls
+    SQS for before checking whether it should die.
+    visibility_timeout (int): Number of seconds a task stays invisible on SQS
+    after its worker stops sending heartbeats.
+    dead_letter_queue (str): Name of the SQS queue that tasks which failed
+    more than max_retry times are moved to.
+    queue_client (QueueClient): Client of the queue to pull tasks from.
+    Defaults to the xtract-container-service queues of the tasks this node
+    can run.
+    formats (list (str)): Container formats this node can build. Only tasks
+    that need no other formats are received. Defaults to docker and
+    singularity.
+    max_owner_threads (int): Maximum number of threads running tasks of one
+    owner at once or None for no limit.
+    max_held (int): Maximum number of tasks received from SQS and waiting in
+    the scheduler.
 
     Attributes:
     max_threads (int): Maximum number of threads to run.
-    idle_time (int): Time to wait before idling a thread.
-    kill_time (int): Time to wait before killing a thread.
+    min_threads (int): Number of threads to keep running while idle.
+    kill_time (int): Time to wait before killing a thread above min_threads.
     max_retry (int): Max number of retries for a function.
+    wait_time (int): Number of seconds an idle thread long polls SQS for.
+    visibility_timeout (int): Number of seconds a task stays invisible on SQS
+    after its worker stops sending heartbeats.
+    dead_letter_queue (str): Name of the dead-letter SQS queue.
+    formats (list (str)): Container formats this node can build.
     total_threads (int): The number of currently running threads.
-    pruning (bool): Whether a pruning job is currently running.
+    idle_threads (int): The number of threads waiting on SQS for a task.
+    busy_threads (int): The number of threads performing a task.
+    queue_latencies (deque (float)): Seconds between the most recent tasks
+    being queued and a thread starting them.
+    functions (dict): Functions that tasks can run, keyed by the
+    function_name of the task.
+    scheduler (FairScheduler): Scheduler of the tasks received from SQS.
+    max_held (int): Maximum number of tasks waiting in the scheduler.
     """
-    def __init__(self, max_threads=5, kill_time=180, max_retry=1):
-        print(self)
+    def __init__(self, max_threads=5, min_threads=0, kill_time=180, max_retry=1, wait_time=20,
+                 visibility_timeout=300, dead_letter_queue="xtract-container-service-dlq", queue_client=None,
+                 formats=("docker", "singularity"), max_owner_threads=None, max_held=100):
         self.max_threads = max_threads
+        self.min_threads = min(min_threads, max_threads)
         self.kill_time = kill_time
         self.max_retry = max_retry
-        self.thread_status = {"hello": "k"}
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.dead_letter_queue = dead_letter_queue
+        self.formats = list(formats)
+        self.queue_client = queue_client if queue_client is not None else get_format_queue_client(self.formats)
         self.total_threads = 0
-        self.pruning = False
+        self.idle_threads = 0
+        self.busy_threads = 0
+        self.queue_latencies = deque(maxlen=1000)
+        self.functions = {"build_container": build_container,
+                          "repo2docker_container": repo2docker_container}
+        self.scheduler = FairScheduler(max_owner_threads)
+        self.max_held = max_held
+        self._lock = threading.Lock()
+        self._task_ready = threading.Condition()
+        self._receiving = False
+        self._draining = False
+        self._hold_thread = None
 
     def execute_work(self):
-        """Pulls down a message from SQS and performs a task. Automatically
-        dies when it hasn't performed a task in self.kill_time seconds.
+        """Long polls SQS for a message and performs a task, polling again as
+        soon as the task finishes. Automatically dies when it hasn't performed
+        a task in self.kill_time seconds and more than min_threads threads are
+        running, or when the pool has been resized below the number of
+        running threads. Errors receiving or finishing a task are logged and
+        retried after a backoff instead of killing the thread.
         """
-        thread_id = str(uuid.uuid4())
-        self.thread_status[thread_id] = "WORKING"
         start_time = time.time()
+        failures = 0
+        exited = False
+        try:
+            while True:
+                with self._lock:
+                    idle_time = time.time() - start_time
+                    if (self.total_threads > self.max_threads or
+                            (idle_time >= self.kill_time and self.total_threads > self.min_threads)):
+                        self.total_threads -= 1
+                        exited = True
+                        break
+                    self.idle_threads += 1
+                    prefetch = self.idle_threads
+
+                try:
+                    task = None
+                    try:
+                        task = self.get_task(wait_time=max(0, min(self.wait_time, int(self.kill_time - idle_time))),
+                                             max_prefetch=prefetch)
+                    finally:
+                        with self._lock:
+                            self.idle_threads -= 1
+
+                    if task is not None:
+                        owner, message = task
+                        with self._lock:
+                            self.busy_threads += 1
+                        try:
+                            self.run_task(message)
+                        finally:
+                            with self._lock:
+                                self.busy_threads -= 1
+                            with self._task_ready:
+                                self.scheduler.done(owner)
+                                self._task_ready.notify_all()
+                        start_time = time.time()
+                    failures = 0
+                except Exception:
+                    failures += 1
+                    logging.error(f"Worker thread failed {failures} times in a row", exc_info=True)
+                    time.sleep(min(MAX_BACKOFF, 2 ** (failures - 1)))
+        finally:
+            if not exited:
+                with self._lock:
+                    self.total_threads -= 1
+
+    def get_task(self, wait_time=0, max_prefetch=1):
+        """Returns the next task chosen by the scheduler, receiving a batch of
+        tasks from SQS when the scheduler has none that can run. Only one
+        thread receives from SQS at a time and the others wait for the tasks
+        it receives.
+
+        Parameters:
+        wait_time (int): Number of seconds (at most 20) to wait for a task.
+        max_prefetch (int): Maximum number of tasks to receive at once.
+
+        Returns:
+        (tuple): Owner and message of the task or None if there is no task.
+        """
+        deadline = time.time() + wait_time
         while True:
-            if time.time() - start_time >= self.kill_time:
-                break
-            elif not self.pruning:
-                task = get_message()
-                if task is not None:
-                    self.thread_status[thread_id] = "WORKING"
-                    function_name = task.pop("function_name")
-
-                    args = []
-                    for arg in task:
-                        args.append(task[arg])
-
-                    if function_name == "build_container":
-                        attempt_num = 0
-                        while attempt_num <= self.max_retry:
-                            try:
-                                build_container(*args)
-                                break
-                            except:
-                                attempt_num += 1
-                    elif function_name == "repo2docker_container":
-                        repo2docker_container(*args)
-                    else:
+            with self._task_ready:
+                while True:
+                    if self._draining:
+                        return None
+                    task = self.scheduler.pop()
+                    if task is not None:
+                        return task
+                    if not self._receiving and len(self.scheduler) < self.max_held:
+                        self._receiving = True
                         break
-                    start_time = time.time()
-                else:
-                    self.thread_status[thread_id] = "IDLE"
-                    continue
+                    remaining_time = deadline - time.time()
+                    if remaining_time <= 0:
+                        return None
+                    self._task_ready.wait(remaining_time)
 
-            time.sleep(5)
+            messages = []
+            try:
+                messages = self.queue_client.receive_batch(min(max_prefetch, self.max_held - len(self.scheduler)),
+                                                           wait_time=max(0, int(deadline - time.time())),
+                                                           visibility_timeout=self.visibility_timeout)
+            finally:
+                with self._task_ready:
+                    self._receiving = False
+                    draining = self._draining
+                    if not draining:
+                        for message in messages:
+                            self.scheduler.add(message)
+                    self._task_ready.notify_all()
+            if draining:
+                release_messages(messages)
+                return None
+            if not messages:
+                return None
+            self._start_hold_thread()
+
+    def hold_task(self):
+        """Task that keeps the messages waiting in the scheduler invisible on
+        SQS by extending their visibility timeout.
+        """
+        while True:
+            time.sleep(self.visibility_timeout / 3)
+            with self._task_ready:
+                messages = self.scheduler.messages()
+            for message in messages:
+                try:
+                    message.change_visibility(self.visibility_timeout)
+                except Exception:
+                    logging.error("Failed to extend message visibility", exc_info=True)
 
-        self.total_threads -= 1
-        del self.thread_status[thread_id]
-        return
+    def _start_hold_thread(self):
+        with self._lock:
+            if self._hold_thread is None:
+                self._hold_thread = threading.Thread(target=self.hold_task, daemon=True)
+                self._hold_thread.start()
+
+    def run_task(self, message):
+        """Performs the task in an SQS message. The message is only deleted
+        once the task finishes, and its visibility is extended while the task
+        runs, so a task whose worker dies is picked up by another worker. A
+        task that fails is made visible again to be retried, and is moved to
+        the dead-letter queue after failing more than max_retry times.
+
+        Parameters:
+        message (Message): Message received from SQS.
+        """
+        task = dict(message.body)
+        function_name = task.pop("function_name")
+        queued_at = task.pop("queued_at", None)
+        priority = task.pop("priority", 0)
+        build_graph_id = task.pop("build_graph_id", None)
+        if queued_at is not None and message.receive_count == 1:
+            latency = time.time() - queued_at
+            self.queue_latencies.append(latency)
+            QUEUE_WAIT_SECONDS.observe(latency, function=function_name)
+            logging.info(f"Started {function_name} {latency} seconds after it was queued")
+
+        finished = True
+        if message.receive_count > self.max_retry + 1:
+            self.dead_letter(message)
+            self.advance(build_graph_id, priority)
+            return
+
+        try:
+            with message.heartbeat(self.visibility_timeout):
+                if function_name not in self.functions:
+                    raise ValueError(f"Unknown function {function_name}")
+                self.functions[function_name](**task)
+        except Exception:
+            logging.error(f"Attempt {message.receive_count} of {function_name} failed", exc_info=True)
+            if message.receive_count > self.max_retry:
+                self.dead_letter(message)
+            else:
+                TASK_RETRIES.inc(function=function_name)
+                message.change_visibility(0)
+                finished = False
+        else:
+            message.delete()
+
+        if finished:
+            self.advance(build_graph_id, priority)
+
+    def advance(self, build_graph_id, priority=0):
+        """Queues the builds that were waiting on a finished build of a build
+        graph.
+
+        Parameters:
+        build_graph_id (str): ID of the build graph or None if the finished
+        task wasn't part of one.
+        priority (int): Priority of the finished task.
+        """
+        if build_graph_id is None:
+            return
+        try:
+            advance_graph(build_graph_id, priority)
+        except Exception:
+            logging.error(f"Failed to advance build graph {build_graph_id}", exc_info=True)
+
+    def dead_letter(self, message):
+        """Moves a task that can't be completed to the dead-letter queue and
+        marks its build as failed.
+
+        Parameters:
+        message (Message): Message received from SQS.
+        """
+        logging.error(f"Moving {message.body.get('function_name')} to {self.dead_letter_queue} "
+                      f"after {message.receive_count} attempts")
+        TASK_FAILURES.inc(function=message.body.get("function_name"))
+        if "build_entry" in message.body:
+            build_id = message.body["build_entry"]["build_id"]
+        else:
+            build_id = message.body.get("build_id")
+        if build_id is not None:
+            update_table_entry("build", build_id, build_status="failed")
+        message.dead_letter(self.dead_letter_queue)
 
     def prune_task(self, prune_time):
-        """Task that periodically runs pruning commands.
+        """Task that periodically evicts the least recently used Docker images
+        beyond the size of the image cache and frees disk space when the disk
+        fills up. Workers keep running while it prunes.
 
         Parameters:
         prune_time (int): Amount of time to wait before pruning containers.
         """
-        thread_id = f"PRUNE_THREAD_{str(uuid.uuid4())}"
-        self.thread_status[thread_id] = "IDLE"
-        client = docker.from_env()
-
         while True:
-            if any([self.thread_status[thread] == "WORKING" for thread in self.thread_status]):
-                time.sleep(prune_time)
-            else:
-                self.thread_status[thread_id] = "WORKING"
-                self.pruning = True
-                client.images.prune()
-                self.pruning = False
-                self.thread_status[thread_id] = "IDLE"
-                time.sleep(prune_time)
+            try:
+                get_image_cache().prune()
+                get_garbage_collector().collect()
+            except Exception:
+                logging.error("Failed to prune", exc_info=True)
+            time.sleep(prune_time)
 
     def start_prune_thread(self, prune_time):
         """Starts a daemon thread running the prune_task method.
@@ -105,8 +451,136 @@ class TaskManager:
         threading.Thread(target=self.prune_task, args=(prune_time,), daemon=True).start()
 
     def start_thread(self):
-        """Starts a thread to do work.
+        """Starts a thread to do work unless a thread is already idle. Idle
+        threads are blocked in an SQS long poll, which returns as soon as a
+        message is queued, so they pick up new work without a new thread.
         """
-        if self.total_threads < self.max_threads:
-            threading.Thread(target=self.execute_work).start()
+        with self._lock:
+            if self.idle_threads > 0 or self.total_threads >= self.max_threads:
+                return
             self.total_threads += 1
+        threading.Thread(target=self.execute_work, daemon=True).start()
+
+    def scale(self):
+        """Starts threads until there is one for every task in flight or
+        waiting on the queue, within min_threads and max_threads. Threads
+        above that number die on their own once they have been idle for
+        kill_time seconds.
+
+        Returns:
+        (int): Number of threads started.
+        """
+        with self._task_ready:
+            held = len(self.scheduler)
+        queue_depth = self.queue_client.approximate_depth() + held
+        with self._lock:
+            target = min(self.max_threads, max(self.min_threads, self.busy_threads + queue_depth))
+            new_threads = max(0, target - self.total_threads)
+            self.total_threads += new_threads
+
+        for _ in range(new_threads):
+            threading.Thread(target=self.execute_work, daemon=True).start()
+
+        return new_threads
+
+    def scale_task(self, scale_time):
+        """Task that periodically scales the pool to the queue depth.
+
+        Parameters:
+        scale_time (int): Amount of time to wait between scaling.
+        """
+        while True:
+            try:
+                self.scale()
+            except Exception:
+                logging.error("Failed to scale threads", exc_info=True)
+            time.sleep(scale_time)
+
+    def start_scale_thread(self, scale_time):
+        """Starts a daemon thread running the scale_task method.
+
+        Parameters:
+        scale_time (int): Amount of time to wait between scaling.
+        """
+        threading.Thread(target=self.scale_task, args=(scale_time,), daemon=True).start()
+
+    def resize(self, max_threads=None, min_threads=None):
+        """Changes the size of the pool without interrupting running threads.
+        Extra threads finish their current task before dying.
+
+        Parameters:
+        max_threads (int): New maximum number of threads or None to keep it.
+        min_threads (int): New minimum number of threads or None to keep it.
+        """
+        with self._lock:
+            if max_threads is not None:
+                self.max_threads = max_threads
+            if min_threads is not None:
+                self.min_threads = min_threads
+            self.min_threads = min(self.min_threads, self.max_threads)
+        self.scale()
+
+    def drain(self):
+        """Stops receiving tasks and shrinks the pool to zero threads. Tasks
+        received but not started are made visible again so other nodes can
+        run them right away. Running tasks keep running, and their threads
+        die once they finish.
+        """
+        with self._task_ready:
+            self._draining = True
+            messages = self.scheduler.clear()
+            self._task_ready.notify_all()
+        self.resize(max_threads=0)
+        release_messages(messages)
+        if hasattr(self.queue_client, "close"):
+            self.queue_client.close()
+
+    def pool_stats(self):
+        """Returns the current size of the pool.
+
+        Returns:
+        (dict): Limits of the pool and the number of total, busy and idle
+        threads.
+        """
+        with self._lock:
+            return {"min_threads": self.min_threads, "max_threads": self.max_threads,
+                    "total_threads": self.total_threads, "busy_threads": self.busy_threads,
+                    "idle_threads": self.idle_threads}
+
+    def export_metrics(self):
+        """Reports the size of the pool in the xcs_worker_threads and
+        xcs_worker_thread_limit gauges, which are computed from pool_stats
+        when they are scraped.
+        """
+        def threads():
+            stats = self.pool_stats()
+            return {("busy",): stats["busy_threads"], ("idle",): stats["idle_threads"],
+                    ("total",): stats["total_threads"]}
+
+        def limits():
+            stats = self.pool_stats()
+            return {("max",): stats["max_threads"], ("min",): stats["min_threads"]}
+
+        WORKER_THREADS.set_function(threads)
+        WORKER_THREAD_LIMIT.set_function(limits)
+
+    def owner_stats(self):
+        """Returns per-owner scheduling statistics.
+
+        Returns:
+        (dict): Statistics from FairScheduler.stats.
+        """
+        with self._task_ready:
+            return self.scheduler.stats()
+
+    def latency_stats(self):
+        """Returns statistics on how long tasks waited in the queue.
+
+        Returns:
+        (dict): Number of tasks measured and the mean and max seconds between
+        a task being queued and a thread starting it.
+        """
+        latencies = list(self.queue_latencies)
+        if not latencies:
+            return {"tasks": 0, "mean": None, "max": None}
+        return {"tasks": len(latencies), "mean": sum(latencies) / len(latencies), "max": max(latencies)}
@@ -0,0 +1,74 @@
+import time
+import pytest
+import container_handler
+from container_handler import ArtifactCache
+
+BUILD_ENTRY = {"build_id": "build", "build_time": "2026-01-01", "container_type": "singularity"}
+
+
+@pytest.fixture
+def source(monkeypatch):
+    streams = []
+
+    def stream_container(build_entry, byte_range=None, chunk_size=2 * 1024 * 1024):
+        streams.append(byte_range)
+        data = b"container"
+        if byte_range is not None:
+            data = data[byte_range[0]:byte_range[1]]
+        return iter([data[:4], data[4:]]), {"content_length": len(data)}
+
+    monkeypatch.setattr(container_handler, "stream_container", stream_container)
+    return streams
+
+
+def test_caches_streamed_container(source, tmp_path):
+    cache = ArtifactCache(str(tmp_path))
+
+    chunks, info = cache.stream(BUILD_ENTRY)
+    assert b"".join(chunks) == b"container"
+    chunks.close()
+    chunks, info = cache.stream(BUILD_ENTRY)
+    assert b"".join(chunks) == b"container"
+    chunks.close()
+
+    assert len(source) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_closing_unread_fill_frees_it(source, tmp_path):
+    cache = ArtifactCache(str(tmp_path), fill_timeout=5)
+
+    chunks, _ = cache.stream(BUILD_ENTRY)
+    chunks.close()
+
+    start_time = time.time()
+    chunks, _ = cache.stream(BUILD_ENTRY)
+    assert time.time() - start_time < 1
+    assert b"".join(chunks) == b"container"
+    assert len(source) == 2
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_waiter_streams_without_cache_after_timeout(source, tmp_path):
+    cache = ArtifactCache(str(tmp_path), fill_timeout=0.1)
+
+    filling, _ = cache.stream(BUILD_ENTRY)
+    chunks, _ = cache.stream(BUILD_ENTRY)
+    assert b"".join(chunks) == b"container"
+    assert len(source) == 2
+
+    filling.close()
+
+
+def test_streams_cached_range(source, tmp_path):
+    cache = ArtifactCache(str(tmp_path))
+    chunks, _ = cache.stream(BUILD_ENTRY)
+    b"".join(chunks)
+    chunks.close()
+
+    assert cache.size(BUILD_ENTRY) == 9
+    chunks, info = cache.stream(BUILD_ENTRY, byte_range=(6, 9))
+    assert b"".join(chunks) == b"ner"
+    assert info == {"content_length": 3, "content_range": "bytes 6-8/9", "total_size": 9}
+    with pytest.raises(ValueError):
+        cache.stream(BUILD_ENTRY, byte_range=(9, 9))
@@ -0,0 +1,130 @@
+import threading
+import time
+import pytest
+import auth_utils
+from auth_utils import TokenCache
+
+
+class StubAuthClient:
+    """Stands in for ConfidentialAppAuthClient, answering introspections
+    from a dict of tokens and counting the calls."""
+    def __init__(self, tokens, delay=0):
+        self.tokens = tokens
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def oauth2_token_introspect(self, token):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        return StubResponse(dict(self.tokens.get(token, {"active": False})))
+
+
+class StubResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class Clock:
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def make_cache(monkeypatch, tokens, **kwargs):
+    clock = Clock()
+    monkeypatch.setattr(auth_utils.time, "time", clock)
+    client = StubAuthClient(tokens)
+    return TokenCache(client.oauth2_token_introspect, **kwargs), client, clock
+
+
+def test_hit_after_miss(monkeypatch):
+    cache, client, clock = make_cache(monkeypatch, {"a": {"active": True, "client_id": "alice"}})
+
+    assert cache.get("a")["client_id"] == "alice"
+    assert cache.get("a")["client_id"] == "alice"
+    assert client.calls == 1
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+
+def test_expires_after_ttl(monkeypatch):
+    cache, client, clock = make_cache(monkeypatch, {"a": {"active": True, "client_id": "alice"}}, ttl=300)
+
+    cache.get("a")
+    clock.now += 299
+    cache.get("a")
+    assert client.calls == 1
+    clock.now += 1
+    cache.get("a")
+    assert client.calls == 2
+
+
+def test_expires_with_token(monkeypatch):
+    cache, client, clock = make_cache(monkeypatch, {}, ttl=300)
+    client.tokens["a"] = {"active": True, "client_id": "alice", "exp": clock.now + 10}
+
+    cache.get("a")
+    clock.now += 10
+    cache.get("a")
+    assert client.calls == 2
+
+
+def test_invalid_tokens_are_cached_briefly(monkeypatch):
+    cache, client, clock = make_cache(monkeypatch, {"b": {"active": False, "client_id": "bob"}}, negative_ttl=30)
+
+    assert "client_id" not in cache.get("b")
+    assert "client_id" not in cache.get("unknown")
+    cache.get("b")
+    assert client.calls == 2
+    clock.now += 30
+    cache.get("b")
+    assert client.calls == 3
+
+
+def test_evicts_least_recently_used(monkeypatch):
+    tokens = {name: {"active": True, "client_id": name} for name in "abc"}
+    cache, client, clock = make_cache(monkeypatch, tokens, max_size=2)
+
+    cache.get("a")
+    cache.get("b")
+    cache.get("a")
+    cache.get("c")
+    assert cache.stats()["size"] == 2
+    cache.get("a")
+    assert client.calls == 3
+    cache.get("b")
+    assert client.calls == 4
+
+
+def test_concurrent_misses_introspect_once():
+    client = StubAuthClient({"a": {"active": True, "client_id": "alice"}}, delay=0.2)
+    cache = TokenCache(client.oauth2_token_introspect)
+    results = []
+
+    threads = [threading.Thread(target=lambda: results.append(cache.get("a"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert client.calls == 1
+    assert [result["client_id"] for result in results] == ["alice"] * 8
+
+
+def test_failed_introspection_is_retried(monkeypatch):
+    cache, client, clock = make_cache(monkeypatch, {"a": {"active": True, "client_id": "alice"}})
+    failures = [RuntimeError("Globus Auth is unavailable")]
+
+    def introspect(token):
+        if failures:
+            raise failures.pop()
+        return client.oauth2_token_introspect(token)
+    cache.introspect = introspect
+
+    with pytest.raises(RuntimeError):
+        cache.get("a")
+    assert cache.get("a")["client_id"] == "alice"
+    assert cache._introspecting == {}
@@ -0,0 +1,45 @@
+import multiprocessing
+import os
+import pytest
+import container_handler
+import gc_utils
+from container_handler import build_in_flight, in_flight
+from gc_utils import GarbageCollector
+
+
+@pytest.fixture
+def roots(monkeypatch, tmp_path):
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    monkeypatch.setattr(container_handler, "BUILD_LOCK_ROOT", str(tmp_path / "build_locks"))
+    monkeypatch.setattr(gc_utils, "WORKSPACE_ROOT", str(workspace))
+    monkeypatch.setattr(gc_utils, "PROJECT_ROOT", str(tmp_path))
+    return workspace
+
+
+def hold_build(build_id, started, finish):
+    with in_flight(build_id):
+        started.set()
+        finish.wait(10)
+
+
+def test_leftovers_skip_builds_running_in_other_processes(roots):
+    for name in ["running_abc", "finished_def"]:
+        (roots / name).mkdir()
+        os.utime(roots / name, (0, 0))
+
+    context = multiprocessing.get_context("fork")
+    started, finish = context.Event(), context.Event()
+    worker = context.Process(target=hold_build, args=("running", started, finish))
+    worker.start()
+    try:
+        assert started.wait(10)
+        assert build_in_flight("running")
+        assert [os.path.basename(path) for path in GarbageCollector()._leftovers()] == ["finished_def"]
+    finally:
+        finish.set()
+        worker.join()
+
+    assert not build_in_flight("running")
+    assert not os.listdir(container_handler.BUILD_LOCK_ROOT)
+    assert len(GarbageCollector()._leftovers()) == 2
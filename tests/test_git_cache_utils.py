@@ -0,0 +1,93 @@
+import os
+import pytest
+from git_cache_utils import GitError, GitMirrorCache, is_git_url, run_git
+
+
+def commit_file(repo, name, content):
+    with open(os.path.join(repo, name), "w") as f:
+        f.write(content)
+    run_git(["add", name], cwd=repo)
+    run_git(["-c", "user.name=test", "-c", "user.email=test@example.com", "commit", "--quiet", "-m", content],
+            cwd=repo)
+    return run_git(["rev-parse", "HEAD"], cwd=repo).strip()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    path = str(tmp_path / "repo")
+    run_git(["init", "--quiet", path])
+    return path
+
+
+def test_is_git_url():
+    assert is_git_url("https://github.com/jupyterhub/binder-examples")
+    assert not is_git_url("git@github.com:jupyterhub/binder-examples.git")
+    assert not is_git_url("ssh://git@github.com/jupyterhub/binder-examples.git")
+    assert not is_git_url("git://github.com/jupyterhub/binder-examples.git")
+    assert not is_git_url("file:///root/package/git_cache/mirror.git")
+    assert not is_git_url("s3://xtract-container-service/uploads/build/repo.zip")
+    assert not is_git_url("/tmp/repo.tar")
+
+
+def test_clones_once_and_fetches_changes(repo, tmp_path):
+    url = "file://" + repo
+    cache = GitMirrorCache(str(tmp_path / "cache"))
+    first = commit_file(repo, "README", "first")
+
+    assert cache.resolve(url) == first
+    assert cache.resolve(url) == first
+    assert (cache.clones, cache.fetches) == (1, 1)
+
+    second = commit_file(repo, "README", "second")
+    assert cache.resolve(url) == second
+    assert cache.resolve(url, first) == first
+    assert (cache.clones, cache.fetches) == (1, 3)
+    assert cache.stats()["mirrors"] == 1
+
+
+def test_resolves_branches_and_tags(repo, tmp_path):
+    url = "file://" + repo
+    cache = GitMirrorCache(str(tmp_path / "cache"))
+    tagged = commit_file(repo, "README", "tagged")
+    run_git(["tag", "v1"], cwd=repo)
+    run_git(["checkout", "--quiet", "-b", "feature"], cwd=repo)
+    feature = commit_file(repo, "README", "feature")
+
+    assert cache.resolve(url, "v1") == tagged
+    assert cache.resolve(url, "feature") == feature
+    with pytest.raises(GitError):
+        cache.resolve(url, "missing")
+
+
+def test_checks_out_one_commit(repo, tmp_path):
+    url = "file://" + repo
+    cache = GitMirrorCache(str(tmp_path / "cache"))
+    first = commit_file(repo, "README", "first")
+    commit_file(repo, "README", "second")
+    cache.resolve(url)
+
+    dest = str(tmp_path / "worktree")
+    cache.checkout(url, first, dest)
+    with open(os.path.join(dest, "README")) as f:
+        assert f.read() == "first"
+    assert run_git(["rev-parse", "HEAD"], cwd=dest).strip() == first
+    assert run_git(["rev-list", "--count", "HEAD"], cwd=dest).strip() == "1"
+
+
+def test_missing_repository(tmp_path):
+    cache = GitMirrorCache(str(tmp_path / "cache"))
+    with pytest.raises(GitError):
+        cache.resolve("file://" + str(tmp_path / "missing"))
+    assert cache.mirrors() == []
+
+
+def test_shrink_removes_mirrors(repo, tmp_path):
+    url = "file://" + repo
+    cache = GitMirrorCache(str(tmp_path / "cache"))
+    commit_file(repo, "README", "first")
+    cache.resolve(url)
+
+    assert cache.shrink(1) > 0
+    assert cache.mirrors() == []
+    cache.resolve(url)
+    assert cache.clones == 2
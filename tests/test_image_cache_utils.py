@@ -0,0 +1,35 @@
+import image_cache_utils
+from image_cache_utils import ImageCache
+
+
+class StubDockerClient:
+    def __init__(self):
+        self.df_calls = 0
+
+    def df(self):
+        self.df_calls += 1
+        return {"LayersSize": 0, "Images": []}
+
+
+def test_periodic_prune_only_lists_images_after_use(monkeypatch):
+    client = StubDockerClient()
+    monkeypatch.setattr(image_cache_utils, "get_docker_client", lambda: client)
+    now = [1000.0]
+    monkeypatch.setattr(image_cache_utils.time, "time", lambda: now[0])
+    cache = ImageCache(check_time=600)
+
+    cache.prune()
+    cache.prune()
+    assert client.df_calls == 1
+
+    with cache.in_use("image"):
+        pass
+    cache.prune()
+    assert client.df_calls == 2
+
+    now[0] += 600
+    cache.prune()
+    assert client.df_calls == 3
+
+    cache.prune(max_bytes=0)
+    assert client.df_calls == 4
@@ -0,0 +1,32 @@
+import log_utils
+from log_utils import BuildLog
+
+
+class StubS3:
+    def __init__(self):
+        self.objects = {}
+        self.failing = False
+
+    def put_object(self, Bucket, Key, Body):
+        if self.failing:
+            raise ConnectionError("S3 is unavailable")
+        self.objects[Key] = Body
+
+
+def test_pending_output_is_capped_while_uploads_fail(monkeypatch):
+    s3 = StubS3()
+    monkeypatch.setattr(log_utils, "get_boto3_client", lambda service: s3)
+    build_log = BuildLog("build", max_bytes=100, chunk_bytes=10)
+
+    s3.failing = True
+    for idx in range(50):
+        build_log.write(f"line {idx:03d}\n")
+    assert len(build_log._pending) == 100
+    assert build_log.dropped == 350
+
+    s3.failing = False
+    build_log.close()
+    uploaded = b"".join(body for _, body in sorted(s3.objects.items()))
+    assert uploaded.startswith(b"[350 bytes of log dropped because they couldn't be uploaded]\n")
+    assert uploaded.endswith(b"line 049\n")
+    assert build_log.read(0)[1] == 450
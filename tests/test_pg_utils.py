@@ -0,0 +1,72 @@
+import threading
+import psycopg2
+import pytest
+import pg_utils
+from pg_utils import ConnectionPool
+
+
+class StubConnection:
+    class info:
+        transaction_status = 0
+
+    def __init__(self):
+        self.closed = 0
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+
+    def connect(**credentials):
+        opened.append(StubConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(psycopg2, "connect", connect, raising=False)
+    monkeypatch.setattr(psycopg2.extensions, "TRANSACTION_STATUS_IDLE", 0, raising=False)
+    monkeypatch.setattr(pg_utils, "config", lambda config_file: {})
+    return opened
+
+
+def test_stats_count_checkouts_and_reuse_connections(connections):
+    pool = ConnectionPool(min_connections=1, max_connections=3)
+    assert pool.stats()["idle"] == 1
+
+    conns = [pool.getconn() for _ in range(3)]
+    assert len(connections) == 3
+    stats = pool.stats()
+    assert (stats["in_use"], stats["idle"], stats["checkouts"]) == (3, 0, 3)
+
+    for conn in conns:
+        pool.putconn(conn)
+    stats = pool.stats()
+    assert (stats["in_use"], stats["idle"]) == (0, 3)
+
+    # Returned connections are reused rather than reopened
+    pool.putconn(pool.getconn())
+    assert len(connections) == 3
+
+
+def test_closed_connections_are_not_kept(connections):
+    pool = ConnectionPool(min_connections=0, max_connections=2)
+    conn = pool.getconn()
+    pool.putconn(conn, close=True)
+    assert conn.closed
+    assert pool.stats()["idle"] == 0
+
+    pool.closeall()
+    assert all(conn.closed for conn in connections)
+
+
+def test_exhausted_pool_blocks_until_a_connection_is_returned(connections):
+    pool = ConnectionPool(min_connections=0, max_connections=1)
+    conn = pool.getconn()
+    threading.Timer(0.2, pool.putconn, args=(conn,)).start()
+
+    assert pool.getconn() is conn
+    assert pool.stats()["waits"] == 1
@@ -0,0 +1,217 @@
+import itertools
+import threading
+import time
+import pytest
+import sqs_queue_utils
+from sqs_queue_utils import MissingQueue, MultiQueueClient, QueueClient
+
+
+class StubSQS:
+    """Stands in for a boto3 SQS client, keeping queues in memory with
+    visibility timeouts, receive counts and long polling."""
+    class exceptions:
+        class QueueDoesNotExist(Exception):
+            pass
+
+    def __init__(self, queue_names):
+        self.queues = {f"https://sqs/{name}": {} for name in queue_names}
+        self.calls = []
+        self.wait_times = []
+        self._ids = itertools.count()
+        self._ready = threading.Condition()
+
+    def get_queue_url(self, QueueName):
+        url = f"https://sqs/{QueueName}"
+        if url not in self.queues:
+            raise self.exceptions.QueueDoesNotExist(QueueName)
+        return {"QueueUrl": url}
+
+    def send_message(self, QueueUrl, MessageBody):
+        with self._ready:
+            self.calls.append("send_message")
+            message_id = str(next(self._ids))
+            self.queues[QueueUrl][message_id] = {"body": MessageBody, "visible_at": 0, "receive_count": 0,
+                                                 "receipt_handle": None}
+            self._ready.notify_all()
+        return {"MessageId": message_id}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= 10
+        for entry in Entries:
+            self.send_message(QueueUrl, entry["MessageBody"])
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds, AttributeNames, VisibilityTimeout=30):
+        assert 1 <= MaxNumberOfMessages <= 10 and 0 <= WaitTimeSeconds <= 20
+        deadline = time.time() + WaitTimeSeconds
+        with self._ready:
+            self.calls.append("receive_message")
+            self.wait_times.append(WaitTimeSeconds)
+            while True:
+                now = time.time()
+                visible = [message_id for message_id, message in self.queues[QueueUrl].items()
+                           if message["visible_at"] <= now]
+                if visible or now >= deadline:
+                    break
+                self._ready.wait(min(deadline - now, 0.05))
+
+            messages = []
+            for message_id in visible[:MaxNumberOfMessages]:
+                message = self.queues[QueueUrl][message_id]
+                message["receipt_handle"] = f"{message_id}-{message['receive_count']}"
+                message["receive_count"] += 1
+                message["visible_at"] = now + VisibilityTimeout
+                messages.append({"Body": message["body"], "ReceiptHandle": message["receipt_handle"],
+                                 "Attributes": {"ApproximateReceiveCount": str(message["receive_count"])}})
+        return {"Messages": messages} if messages else {}
+
+    def _received(self, QueueUrl, ReceiptHandle):
+        for message_id, message in self.queues[QueueUrl].items():
+            if message["receipt_handle"] == ReceiptHandle:
+                return message_id
+        raise ValueError(f"Invalid receipt handle {ReceiptHandle}")
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self._ready:
+            self.calls.append("delete_message")
+            del self.queues[QueueUrl][self._received(QueueUrl, ReceiptHandle)]
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        with self._ready:
+            self.calls.append(("change_message_visibility", VisibilityTimeout))
+            message_id = self._received(QueueUrl, ReceiptHandle)
+            self.queues[QueueUrl][message_id]["visible_at"] = time.time() + VisibilityTimeout
+            self._ready.notify_all()
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        now = time.time()
+        visible = [message for message in self.queues[QueueUrl].values() if message["visible_at"] <= now]
+        return {"Attributes": {"ApproximateNumberOfMessages": str(len(visible))}}
+
+    def depth(self, queue_name):
+        return len(self.queues[f"https://sqs/{queue_name}"])
+
+
+def queue_client(sqs, queue_name):
+    client = QueueClient(queue_name)
+    client._client = sqs
+    return client
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    sqs = StubSQS(["tasks", "other", "dlq"])
+    monkeypatch.setattr(sqs_queue_utils, "_queue_clients",
+                        {name: queue_client(sqs, name) for name in ["tasks", "other", "dlq"]})
+    return sqs
+
+
+def test_send_and_receive_batches(sqs):
+    client = sqs_queue_utils.get_queue_client("tasks")
+
+    assert client.send_batch([{"task": idx} for idx in range(25)]) == []
+    assert sqs.calls.count("send_message") == 25
+
+    messages = client.receive_batch(25)
+    assert len(messages) == 10
+    assert sqs.calls.count("receive_message") == 1
+    assert [message.body["task"] for message in messages] == list(range(10))
+    assert all(message.receive_count == 1 and "queued_at" in message.body for message in messages)
+    assert client.approximate_depth() == 15
+
+
+def test_message_is_redelivered_until_deleted(sqs):
+    client = sqs_queue_utils.get_queue_client("tasks")
+    client.put_message({"task": 1})
+
+    message = client.receive_batch(1, visibility_timeout=0)[0]
+    message = client.receive_batch(1)[0]
+    assert message.receive_count == 2
+    message.delete()
+    assert sqs.depth("tasks") == 0
+
+
+def test_heartbeat_extends_visibility(sqs):
+    client = sqs_queue_utils.get_queue_client("tasks")
+    client.put_message({"task": 1})
+    message = client.receive_batch(1, visibility_timeout=1)[0]
+
+    with message.heartbeat(timeout=0.3):
+        time.sleep(1.5)
+        assert client.receive_batch(1) == []
+    extensions = [call for call in sqs.calls if call == ("change_message_visibility", 0.3)]
+    assert len(extensions) >= 4
+
+
+def test_dead_letter_moves_message(sqs):
+    client = sqs_queue_utils.get_queue_client("tasks")
+    client.put_message({"task": 1})
+    message = client.receive_batch(1)[0]
+
+    message.dead_letter("dlq")
+    assert sqs.depth("tasks") == 0
+    dead = sqs_queue_utils.get_queue_client("dlq").receive_batch(1)
+    assert dead[0].body["task"] == 1
+
+
+def test_missing_queue_is_not_created():
+    client = queue_client(StubSQS([]), "missing")
+    with pytest.raises(MissingQueue):
+        client.put_message({"task": 1})
+
+
+def test_multi_queue_client_long_polls_every_queue(sqs):
+    tasks, other = sqs_queue_utils.get_queue_client("tasks"), sqs_queue_utils.get_queue_client("other")
+    client = MultiQueueClient([tasks, other], poll_time=5)
+
+    start_time = time.time()
+    assert client.receive_batch(10, wait_time=0.5) == []
+    assert time.time() - start_time < 1
+    assert sqs.calls.count("receive_message") == 2
+
+    threading.Timer(0.2, other.put_message, args=({"task": 1},)).start()
+    start_time = time.time()
+    messages = client.receive_batch(10, wait_time=5)
+    assert time.time() - start_time < 1
+    assert [message.body["task"] for message in messages] == [1]
+
+
+def test_multi_queue_client_polls_for_the_callers_wait(sqs):
+    tasks = sqs_queue_utils.get_queue_client("tasks")
+    client = MultiQueueClient([tasks], poll_time=20)
+
+    assert client.receive_batch(1, wait_time=0.2) == []
+    time.sleep(1.2)
+    assert sqs.wait_times == [1]
+
+
+def test_multi_queue_client_releases_messages_nobody_takes(sqs):
+    tasks, other = sqs_queue_utils.get_queue_client("tasks"), sqs_queue_utils.get_queue_client("other")
+    client = MultiQueueClient([tasks, other], poll_time=5)
+
+    # The receiver's poll outlives the caller, so what it receives is released
+    assert client.receive_batch(1, wait_time=0.2) == []
+    tasks.put_message({"task": 1})
+    time.sleep(0.2)
+    assert tasks.approximate_depth() == 1
+    assert client.approximate_depth() == 1
+    assert ("change_message_visibility", 0) in sqs.calls
+
+    # Only one of the messages received from both queues is taken
+    other.put_message({"task": 2})
+    messages = client.receive_batch(1, wait_time=1)
+    time.sleep(0.2)
+    assert len(messages) == 1
+    assert tasks.approximate_depth() + other.approximate_depth() == 1
+    assert client.approximate_depth() == 1
+
+
+def test_multi_queue_client_releases_on_close(sqs):
+    tasks = sqs_queue_utils.get_queue_client("tasks")
+    client = MultiQueueClient([tasks], poll_time=2)
+
+    assert client.receive_batch(1, wait_time=0.2) == []
+    client.close()
+    tasks.put_message({"task": 1})
+    time.sleep(0.2)
+    assert tasks.approximate_depth() == 1
@@ -0,0 +1,147 @@
+import threading
+import time
+import pytest
+import sqs_queue_utils
+import task_manager
+from task_manager import FairScheduler, TaskManager
+
+
+class StubMessage:
+    def __init__(self, owner, priority=0, name=None):
+        self.body = {"client_id": owner, "priority": priority, "name": name}
+
+
+@pytest.fixture
+def queues(monkeypatch):
+    monkeypatch.setenv("XCS_QUEUE_BACKEND", "memory")
+    monkeypatch.setattr(sqs_queue_utils, "_queue_clients", {})
+    statuses = []
+    monkeypatch.setattr(task_manager, "update_table_entry",
+                        lambda table_name, build_id, **columns: statuses.append((build_id, columns)))
+    return sqs_queue_utils.get_queue_client("tasks"), sqs_queue_utils.get_queue_client("dlq"), statuses
+
+
+def make_manager(queue, function, **kwargs):
+    manager = TaskManager(queue_client=queue, dead_letter_queue="dlq", wait_time=1, **kwargs)
+    manager.functions = {"work": function}
+    return manager
+
+
+def run_next(manager):
+    owner, message = manager.get_task(wait_time=1)
+    try:
+        manager.run_task(message)
+    finally:
+        manager.scheduler.done(owner)
+
+
+def test_scheduler_takes_turns_between_owners():
+    scheduler = FairScheduler()
+    for priority, name in [(0, "a1"), (100, "a2"), (50, "a3")]:
+        scheduler.add(StubMessage("a", priority, name))
+    scheduler.add(StubMessage("b", 0, "b1"))
+
+    order = [scheduler.pop()[1].body["name"] for _ in range(4)]
+    assert order == ["a2", "b1", "a3", "a1"]
+    assert scheduler.pop() is None
+
+
+def test_scheduler_limits_running_tasks_per_owner():
+    scheduler = FairScheduler(max_owner_tasks=1)
+    scheduler.add(StubMessage("a", name="a1"))
+    scheduler.add(StubMessage("a", name="a2"))
+
+    owner, _ = scheduler.pop()
+    assert scheduler.pop() is None
+    scheduler.done(owner)
+    assert scheduler.pop()[1].body["name"] == "a2"
+
+
+def test_failed_task_is_retried(queues):
+    tasks, dlq, _ = queues
+    attempts = []
+
+    def work(build_id, **task):
+        attempts.append(build_id)
+        if len(attempts) == 1:
+            raise RuntimeError("Transient failure")
+
+    manager = make_manager(tasks, work, max_retry=1)
+    tasks.put_message({"function_name": "work", "client_id": "a", "build_id": "build"})
+    run_next(manager)
+    run_next(manager)
+
+    assert attempts == ["build", "build"]
+    assert tasks.approximate_depth() == 0 and not tasks._messages
+    assert dlq.approximate_depth() == 0
+
+
+def test_task_failing_every_retry_is_dead_lettered(queues):
+    tasks, dlq, statuses = queues
+
+    def work(build_id, **task):
+        raise RuntimeError("Permanent failure")
+
+    manager = make_manager(tasks, work, max_retry=1)
+    tasks.put_message({"function_name": "work", "client_id": "a", "build_id": "build"})
+    run_next(manager)
+    run_next(manager)
+
+    assert not tasks._messages
+    assert dlq.approximate_depth() == 1
+    assert statuses == [("build", {"build_status": "failed"})]
+
+
+def test_scale_starts_a_thread_per_queued_task(queues):
+    tasks, _, _ = queues
+    release = threading.Event()
+    manager = make_manager(tasks, lambda **task: release.wait(5), max_threads=2)
+    for _ in range(3):
+        tasks.put_message({"function_name": "work", "client_id": "a"})
+
+    assert manager.scale() == 2
+    deadline = time.time() + 5
+    while manager.pool_stats()["busy_threads"] < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    assert manager.pool_stats()["busy_threads"] == 2
+
+    release.set()
+    manager.drain()
+
+
+def test_drain_releases_held_tasks(queues):
+    tasks, _, _ = queues
+    manager = make_manager(tasks, lambda **task: None)
+    for _ in range(3):
+        tasks.put_message({"function_name": "work", "client_id": "a"})
+
+    task = manager.get_task(wait_time=1, max_prefetch=3)
+    assert task is not None
+    assert len(manager.scheduler) == 2 and tasks.approximate_depth() == 0
+
+    manager.drain()
+    assert tasks.approximate_depth() == 2
+    assert manager.get_task(wait_time=1) is None
+
+
+def test_thread_survives_receive_errors(queues, monkeypatch):
+    tasks, _, _ = queues
+    done = threading.Event()
+    manager = make_manager(tasks, lambda **task: done.set(), kill_time=30)
+    monkeypatch.setattr(task_manager, "MAX_BACKOFF", 0.1)
+    receive_batch = tasks.receive_batch
+    failures = []
+
+    def flaky_receive_batch(*args, **kwargs):
+        if not failures:
+            failures.append(1)
+            raise RuntimeError("Receive failed")
+        return receive_batch(*args, **kwargs)
+
+    monkeypatch.setattr(tasks, "receive_batch", flaky_receive_batch)
+    tasks.put_message({"function_name": "work", "client_id": "a"})
+    manager.start_thread()
+
+    assert done.wait(5)
+    assert manager.pool_stats()["total_threads"] == 1
+    manager.drain()
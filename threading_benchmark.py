@@ -0,0 +1,64 @@
+"""Measures TaskManager throughput against the number of threads.
+
+Tasks are simulated with a fixed sleep and served from an in-memory queue,
+so this runs without AWS and measures the pool itself rather than Docker or
+Singularity. This automates what threading_experiments.ipynb measured by
+hand against a live server.
+
+Usage:
+    python threading_benchmark.py --tasks 200 --task_time 0.1 --threads 1 2 4 8 16
+"""
+import argparse
+import csv
+import sys
+import threading
+import time
+from memory_queue_utils import MemoryQueueClient
+from task_manager import TaskManager
+
+
+def run(threads, tasks, task_time):
+    """Runs tasks through a pool of a fixed number of threads.
+
+    Parameters:
+    threads (int): Number of threads in the pool.
+    tasks (int): Number of tasks to run.
+    task_time (float): Number of seconds each task takes.
+
+    Returns:
+    (tuple (float)): Seconds to finish every task and the mean queue latency.
+    """
+    queue = MemoryQueueClient("threading-benchmark")
+    manager = TaskManager(max_threads=threads, min_threads=threads, kill_time=1, wait_time=1, queue_client=queue)
+    finished = threading.Semaphore(0)
+
+    def task():
+        time.sleep(task_time)
+        finished.release()
+
+    manager.functions = {"task": task}
+    start_time = time.time()
+    for _ in range(tasks):
+        queue.put_message({"function_name": "task"})
+    manager.scale()
+    for _ in range(tasks):
+        finished.acquire()
+    total_time = time.time() - start_time
+    manager.resize(max_threads=0)
+
+    return total_time, manager.latency_stats()["mean"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--task_time", type=float, default=0.1)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["threads", "tasks", "time", "tasks_per_second", "mean_queue_latency"])
+    for threads in args.threads:
+        total_time, latency = run(threads, args.tasks, args.task_time)
+        writer.writerow([threads, args.tasks, round(total_time, 3), round(args.tasks / total_time, 2),
+                         round(latency, 3)])
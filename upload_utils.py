@@ -0,0 +1,90 @@
+import hashlib
+import os
+from boto3.s3.transfer import TransferConfig
+from client_utils import get_boto3_client
+from metrics_utils import UPLOAD_SECONDS
+
+UPLOAD_CONFIG = TransferConfig(multipart_threshold=8 * 1024 ** 2, multipart_chunksize=16 * 1024 ** 2,
+                               max_concurrency=8)
+
+
+class UploadTooLarge(ValueError):
+    """Raised when an upload is larger than the upload size limit."""
+
+
+def max_upload_size():
+    """Returns the maximum size of an upload in bytes, read from
+    XCS_MAX_UPLOAD_SIZE.
+
+    Returns:
+    (int): Maximum size of an upload in bytes. Defaults to 10 GB.
+    """
+    return int(os.environ.get("XCS_MAX_UPLOAD_SIZE", 10 * 1024 ** 3))
+
+
+class HashingReader:
+    """Non-seekable file object that hashes and counts the bytes read through
+    it, so a file can be hashed while it is streamed somewhere else. The
+    digest is the same as hash_definition's for a single file.
+
+    Parameters:
+    file_obj: Binary file object to read from.
+    file_name (str): Name of the file, which is part of the hash.
+    max_bytes (int): Maximum number of bytes to read before raising
+    UploadTooLarge or None for no limit.
+
+    Attributes:
+    size (int): Number of bytes read.
+    """
+    def __init__(self, file_obj, file_name, max_bytes=None):
+        self.file_obj = file_obj
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._digest = hashlib.sha256(file_name.encode() + b"\0")
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise UploadTooLarge(f"Upload is larger than {self.max_bytes} bytes")
+        self._digest.update(data)
+        return data
+
+    def seekable(self):
+        return False
+
+    def hexdigest(self):
+        """Returns the hash of the bytes read so far.
+
+        Returns:
+        (str): Hex SHA-256 digest.
+        """
+        digest = self._digest.copy()
+        digest.update(b"\0")
+        return digest.hexdigest()
+
+
+def stream_upload(file_obj, file_name, key, max_bytes=None):
+    """Streams a file to S3 in one pass, hashing it on the way. Large files
+    are sent as a multipart upload with several parts in flight at once, and
+    the file is never held in memory or written to disk here.
+
+    Parameters:
+    file_obj: Binary file object or stream to upload.
+    file_name (str): Name of the file, which is part of the hash.
+    key (str): Key to upload the file to in the xtract-container-service
+    bucket.
+    max_bytes (int): Maximum size of the file. Defaults to max_upload_size.
+
+    Returns:
+    definition_hash (str): Hash of the file as computed by hash_definition.
+    size (int): Size of the file in bytes.
+
+    Raises:
+    UploadTooLarge: If the file is larger than max_bytes. Nothing is stored.
+    """
+    reader = HashingReader(file_obj, file_name, max_upload_size() if max_bytes is None else max_bytes)
+    with UPLOAD_SECONDS.time(kind="request"):
+        get_boto3_client("s3").upload_fileobj(reader, "xtract-container-service", key, Config=UPLOAD_CONFIG)
+
+    return reader.hexdigest(), reader.size
@@ -0,0 +1,96 @@
+"""Runs a build node without the web API.
+
+A worker pulls tasks from the queues of the container formats it can build,
+registers itself in the node table and sends heartbeats with its capacity
+and load. Start one per build machine to scale builds horizontally behind
+the API in flaskapp.wsgi, which can run without builds of its own by
+setting XCS_EMBEDDED_THREADS=0.
+
+Usage:
+    python worker.py --max_threads 8 --formats docker singularity --metrics_port 9100
+"""
+import argparse
+import logging
+import signal
+import threading
+import time
+from metrics_utils import serve_metrics
+from node_utils import NodeHeartbeat, detect_formats
+from pg_utils import prep_database, table_exists, update_schema
+from task_manager import TaskManager
+
+
+def run(max_threads, min_threads, kill_time, max_owner_threads, formats, prune_time, scale_time,
+        heartbeat_time, drain_time, metrics_port=None):
+    """Runs a build node until it receives SIGTERM or SIGINT, then stops
+    receiving tasks, releases the ones it received but didn't start to other
+    nodes and waits up to drain_time seconds for the running ones to
+    finish.
+
+    Parameters:
+    max_threads (int): Maximum number of build threads.
+    min_threads (int): Number of build threads to keep running while idle.
+    kill_time (int): Seconds an idle thread above min_threads waits before
+    dying.
+    max_owner_threads (int): Maximum number of threads running tasks of one
+    owner at once or None for no limit.
+    formats (list (str)): Container formats to build or None to detect
+    them.
+    prune_time (int): Seconds between image pruning and garbage collection
+    passes.
+    scale_time (int): Seconds between pool scaling passes.
+    heartbeat_time (int): Seconds between node heartbeats.
+    drain_time (int): Seconds to wait for running tasks when stopping.
+    metrics_port (int): Port to serve Prometheus metrics on /metrics from or
+    None to not serve them.
+    """
+    if not(table_exists("definition") and table_exists("build")):
+        prep_database()
+    update_schema()
+
+    formats = formats if formats is not None else detect_formats()
+    if not formats:
+        raise RuntimeError("This machine can't build Docker or Singularity containers")
+
+    manager = TaskManager(max_threads=max_threads, min_threads=min_threads, kill_time=kill_time,
+                          formats=formats, max_owner_threads=max_owner_threads)
+    # Raises MissingQueue now rather than in every thread if a queue doesn't exist
+    manager.queue_client.approximate_depth()
+    manager.start_prune_thread(prune_time)
+    manager.start_scale_thread(scale_time)
+    manager.export_metrics()
+    if metrics_port is not None:
+        serve_metrics(metrics_port)
+    heartbeat = NodeHeartbeat(manager, heartbeat_time=heartbeat_time)
+    heartbeat.start()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    stop.wait()
+
+    logging.info(f"Draining node {heartbeat.node_id}")
+    manager.drain()
+    deadline = time.time() + drain_time
+    while manager.busy_threads and time.time() < deadline:
+        time.sleep(1)
+    heartbeat.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max_threads", type=int, default=5)
+    parser.add_argument("--min_threads", type=int, default=1)
+    parser.add_argument("--kill_time", type=int, default=60)
+    parser.add_argument("--max_owner_threads", type=int, default=None)
+    parser.add_argument("--formats", nargs="+", choices=["docker", "singularity"], default=None)
+    parser.add_argument("--prune_time", type=int, default=10)
+    parser.add_argument("--scale_time", type=int, default=5)
+    parser.add_argument("--heartbeat_time", type=int, default=15)
+    parser.add_argument("--drain_time", type=int, default=600)
+    parser.add_argument("--metrics_port", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    run(args.max_threads, args.min_threads, args.kill_time, args.max_owner_threads, args.formats,
+        args.prune_time, args.scale_time, args.heartbeat_time, args.drain_time, args.metrics_port)
@@ -1,4 +1,6 @@
 import json
+import os
+import time
 import requests
 
 
@@ -30,39 +32,221 @@ class XtractConnection:
 
         return definition_id
 
-    def build(self, definition_id, to_format, container_name):
+    def build(self, definition_id, to_format, container_name, priority=0, singularity_name=None):
         """Builds a Docker or Singularity container from an uploaded definition file.
 
         Note:
         A Docker definition file can be built into a Docker and Singularity container but a
-        Singularity definition file can only be built into a Singularity container.
+        Singularity definition file can only be built into a Singularity container. Building
+        a Docker definition file to "both" builds it once and converts the Docker image to
+        Singularity.
 
         Parameters:
         definition_id (str): ID of definition file to build from.
-        to_format (str): "singularity" or "docker".
+        to_format (str): "singularity", "docker" or "both".
         container_name (str): Name to give the built container.
+        priority (int): Priority of the build among your other queued builds.
+        Higher priority builds start first.
+        singularity_name (str): Name to give the Singularity container when to_format
+        is "both". Defaults to container_name with .sif appended.
 
         Returns:
-        build_id (str): ID of the container being built or an error message.
+        build_id (str or dict): ID of the container being built, a dictionary of the
+        "docker" and "singularity" build IDs if to_format is "both" or an error message.
         """
         url = f"{self.base_url}/build"
-        payload = {"definition_id": definition_id, "to_format": to_format, "container_name": container_name}
+        payload = {"definition_id": definition_id, "to_format": to_format, "container_name": container_name,
+                   "priority": priority}
+        if singularity_name is not None:
+            payload["singularity_name"] = singularity_name
         response = requests.post(url, json=payload, headers=self.headers)
         build_id = response.text
+        if to_format == "both":
+            try:
+                build_id = json.loads(response.text)
+            except:
+                pass
 
         return build_id
 
-    def get_status(self, build_id):
+    def build_many(self, builds):
+        """Builds several containers from uploaded definition files with one request. Either
+        every build is submitted or none is.
+
+        Parameters:
+        builds (list (dict)): Builds to submit, each with a "definition_id", a "to_format" of
+        "docker" or "singularity", a "container_name" and optionally a "priority".
+
+        Returns:
+        build_ids (list (str) or str): IDs of the builds in the order they were given or an
+        error message.
+        """
+        url = f"{self.base_url}/builds"
+        response = requests.post(url, json={"builds": builds}, headers=self.headers)
+        try:
+            build_ids = json.loads(response.text)["build_ids"]
+        except:
+            build_ids = response.text
+
+        return build_ids
+
+    def get_statuses(self, build_ids):
+        """Retrieves the build entries of several builds with one request.
+
+        Parameters:
+        build_ids (list (str)): IDs of the builds.
+
+        Returns:
+        statuses (dict or str): Build entries keyed by build ID, None for IDs that aren't
+        valid, or an error message.
+        """
+        url = f"{self.base_url}/builds"
+        response = requests.get(url, params={"ids": ",".join(build_ids)}, headers=self.headers)
+        try:
+            statuses = json.loads(response.text)
+        except:
+            statuses = response.text
+
+        return statuses
+
+    def get_status(self, build_id, wait=0, status=None):
         """Retrieves the build entry of a build_id
 
         Parameters:
         build_id (str): ID of build entry to get.
+        wait (float): Number of seconds (at most 60) to wait for the build's status to
+        differ from status before returning.
+        status (str): Status to wait for a change from. Defaults to the current status.
 
         Returns:
         status (json or str.): Json of build entry or an error message
         """
         url = f"{self.base_url}/build"
         payload = {"build_id": build_id}
+        if wait:
+            if status is None:
+                current = self.get_status(build_id)
+                if not isinstance(current, dict):
+                    return current
+                status = current["build_status"]
+            payload["wait"] = wait
+            payload["status"] = status
+        response = requests.get(url, json=payload, headers=self.headers, timeout=wait + 30 if wait else None)
+
+        try:
+            status = json.loads(response.text)
+        except:
+            status = response.text
+
+        return status
+
+    def wait_for(self, build_id, timeout=None, callback=None):
+        """Waits for a build to finish, following its status transitions as the server
+        pushes them instead of polling.
+
+        Parameters:
+        build_id (str): ID of the build to wait for.
+        timeout (float): Maximum number of seconds to wait or None to wait until the
+        build finishes.
+        callback (function): Function called with the build entry on every status
+        transition.
+
+        Returns:
+        build_entry (dict or str): Build entry once its status is "success", "failed",
+        "error" or "cancelled", or when the timeout passes, or an error message.
+        """
+        url = f"{self.base_url}/build/{build_id}/events"
+        deadline = None if timeout is None else time.time() + timeout
+        build_entry = None
+        while deadline is None or time.time() < deadline:
+            try:
+                with requests.get(url, headers=self.headers, stream=True,
+                                  timeout=(10, 60 if deadline is None else max(1, deadline - time.time()))) as response:
+                    if response.status_code != 200:
+                        return response.text
+                    event = None
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line.startswith("event:"):
+                            event = line[len("event:"):].strip()
+                        elif line.startswith("data:") and event == "status":
+                            build_entry = json.loads(line[len("data:"):])
+                            if callback is not None:
+                                callback(build_entry)
+                            if build_entry["build_status"] in ["success", "failed", "error", "cancelled"]:
+                                return build_entry
+                        elif line.startswith("data:") and event == "error":
+                            return json.loads(line[len("data:"):])
+                        if deadline is not None and time.time() >= deadline:
+                            return build_entry
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                # The server ends streams after an hour and proxies may cut idle ones, so reconnect
+                continue
+
+        return build_entry
+
+    def get_log(self, build_id, offset=0, follow=False, callback=None):
+        """Retrieves the output of a build.
+
+        Parameters:
+        build_id (str): ID of the build.
+        offset (int): Byte offset of the log to start from. Negative offsets count from the
+        end of the log, e.g. -10000 for the last 10 kB.
+        follow (bool): Whether to keep reading the log as it is written until the build
+        finishes.
+        callback (function): Function called with each chunk of the log as text as it
+        arrives.
+
+        Returns:
+        log (str): Output of the build from offset or an error message.
+        """
+        url = f"{self.base_url}/build/{build_id}/log"
+        params = {"offset": offset, "follow": "true" if follow else "false"}
+        chunks = []
+        with requests.get(url, params=params, headers=self.headers, stream=follow) as response:
+            if response.status_code != 200:
+                return response.text
+            for chunk in response.iter_content(chunk_size=None):
+                text = chunk.decode(errors="replace")
+                chunks.append(text)
+                if callback is not None:
+                    callback(text)
+
+        return "".join(chunks)
+
+    def build_graph(self, definition_id, to_format, container_names=None, priority=0):
+        """Builds a definition file together with every definition file that depends on it
+        through pre_containers and post_containers, and everything those depend on.
+        Definitions are built as soon as the definitions they depend on are built.
+
+        Parameters:
+        definition_id (str): ID of the root definition file.
+        to_format (str): "singularity" or "docker".
+        container_names (dict (str)): Names to give the built containers, keyed by
+        definition ID. Definition IDs are used for definitions without a name.
+        priority (int): Priority of the builds among your other queued builds.
+
+        Returns:
+        build_graph_id (str): ID of the build graph or an error message.
+        """
+        url = f"{self.base_url}/build_graph"
+        payload = {"definition_id": definition_id, "to_format": to_format,
+                   "container_names": container_names, "priority": priority}
+        response = requests.post(url, json=payload, headers=self.headers)
+        build_graph_id = response.text
+
+        return build_graph_id
+
+    def get_graph_status(self, build_graph_id):
+        """Retrieves the status of a build graph and each of its builds.
+
+        Parameters:
+        build_graph_id (str): ID of build graph to get.
+
+        Returns:
+        status (json or str.): Json of the graph status or an error message
+        """
+        url = f"{self.base_url}/build_graph"
+        payload = {"build_graph_id": build_graph_id}
         response = requests.get(url, json=payload, headers=self.headers)
 
         try:
@@ -72,38 +256,52 @@ class XtractConnection:
 
         return status
 
-    def pull(self, build_id, file_path):
-        """Pulls a container down and writes it to a file.
+    def pull(self, build_id, file_path, resume=False, chunk_size=1024 * 1024):
+        """Pulls a container down and writes it to a file as it streams in.
 
         Note:
         Docker containers are pulled as .tar files and Singularity containers
-        are pulled as .sif files.
+        are pulled as .sif files. Only Singularity pulls can be resumed.
 
         Parameters:
         build_id (str): ID of build to pull down.
         file_path (str): Full path of file to write to.
+        resume (bool): Whether to continue an interrupted pull by requesting
+        only the bytes missing from file_path.
+        chunk_size (int): Number of bytes to read into memory at a time.
 
         Returns:
         (str): A success or error message.
         """
         url = f"{self.base_url}/pull"
         payload = {"build_id": build_id}
-        response = requests.get(url, json=payload, headers=self.headers)
-        if response.headers["Content-Type"] == "text/html":
-            return response.text
-        else:
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
+        headers = dict(self.headers)
+        offset = os.path.getsize(file_path) if resume and os.path.exists(file_path) else 0
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        with requests.get(url, json=payload, headers=headers, stream=True) as response:
+            if response.status_code == 416:
+                # file_path already has every byte of the container
+                return "Success"
+            elif response.headers["Content-Type"].startswith("text/html"):
+                return response.text
+
+            with open(file_path, 'ab' if response.status_code == 206 else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
 
             return "Success"
 
-    def repo2docker(self, container_name, git_repo=None, file_obj=None):
+    def repo2docker(self, container_name, git_repo=None, file_obj=None, priority=0, ref=None):
         """Builds a Docker container from a git repository or .tar or .zip file.
 
         Parameters:
         container_name (str): Name of container to build.
         git_repo (str): URL to base git repository to build.
         file_obj: Binary file object of .zip or .tar file to build.
+        priority (int): Priority of the build among your other queued builds.
+        ref (str): Branch, tag or commit of git_repo to build. Defaults to its default branch.
 
         Return:
         (str): build_id of container or an error message.
@@ -113,14 +311,16 @@ class XtractConnection:
         if git_repo and file_obj:
             return "Can only upload a git repository OR a file"
         elif git_repo:
-            payload = {"container_name": container_name, "git_repo": git_repo}
+            payload = {"container_name": container_name, "git_repo": git_repo, "priority": priority, "ref": ref}
             response = requests.post(url, json=payload, headers=self.headers)
             build_id = response.text
 
             return build_id
         elif file_obj:
-            payload = {"file": (container_name, file_obj)}
-            response = requests.post(url, files=payload, headers=self.headers)
+            # Sent as the raw body so the file is streamed instead of read into a multipart form
+            params = {"container_name": container_name, "priority": priority}
+            headers = dict(self.headers, **{"Content-Type": "application/octet-stream"})
+            response = requests.post(url, data=file_obj, params=params, headers=headers)
             build_id = response.text
 
             return build_id